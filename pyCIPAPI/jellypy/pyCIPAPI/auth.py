@@ -1,6 +1,7 @@
 """Objects for authenticating with the GEL CIP API."""
 
 import json
+import threading
 from datetime import datetime, timedelta
 
 import jwt
@@ -9,8 +10,10 @@ import requests
 from jwt.exceptions import (DecodeError, ExpiredSignatureError,
                             InvalidTokenError)
 
+from . import transport
 from .auth_credentials import auth_credentials
-from .config import beta_testing_auth_url, live_100K_auth_url, live_100k_data_base_url, use_active_directory
+from .config import (beta_testing_auth_url, live_100K_auth_url, live_100k_data_base_url, opencga_base_url,
+                     use_active_directory)
 
 
 # get an authenticated session
@@ -27,6 +30,7 @@ class AuthenticatedCIPAPISession(requests.Session):
 
         """
         requests.Session.__init__(self)
+        transport.mount(self)
         self.auth_credentials = auth_credentials
         self.set_auth_url(testing_on=testing_on)
         if token:
@@ -159,8 +163,9 @@ class AuthenticatedOpenCGASession(requests.Session):
 
         """
         requests.Session.__init__(self)
-        self.host_url = ('https://apps.genomicsengland.nhs.uk/opencga/'
-                         'webservices/rest/v1')
+        transport.mount(self)
+        self.host_url = opencga_base_url
+        self._auth_lock = threading.Lock()
         self.authenticate()
 
     def authenticate(self):
@@ -192,9 +197,53 @@ class AuthenticatedOpenCGASession(requests.Session):
             print('Authentication Error')
         return self
 
-    def check_auth(self, testing_on=False):
-        """Check whether the session is still authenticated."""
-        if maya.now() > self.auth_expires():
-            self.authenticate(testing_on=testing_on)
-        else:
-            pass
+    def auth_current(self, margin=5):
+        """Return True if the session id is valid for at least `margin` more minutes."""
+        return bool(self.auth_time) and maya.now() < self.auth_expires.subtract(minutes=margin)
+
+    def check_auth(self, margin=5):
+        """Log in again if the session id expires within `margin` minutes.
+
+        Safe to call from many threads sharing the session: one thread logs in
+        while the others wait for it and then use the new session id.
+
+        Returns:
+            The current instance of AuthenticatedOpenCGASession.
+        """
+        if not self.auth_current(margin):
+            with self._auth_lock:
+                # Another thread may have logged in while this one waited
+                if not self.auth_current(margin):
+                    self.authenticate()
+        if not self.auth_time:
+            raise Exception('OpenCGA authentication error')
+        return self
+
+
+class OpenCGASessionProvider():
+    """Share one OpenCGA session between threads, logging in again before its session id expires.
+
+    The session is created on first use. OpenCGA session ids expire 30 minutes
+    after login, so the session logs in again once it is within `margin` minutes
+    of expiry. Only one thread logs in at a time.
+
+    Args:
+        margin (float): Minutes before expiry at which the session logs in again.
+
+    >>> provider = OpenCGASessionProvider()
+    >>> session = provider.get()
+    >>> session.get(url, params={'sid': session.sid})
+    """
+
+    def __init__(self, margin=5):
+        self.margin = margin
+        self._session = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the shared session, logged in for at least `margin` more minutes."""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = AuthenticatedOpenCGASession()
+        return self._session.check_auth(self.margin)
@@ -1,14 +1,46 @@
 #!/usr/bin/env python
 
 # Configuration file for setting common variables to avoid hard-coding them in code:
+import os
 
 # Set to true to use Active Directory authentication, or false to use legacy LDAP authentication
 use_active_directory = True
 
+# URLs can be overridden with environment variables, e.g. to use a local mock server (see mock_server.py)
+
 # CIP-API AD authentication URLs
-live_100K_auth_url = 'https://login.microsoftonline.com/0a99a061-37d0-475e-aa91-f497b83269b2/oauth2/token'
-beta_testing_auth_url = 'https://login.microsoftonline.com/99515578-fda0-444c-8f5a-2005038880f2/oauth2/token'
+live_100K_auth_url = os.environ.get(
+    'JELLYPY_CIPAPI_AUTH_URL',
+    'https://login.microsoftonline.com/0a99a061-37d0-475e-aa91-f497b83269b2/oauth2/token'
+)
+beta_testing_auth_url = os.environ.get(
+    'JELLYPY_CIPAPI_BETA_AUTH_URL',
+    'https://login.microsoftonline.com/99515578-fda0-444c-8f5a-2005038880f2/oauth2/token'
+)
 
 # CIP-API base URLs for live data and beta testing:
-live_100k_data_base_url = 'https://cipapi.genomicsengland.nhs.uk/api/2/'
-beta_testing_base_url = 'https://cipapi-beta.genomicsengland.co.uk/api/2/'
+live_100k_data_base_url = os.environ.get('JELLYPY_CIPAPI_URL', 'https://cipapi.genomicsengland.nhs.uk/api/2/')
+beta_testing_base_url = os.environ.get('JELLYPY_CIPAPI_BETA_URL', 'https://cipapi-beta.genomicsengland.co.uk/api/2/')
+
+# OpenCGA REST API base URL:
+opencga_base_url = os.environ.get(
+    'JELLYPY_OPENCGA_URL', 'https://apps.genomicsengland.nhs.uk/opencga/webservices/rest/v1'
+)
+
+# PanelApp API URL for panels, used by jellypy-tierup:
+panelapp_url = os.environ.get('JELLYPY_PANELAPP_URL', 'https://panelapp.genomicsengland.co.uk/api/v1/panels')
+
+# HTTP transport settings used by transport.py for CIP-API, OpenCGA and PanelApp requests:
+# Default (connect, read) timeout in seconds
+http_timeout = (10, 300)
+# Maximum retries for requests failing with a connection error, 429 or 5xx response
+http_retries = 5
+# Base and maximum delay in seconds for exponential backoff between retries
+http_backoff = 1
+http_max_backoff = 60
+# Maximum requests per second for each host. 'default' applies to hosts not listed.
+http_rate_limits = {
+    'default': 20,
+}
+# Connections kept open for each host
+http_pool_size = 32
@@ -1,11 +1,15 @@
 """Functions for getting and manipulating interpretation requests."""
 from __future__ import print_function
 
+import collections
 import datetime
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from time import strptime
 
+import maya
+
 from .auth import AuthenticatedCIPAPISession
 from .config import beta_testing_base_url, live_100k_data_base_url
 
@@ -24,6 +28,94 @@ def get_interpretation_request_json(ir_id, ir_version, reports_v6=True, testing_
     return s.get(request_url, params=payload).json()
 
 
+def get_last_modified_timestamp(case):
+    """Return the listing record's last_modified date as a POSIX timestamp, or None if missing or not parseable.
+
+    Dates are parsed with maya, which accepts ISO 8601 variants such as 'Z' offsets and any number of
+    fractional second digits on every supported Python version.
+    """
+    try:
+        return maya.parse(case['last_modified']).datetime().timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def get_cached_interpretation_request_json(case, cache_dir, reports_v6=True, testing_on=False, token=None,
+                                           session=None):
+    """Get an interpretation request json, reading it from a local cache directory where possible.
+
+    Cached files are named <ir_id>-<ir_version>.json. A cached file is used if it was written after the
+    case's last_modified date in the listing record, otherwise the case is downloaded and the cache updated.
+    If the last_modified date is missing or cannot be parsed, the case is always downloaded, as a cached
+    file may be out of date.
+
+    Args:
+        case: An interpretation request listing record (output of get_interpretation_request_list)
+        cache_dir: Directory of cached interpretation request json files. Created if it does not exist.
+
+    Returns:
+        interpretation_request: JSON representation of the interpretation request
+    """
+    ir_id, ir_version = case['interpretation_request_id'].split('-')
+    cache_path = os.path.join(cache_dir, '{}-{}.json'.format(ir_id, ir_version))
+    last_modified = get_last_modified_timestamp(case)
+    if last_modified is not None and os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= last_modified:
+        with open(cache_path) as fin:
+            return json.load(fin)
+    interpretation_request = get_interpretation_request_json(ir_id, ir_version, reports_v6=reports_v6,
+                                                             testing_on=testing_on, token=token, session=session)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first so concurrent readers never see a partial file
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    with open(tmp_path, 'w') as fout:
+        json.dump(interpretation_request, fout)
+    os.replace(tmp_path, cache_path)
+    return interpretation_request
+
+
+def iter_interpretation_request_json(cases, max_workers=8, cache_dir=None, reports_v6=True, testing_on=False,
+                                     token=None, session=None):
+    """Download interpretation request json for many cases concurrently, yielding them in listing order.
+
+    At most 2 * max_workers interpretation requests are downloaded ahead of the consumer, so memory use
+    stays flat however many cases are requested, provided the caller drops each one after use.
+
+    Args:
+        cases: Interpretation request listing records (output of get_interpretation_request_list)
+        max_workers: Maximum concurrent requests
+        cache_dir: Directory of cached interpretation request json files. If given, cases are read from and
+            saved to the cache with get_cached_interpretation_request_json.
+        session: An authenticated CIP-API session, created if not given
+
+    Yields:
+        (case, interpretation_request) tuples. interpretation_request is None if the download failed.
+    """
+    s = session if session else AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
+
+    def fetch(case):
+        try:
+            if cache_dir:
+                return get_cached_interpretation_request_json(case, cache_dir, reports_v6=reports_v6,
+                                                              testing_on=testing_on, session=s)
+            ir_id, ir_version = case['interpretation_request_id'].split('-')
+            return get_interpretation_request_json(ir_id, ir_version, reports_v6=reports_v6,
+                                                   testing_on=testing_on, session=s)
+        except Exception as error:
+            print('Could not get interpretation request {}: {}'.format(case['interpretation_request_id'], error))
+            return None
+
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers) as executor:
+        for case in cases:
+            pending.append((case, executor.submit(fetch, case)))
+            if len(pending) >= 2 * max_workers:
+                case, future = pending.popleft()
+                yield case, future.result()
+        while pending:
+            case, future = pending.popleft()
+            yield case, future.result()
+
+
 def get_interpretation_request_list(page_size=100,
                                     cip=None,
                                     group_id=None,
@@ -47,9 +139,10 @@ def get_interpretation_request_list(page_size=100,
                                     search=None,
                                     testing_on=False,
                                     token=None,
-                                    minimize=True):
+                                    minimize=True,
+                                    session=None):
     """Get a list of interpretation requests."""
-    s = AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
+    s = session if session else AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
     interpretation_request_list = []
 
     # Use the correct url if using beta dataset for testing (imported form config.py):
@@ -107,21 +200,106 @@ def get_pedigree_dict(interpretation_request):
         pedigree: Dictionary of keys 'relation_to_proband' and 'gelId' pairs
             extracted from the interpretation_request object.
     """
+    return _simple_pedigree(interpretation_request['interpretation_request_data'])
+
+
+def _simple_pedigree(interpretation_request):
+    """Return relation_to_proband: gelId pairs for an interpretation request json.
+
+    Reads GeL v3/v4 pedigree participants keyed by gelId, or v6 pedigree members keyed by participantId.
+    """
+    pedigree_json = interpretation_request['interpretation_request_data']['json_request']['pedigree']
     pedigree = {}
-    for p in (interpretation_request['interpretation_request_data']
-    ['interpretation_request_data']['json_request']['pedigree']
-    ['participants']):
+    for p in pedigree_json.get('participants', pedigree_json.get('members', [])):
+        gel_id = p.get('gelId', p.get('participantId'))
         if p['isProband']:
-            pedigree['Proband'] = p['gelId']
+            pedigree['Proband'] = gel_id
         else:
             try:
                 pedigree[p['additionalInformation']['relation_to_proband']] = (
-                    p['gelId'])
+                    gel_id)
             except KeyError:
                 pass
     return pedigree
 
 
+class PedigreeRoles():
+    """Look up the genotypes of pedigree members for variants by their relation to the proband.
+
+    A gelId to role map is built once per case, so the zygosities of every role are read in a single pass
+    over each variant's calls.
+
+    Args:
+        simple_pedigree: Dictionary of relation_to_proband: gelId pairs (output of get_pedigree_dict)
+
+    >>> roles = PedigreeRoles.from_interpretation_request(interpretation_request)
+    >>> roles.zygosities(variant, ['Proband', 'Mother', 'Father'])
+    {'Proband': 'heterozygous', 'Mother': 'reference_homozygous', 'Father': 'Unknown'}
+    """
+
+    def __init__(self, simple_pedigree):
+        self.simple_pedigree = simple_pedigree
+        # Proband first, then relatives in pedigree order
+        self.roles = sorted(simple_pedigree, key=lambda role: role != 'Proband')
+        self.role_by_gel_id = {gel_id: role for role, gel_id in simple_pedigree.items()}
+
+    @classmethod
+    def from_interpretation_request(cls, interpretation_request):
+        """Create from an interpretation request json (output of get_interpretation_request_json)."""
+        return cls(_simple_pedigree(interpretation_request))
+
+    def zygosities(self, variant, roles=None, missing='Unknown'):
+        """Get the zygosity of each role for a variant.
+
+        Args:
+            variant: A TieredVariants variant with calledGenotypes, or a v6 variant with variantCalls
+            roles: Roles to return. Defaults to all roles in the pedigree.
+            missing: Zygosity for roles without a call
+
+        Returns:
+            zygosities: Dictionary of role: zygosity pairs
+        """
+        roles = self.roles if roles is None else roles
+        zygosities = dict.fromkeys(roles, missing)
+        if 'calledGenotypes' in variant:
+            calls = ((call['gelId'], call['genotype']) for call in variant['calledGenotypes'])
+        else:
+            calls = ((call['participantId'], call['zygosity']) for call in variant['variantCalls'])
+        for gel_id, zygosity in calls:
+            role = self.role_by_gel_id.get(gel_id)
+            if role in zygosities:
+                zygosities[role] = zygosity
+        return zygosities
+
+    def genotype_matrix(self, variants, roles=None, missing='Unknown'):
+        """Get a table of zygosities for every variant in a case. Requires pandas.
+
+        Args:
+            variants: TieredVariants variants, or v6 variants with variantCoordinates
+            roles: Roles to include as columns. Defaults to all roles in the pedigree.
+            missing: Zygosity for roles without a call
+
+        Returns:
+            A pandas DataFrame indexed by chromosome, position, reference and alternate, with a column of
+            zygosities for each role
+        """
+        import pandas as pd
+
+        roles = self.roles if roles is None else roles
+        # Build one list per column rather than one dictionary per row
+        names = ['chromosome', 'position', 'reference', 'alternate']
+        keys = {name: [] for name in names}
+        columns = {role: [] for role in roles}
+        for variant in variants:
+            coordinates = variant.get('variantCoordinates', variant)
+            for name in names:
+                keys[name].append(coordinates[name])
+            for role, zygosity in self.zygosities(variant, roles, missing).items():
+                columns[role].append(zygosity)
+        index = pd.MultiIndex.from_arrays([keys[name] for name in names], names=names)
+        return pd.DataFrame(columns, index=index, columns=roles)
+
+
 def get_variant_tier(variant):
     """Get the most significant tier (lowest) for a variant.
 
@@ -144,6 +322,23 @@ def get_variant_tier(variant):
     return tier
 
 
+def count_variant_tiers(interpretation_request):
+    """Count the number of tiered variants in each tier for an interpretation request.
+
+    Args:
+        interpretation_request: JSON representation of an
+            interpretation_request (output of get_interpretation_request_json).
+
+    Returns:
+        counts: Dictionary of 'T1', 'T2' and 'T3' variant counts
+    """
+    counts = {'T1': 0, 'T2': 0, 'T3': 0}
+    for variant in (interpretation_request['interpretation_request_data']
+                    ['json_request']['TieredVariants']):
+        counts['T{}'.format(get_variant_tier(variant))] += 1
+    return counts
+
+
 def save_interpretation_request_list_json(interpretation_request_list,
                                           force_update=False):
     """Save a list of interpretation requests as a datestamped JSON."""
@@ -157,7 +352,7 @@ def save_interpretation_request_list_json(interpretation_request_list,
             json.dump(interpretation_request_list, fout)
 
 
-def access_date_summary_content(date1, date2, testing_on=False, token=None):
+def access_date_summary_content(date1, date2, testing_on=False, token=None, session=None):
     """
     method for accessing the JSON response from the date summary endpoint
     :param date1: '%d-%m-%Y' format date string
@@ -174,7 +369,7 @@ def access_date_summary_content(date1, date2, testing_on=False, token=None):
 
     date_summary_ext = 'interpretation-request/date-summary/{start}/{fin}/'.format(start=date1, fin=date2)
 
-    s = AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
+    s = session if session else AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
 
     # switch based on test arg - currently a single results page
     if testing_on:
@@ -183,7 +378,7 @@ def access_date_summary_content(date1, date2, testing_on=False, token=None):
         return s.get(live_100k_data_base_url + date_summary_ext).json()
 
 
-def get_interpreted_genome_for_case(ir, version, tiering_service, testing_on=False, token=None):
+def get_interpreted_genome_for_case(ir, version, tiering_service, testing_on=False, token=None, session=None):
     """
 
     :param ir: case ID, e.g. X in GEL-XXXX-y
@@ -191,10 +386,11 @@ def get_interpreted_genome_for_case(ir, version, tiering_service, testing_on=Fal
     :param tiering_service: name of the interpreted genome service to check for
     :param testing_on:
     :param token:
+    :param session: an authenticated CIP-API session, created if not given
     :return: an interpreted genome JSON, or None
     """
 
-    s = AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
+    s = session if session else AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
 
     endpoint_suffix = 'interpreted-genome/{ir}/{ver}/{service}/last/?reports_v6=true'.format(ir=ir, ver=version,
                                                                                              service=tiering_service)
@@ -212,6 +408,62 @@ def get_interpreted_genome_for_case(ir, version, tiering_service, testing_on=Fal
         return None
 
 
+def get_interpreted_genomes(cases, tiering_service, testing_on=False, token=None, session=None, max_workers=8):
+    """Get the last interpreted genome from a service for many cases concurrently over one session.
+
+    Args:
+        cases: Case ids in IR-VERSION format, e.g. ['1234-1', '5678-2']
+        tiering_service: Name of the interpreted genome service, e.g. 'genomics_england_pharmacogenomics'
+        testing_on: Use the CIP-API beta dataset
+        token: A pre-authorised CIP-API token
+        session: An authenticated CIP-API session, created if not given
+        max_workers: Maximum concurrent requests
+
+    Returns:
+        A dictionary mapping each case id to its interpreted genome JSON, or None if the case has no
+        interpreted genome from the service.
+    """
+    s = session if session else AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
+
+    def fetch(case):
+        ir, version = case.split('-')
+        genome = get_interpreted_genome_for_case(ir, version, tiering_service, testing_on=testing_on, session=s)
+        return None if not genome or genome == {'detail': 'Not found.'} else genome
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        return dict(zip(cases, executor.map(fetch, cases)))
+
+
+def get_case_metadata(cases, testing_on=False, token=None, session=None, max_workers=8):
+    """Get interpretation request listing records for many cases concurrently over one session.
+
+    Records are the minimised listing data for each case, including the proband, sites and status.
+
+    Args:
+        cases: Case ids in IR-VERSION format, e.g. ['1234-1', '5678-2']
+        testing_on: Use the CIP-API beta dataset
+        token: A pre-authorised CIP-API token
+        session: An authenticated CIP-API session, created if not given
+        max_workers: Maximum concurrent requests
+
+    Returns:
+        A dictionary mapping each case id to its listing record, or None if the case is not found.
+    """
+    s = session if session else AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
+    # Each listing request returns every version of an interpretation request, so request each id once
+    ir_ids = sorted({case.split('-')[0] for case in cases})
+
+    def fetch(ir_id):
+        return get_interpretation_request_list(interpretation_request_id=ir_id, testing_on=testing_on, session=s)
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        records = {
+            record['interpretation_request_id']: record
+            for results in executor.map(fetch, ir_ids) for record in results
+        }
+    return {case: records.get(case) for case in cases}
+
+
 def get_workspace_mapping(token=None):
     """
     Currently 100k only, no need for a test mode
@@ -0,0 +1,386 @@
+"""A local stand-in for the CIP-API, PanelApp and OpenCGA for load testing and benchmarks.
+
+The server answers the requests made by jellypy.pyCIPAPI and jellypy-tierup with data from
+jellypy.pyCIPAPI.synthetic:
+    - POST /oauth2/token: Active Directory token endpoint
+    - GET /api/2/interpretation-request: Paginated interpretation request listing
+    - GET /api/2/interpretation-request/<ir_id>/<ir_version>/: Interpretation request json
+    - GET /api/2/interpreted-genome/<ir_id>/<ir_version>/<service>/last/: Interpreted genome json
+    - GET /api/2/interpretation-request/date-summary/<date1>/<date2>/: Cases sent to GMCs
+    - POST /api/2/clinical-report/<partner>/<program>/<case_id>/: Submit a clinical report
+    - PUT /api/2/exit-questionnaire/<ir_id>/<ir_version>/<clinical_report_version>/: Submit an exit questionnaire
+    - GET /api/v1/panels/: Paginated PanelApp panel listing
+    - GET /api/v1/panels/<panel id or name>/: PanelApp panel json
+    - POST /opencga/users/<user>/login: OpenCGA login
+    - GET /opencga/files/search: OpenCGA file search by comma separated names
+    - GET /opencga/files/<file_id>/download: Random file content, with HTTP Range request support
+
+Response latency, error rate and page size are configurable. Point jellypy at the server with the
+environment variables printed on startup:
+
+    $ python -m jellypy.pyCIPAPI.mock_server --port 8000 --latency 0.05 --error-rate 0.01
+    export JELLYPY_CIPAPI_URL=http://127.0.0.1:8000/api/2/
+    ...
+
+Or from Python:
+>>> with MockServer(cases=100, latency=0.01) as server:
+>>> ...     server.environ()  # URLs for jellypy config environment variables
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import zlib
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import jwt
+
+from .synthetic import SyntheticCaseGenerator
+
+
+class MockServer():
+    """A threaded HTTP server with synthetic CIP-API, PanelApp and OpenCGA endpoints.
+
+    Args:
+        host(str): Host address to bind
+        port(int): Port to bind. 0 picks a free port.
+        cases(int): Number of interpretation requests served. Ids start at 1 with version 1.
+        panels(int): Number of PanelApp panels served. Ids start at 1.
+        latency(float): Seconds added to every response
+        jitter(float): Maximum random seconds added to latency
+        error_rate(float): Fraction of requests answered with `error_status`
+        error_status(int): Status code for simulated errors, e.g. 429 or 503
+        retry_after(int): Retry-After header value for simulated errors. None omits the header.
+        page_size(int): Page size for paginated listings. If None, the client's page_size is used.
+        seed(int): Random seed for synthetic data and errors
+        generator(SyntheticCaseGenerator): Generator for case and panel data. Defaults to a generator
+            with `seed` and `panels` total panels.
+        file_size(int): Size in bytes of OpenCGA file downloads
+        range_requests(bool): Answer OpenCGA download Range requests with partial content
+        opencga_files(list): OpenCGA file names found by file searches. If None, every name is found.
+    Attributes:
+        requests(Counter): Number of requests received for each endpoint
+        clinical_reports(dict): Clinical reports submitted for each (ir_id, ir_version), included in
+            interpretation request json
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, cases=100, panels=20, latency=0, jitter=0, error_rate=0,
+                 error_status=503, retry_after=0, page_size=None, seed=0, generator=None, file_size=2**20,
+                 range_requests=True, opencga_files=None):
+        self.cases, self.panels = cases, panels
+        self.latency, self.jitter = latency, jitter
+        self.error_rate, self.error_status, self.retry_after = error_rate, error_status, retry_after
+        self.page_size, self.seed = page_size, seed
+        self.generator = generator or SyntheticCaseGenerator(seed=seed, total_panels=panels)
+        self.file_size, self.range_requests = file_size, range_requests
+        self.opencga_files = opencga_files
+        self._files = {}
+        self.clinical_reports = {}
+        self.requests = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = _ThreadingHTTPServer((host, port), _handler(self))
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def environ(self):
+        """Return environment variables pointing jellypy.pyCIPAPI.config at this server."""
+        return {
+            'JELLYPY_CIPAPI_URL': f'{self.url}/api/2/',
+            'JELLYPY_CIPAPI_BETA_URL': f'{self.url}/api/2/',
+            'JELLYPY_CIPAPI_AUTH_URL': f'{self.url}/oauth2/token',
+            'JELLYPY_CIPAPI_BETA_AUTH_URL': f'{self.url}/oauth2/token',
+            'JELLYPY_PANELAPP_URL': f'{self.url}/api/v1/panels',
+            'JELLYPY_OPENCGA_URL': f'{self.url}/opencga',
+        }
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _delay(self):
+        with self._lock:
+            jitter = self._random.uniform(0, self.jitter) if self.jitter else 0
+        if self.latency or jitter:
+            time.sleep(self.latency + jitter)
+
+    def _case_exists(self, ir_id, ir_version):
+        return 1 <= int(ir_id) <= self.cases and int(ir_version) == 1
+
+    def _case(self, ir_id, ir_version):
+        if self._case_exists(ir_id, ir_version):
+            ir_id, ir_version = int(ir_id), int(ir_version)
+            irjson = self.generator.interpretation_request(ir_id, ir_version)
+            with self._lock:
+                irjson['clinical_report'] = [dict(report) for report in self.clinical_reports.get((ir_id, ir_version), [])]
+            return self._listing_record(ir_id, ir_version), irjson
+        return None
+
+    def _listing_record(self, ir_id, ir_version):
+        record = self.generator.listing_record(ir_id, ir_version)
+        with self._lock:
+            record['clinical_reports'] = [
+                {key: report.get(key) for key in ('clinical_report_version', 'exit_questionnaire')}
+                for report in self.clinical_reports.get((int(ir_id), int(ir_version)), [])
+            ]
+        return record
+
+    def _panel(self, panel):
+        panel_id = self.generator.panel_id(panel)
+        if panel_id is None or not 1 <= panel_id <= self.panels:
+            return None
+        return self.generator.panel(panel_id)
+
+    def file_content(self, file_id):
+        """Return the content of an OpenCGA file. Content is random bytes seeded by the file id."""
+        with self._lock:
+            if file_id not in self._files:
+                # getrandbits rather than randbytes, which needs Python 3.9
+                rng = random.Random(f'{self.seed}-file-{file_id}')
+                self._files[file_id] = (
+                    rng.getrandbits(8 * self.file_size).to_bytes(self.file_size, 'little') if self.file_size else b''
+                )
+            return self._files[file_id]
+
+    def file_record(self, name, file_format='VCF'):
+        """Return the OpenCGA file search result for a file name, or None if it is not served."""
+        if self.opencga_files is not None and name not in self.opencga_files:
+            return None
+        file_id = zlib.crc32(name.encode()) & 0x7fffffff
+        return {
+            'id': file_id, 'name': name, 'format': file_format, 'size': self.file_size,
+            'checksum': hashlib.md5(self.file_content(file_id)).hexdigest(),
+        }
+
+    def _download(self, file_id, headers):
+        content = self.file_content(file_id)
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', (headers or {}).get('Range', ''))
+        if not (self.range_requests and match):
+            return 200, content, {'Accept-Ranges': 'bytes' if self.range_requests else 'none'}
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else len(content) - 1, len(content) - 1)
+        if start >= len(content):
+            return 416, {'detail': 'Range not satisfiable.'}, {'Content-Range': f'bytes */{len(content)}'}
+        return 206, content[start:end + 1], {'Content-Range': f'bytes {start}-{end}/{len(content)}'}
+
+    def _page(self, base_url, query, items):
+        page = int(query.get('page', ['1'])[0])
+        page_size = self.page_size or int(query.get('page_size', ['100'])[0])
+        start = (page - 1) * page_size
+        next_url = None
+        if start + page_size < len(items):
+            next_query = {key: values[0] for key, values in query.items()}
+            next_query.update(page=page + 1)
+            next_url = f'{base_url}?{urlencode(next_query)}'
+        return {'count': len(items), 'next': next_url, 'previous': None,
+                'results': items[start:start + page_size]}
+
+    def _submit(self, method, path, body):
+        """Store a submitted clinical report or exit questionnaire. Returns (status, json body) or None."""
+        match = re.fullmatch(r'/api/2/clinical-report/[\w-]+/\w+/\w+-(\d+)-(\d+)/?', path)
+        if method == 'POST' and match and self._case_exists(*match.groups()):
+            with self._lock:
+                reports = self.clinical_reports.setdefault(tuple(map(int, match.groups())), [])
+                reports.append({
+                    'clinical_report_version': len(reports) + 1, 'clinical_report_data': body,
+                    'exit_questionnaire': None
+                })
+                return 201, reports[-1]
+        match = re.fullmatch(r'/api/2/exit-questionnaire/(\d+)/(\d+)/(\d+)/?', path)
+        if method == 'PUT' and match:
+            ir_id, ir_version, report_version = map(int, match.groups())
+            with self._lock:
+                reports = self.clinical_reports.get((ir_id, ir_version), [])
+                if not 1 <= report_version <= len(reports):
+                    return 404, {'detail': 'Not found.'}
+                reports[report_version - 1]['exit_questionnaire'] = {'exit_questionnaire_data': body}
+                return 200, reports[report_version - 1]
+        return None
+
+    def route(self, method, path, query, headers=None, body=None):
+        """Return (status, json body) or (status, body, response headers) for a request."""
+        if method == 'POST' and path == '/oauth2/token':
+            now = int(time.time())
+            # A JWT, so the token can also be passed to functions with a `token` argument
+            token = jwt.encode({'orig_iat': now, 'exp': now + 3600}, 'mock-secret', algorithm='HS256')
+            token = token.decode() if isinstance(token, bytes) else token
+            return 200, {'access_token': token, 'not_before': now, 'expires_on': now + 3600}
+        if method == 'POST' and re.fullmatch(r'/opencga/users/[^/]+/login', path):
+            with self._lock:
+                logins = self.requests[f'{method} /opencga/users/<user>/login']
+            return 200, {'response': [{'result': [{'sessionId': f'mock-sid-{logins}'}]}]}
+        if method in ('POST', 'PUT'):
+            return self._submit(method, path, body) or (405, {'detail': 'Method not allowed.'})
+        if method != 'GET':
+            return 405, {'detail': 'Method not allowed.'}
+
+        if path == '/api/2/interpretation-request':
+            if 'interpretation_request_id' in query:
+                ir_ids = [int(query['interpretation_request_id'][0])]
+            else:
+                ir_ids = range(1, self.cases + 1)
+            records = [
+                self._listing_record(ir_id, 1) for ir_id in ir_ids if self._case_exists(ir_id, 1)
+            ]
+            return 200, self._page(self.url + path, query, records)
+
+        match = re.fullmatch(r'/api/2/interpretation-request/(\d+)/(\d+)/?', path)
+        if match:
+            case = self._case(*match.groups())
+            return (200, case[1]) if case else (404, {'detail': 'Not found.'})
+
+        match = re.fullmatch(r'/api/2/interpreted-genome/(\d+)/(\d+)/([\w-]+)/last/?', path)
+        if match:
+            case = self._case(*match.groups()[:2])
+            genomes = [
+                genome for genome in (case[1]['interpreted_genome'] if case else [])
+                if genome['interpreted_genome_data'].get('interpretationService') == match.group(3)
+            ]
+            return (200, genomes[-1]) if genomes else (404, {'detail': 'Not found.'})
+
+        match = re.fullmatch(r'/api/2/interpretation-request/date-summary/([\d-]+)/([\d-]+)/?', path)
+        if match:
+            return 200, {'cases': {'illumina-sent_to_gmcs': [f'{ir_id}-1' for ir_id in range(1, self.cases + 1)]}}
+
+        if path.rstrip('/') == '/api/v1/panels':
+            listing = [self.generator.panel_summary(panel_id) for panel_id in range(1, self.panels + 1)]
+            return 200, self._page(self.url + path, query, listing)
+
+        match = re.fullmatch(r'/api/v1/panels/([^/]+)/?', path)
+        if match:
+            panel = self._panel(match.group(1))
+            if panel and query.get('version', [None])[0] not in (None, 'None', panel['version']):
+                panel = None
+            return (200, panel) if panel else (404, {'detail': 'Not found.'})
+
+        if path == '/opencga/files/search':
+            names = query.get('name', [''])[0].split(',')
+            file_format = query.get('format', ['VCF'])[0]
+            results = [record for record in (self.file_record(name, file_format) for name in names) if record]
+            return 200, {'response': [{'numResults': len(results), 'result': results}]}
+
+        match = re.fullmatch(r'/opencga/files/(\d+)/download', path)
+        if match:
+            return self._download(int(match.group(1)), headers)
+
+        return 404, {'detail': 'Not found.'}
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in a thread, as http.server.ThreadingHTTPServer does from Python 3.7"""
+
+
+def _handler(server):
+    """Return a request handler class bound to a MockServer."""
+
+    class MockRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _respond(self, method):
+            parsed = urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            request_body = self.rfile.read(length) if length else b''
+            # Count requests by endpoint, replacing ids after the /api/<version>/ prefix
+            parts = parsed.path.split('/')
+            endpoint = '/'.join(parts[:3] + ['<id>' if part.isdigit() else part for part in parts[3:]])
+            if parts[1:2] == ['opencga'] and parts[-1] == 'login':
+                endpoint = '/opencga/users/<user>/login'
+            with server._lock:
+                server.requests[f'{method} {endpoint}'] += 1
+            server._delay()
+            if server._fail():
+                status, body, headers = server.error_status, {'detail': 'Simulated error.'}, {}
+                if server.retry_after is not None:
+                    headers['Retry-After'] = str(server.retry_after)
+            else:
+                try:
+                    request_json = json.loads(request_body) if request_body else None
+                except ValueError:
+                    request_json = None
+                response = server.route(method, parsed.path, parse_qs(parsed.query), self.headers, request_json)
+                status, body, headers = response if len(response) == 3 else response + ({},)
+            binary = isinstance(body, bytes)
+            data = body if binary else json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/octet-stream' if binary else 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._respond('GET')
+
+        def do_POST(self):
+            self._respond('POST')
+
+        def do_PUT(self):
+            self._respond('PUT')
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockRequestHandler
+
+
+def parser_args():
+    """Parse arguments from the command line"""
+    parser = argparse.ArgumentParser(description='Serve synthetic CIP-API, PanelApp and OpenCGA data for load testing')
+    parser.add_argument('--host', default='127.0.0.1', help='Host address to bind')
+    parser.add_argument('--port', type=int, default=8000, help='Port to bind')
+    parser.add_argument('--cases', type=int, default=1000, help='Number of interpretation requests')
+    parser.add_argument('--panels', type=int, default=100, help='Number of PanelApp panels')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0, help='Maximum random seconds added to latency')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests that return an error')
+    parser.add_argument('--error-status', type=int, default=503, help='Status code for simulated errors')
+    parser.add_argument('--page-size', type=int, help='Page size for listings. Defaults to the client page_size')
+    parser.add_argument('--variants', type=int, default=50, help='Variants in each interpreted genome')
+    parser.add_argument('--file-size', type=int, default=2**20, help='Size in bytes of OpenCGA file downloads')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parser_args()
+    mock_server = MockServer(
+        host=args.host, port=args.port, cases=args.cases, panels=args.panels, latency=args.latency,
+        jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status,
+        page_size=args.page_size, seed=args.seed, file_size=args.file_size,
+        generator=SyntheticCaseGenerator(seed=args.seed, variants=args.variants, total_panels=args.panels)
+    )
+    for variable, value in mock_server.environ().items():
+        print(f'export {variable}={value}')
+    mock_server.serve_forever()
@@ -1,9 +1,32 @@
 """Functions for interacting with GEL instance of openCGA."""
 from __future__ import print_function
 
+import argparse
+import csv
+import hashlib
+import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from .auth import AuthenticatedOpenCGASession
+import requests
+
+from .auth import OpenCGASessionProvider
+from .transport import TokenBucket
+
+# Bytes read from the network per file write. Large chunks keep per-chunk
+# overhead low for multi-GB BAM and VCF downloads.
+DOWNLOAD_CHUNK_SIZE = 8 * 2**20
+# Files are split into parallel Range requests of at least this many bytes
+MIN_SEGMENT_SIZE = 64 * 2**20
+
+# Session shared by functions called without a session, so they log in once
+session_provider = OpenCGASessionProvider()
+
+
+def _session(session=None):
+    """Return the given session, or the shared session, logged in again if its session id is about to expire."""
+    return session.check_auth() if session else session_provider.get()
 
 
 def get_study_id(study_type, assembly=None, sample_type=None):
@@ -45,7 +68,7 @@ def get_study_id(study_type, assembly=None, sample_type=None):
     return study_id
 
 
-def find_file_id(study_id, file_format, file_name):
+def find_file_id(study_id, file_format, file_name, session=None):
     """Find the file ID for the given filename, format, and study ID.
 
     Use the openCGA file search endpoint to get the file_id for the given
@@ -55,59 +78,434 @@ def find_file_id(study_id, file_format, file_name):
         study_id (int): ID for appropriate study within the CIPAPI.
         file_format (str): Format of file to search for (eg VCF).
         file_name (str): Name of file to search for.
+        session (AuthenticatedOpenCGASession): Session to use. Defaults to
+            a session shared between calls.
 
     Returns:
         file_id (int): ID for given file in openCGA. Will be None if failed
             search or no search results are found.
     """
-    s = AuthenticatedOpenCGASession()
+    s = _session(session)
     # Construct search url
-    search_url = ("{host}/files/search?format=VCF&sid={sid}&study={study_id}"
+    search_url = ("{host}/files/search?format={file_format}&sid={sid}&study={study_id}"
                   "&name={file_name}&exclude=meta&limit=1&sort=creationDate"
-                  .format(host=s.host_url, sid=s.sid, study_id=study_id,
-                          file_name=file_name))
+                  .format(host=s.host_url, file_format=file_format, sid=s.sid,
+                          study_id=study_id, file_name=file_name))
     r = s.get(search_url)
     file_id = None
     if r.status_code == 200:
         try:
             file_id = r.json()['response'][0]['result'][0]['id']
         except (KeyError, IndexError):
-            print('Unable to find file {file_idname}'
-                  .format(filename=file_name))
+            print('Unable to find file {file_name}'
+                  .format(file_name=file_name))
     else:
-        print('Search for file {file_name} failed'.format(filename=file_name))
+        print('Search for file {file_name} failed'.format(file_name=file_name))
     return file_id
 
 
-def download_file(file_id, study_id, file_name, download_folder=None):
+def find_files(study_id, file_format, file_names, session=None,
+               batch_size=100):
+    """Find the openCGA file records for many file names in one study.
+
+    File names are searched in batches of comma separated names, so a
+    cohort's files are resolved in a few requests over one session.
+
+    Args:
+        study_id (int): ID for appropriate study within the CIPAPI.
+        file_format (str): Format of files to search for (eg VCF).
+        file_names (list): Names of files to search for.
+        session (AuthenticatedOpenCGASession): Session to use. Defaults to
+            a session shared between calls.
+        batch_size (int): Maximum file names in each search request.
+
+    Returns:
+        files (dict): File names mapped to their openCGA file record, with id,
+            size and checksum fields. Names with no search results map to None.
+    """
+    s = _session(session)
+    file_names = list(file_names)
+    files = dict.fromkeys(file_names)
+    for i in range(0, len(file_names), batch_size):
+        batch = file_names[i:i + batch_size]
+        s.check_auth()
+        r = s.get('{host}/files/search'.format(host=s.host_url), params={
+            'format': file_format, 'sid': s.sid, 'study': study_id,
+            'name': ','.join(batch), 'exclude': 'meta', 'sort': 'creationDate',
+            'limit': 10 * len(batch)})
+        if r.status_code != 200:
+            print('Search for {n} files in study {study_id} failed'
+                  .format(n=len(batch), study_id=study_id))
+            continue
+        # Keep the first result for each name, as find_file_id does
+        for record in r.json()['response'][0]['result']:
+            if files.get(record['name'], True) is None:
+                files[record['name']] = record
+    return files
+
+
+def download_file(file_id, study_id, file_name, download_folder=None, session=None, segments=4,
+                  expected_size=None, expected_md5=None, chunk_size=DOWNLOAD_CHUNK_SIZE, rate_limit=None):
     """Download a file from the GEL openCGA instance.
 
+    If the server supports HTTP Range requests, the file is downloaded in up to
+    `segments` parallel parts. Progress is saved alongside a partial
+    <file_name>.part file, so an interrupted download resumes where it
+    stopped when called again. Servers without Range support send the whole
+    file, which is downloaded again from the start after an interruption. The
+    partial file is moved to file_name once its size, and md5 checksum if
+    given, are verified.
+
     Args:
         file_id (int): ID for given file in openCGA.
         study_id (int): ID for appropriate study within the CIPAPI.
         file_name (str): Name of file to create with download.
         download_folder (str): Path to download location. Defaults to current
             working directory.
+        session (AuthenticatedOpenCGASession): Session to use. Defaults to
+            a session shared between calls. The session logs in again if its
+            session id is about to expire during the download.
+        segments (int): Maximum parallel Range requests.
+        expected_size (int): Expected file size in bytes. Defaults to the size
+            reported by the server.
+        expected_md5 (str): Expected md5 checksum of the file.
+        chunk_size (int): Bytes read from the network per write.
+        rate_limit (transport.TokenBucket): Bucket of bytes per second shared
+            between downloads to cap total bandwidth.
 
+    Returns:
+        download_path (str): Path to the downloaded file. Will be None if the
+            download failed, including network and file errors, or could not
+            be verified. A partial download is kept to resume from.
     """
-    s = AuthenticatedOpenCGASession()
-    # Construct download url
-    download_url = ("{host}/files/{file_id}/download?sid={sid}&"
-                    "study={study_id}"
-                    .format(host=s.host_url, file_id=file_id, sid=s.sid,
-                            study_id=study_id))
-    r = s.get(download_url, stream=True)
-    if r.status_code == 200:
-        if not download_folder:
-            download_folder = os.getcwd()
-        download_path = os.path.join(download_folder, file_name)
-        print('Downloading to {download_path}'
-              .format(download_path=download_path))
-        with open(download_path, 'wb') as fout:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    fout.write(chunk)
-                    fout.flush()
-    else:
-        print('Unable to download file {file_id} for study {study_id}'
-              .format(file_id=file_id, study_id=study_id))
+    s = _session(session)
+    if not download_folder:
+        download_folder = os.getcwd()
+    download_path = os.path.join(download_folder, file_name)
+    part_path = download_path + '.part'
+
+    def download_url():
+        # Construct download url with the current session id
+        s.check_auth()
+        return ("{host}/files/{file_id}/download?sid={sid}&"
+                "study={study_id}"
+                .format(host=s.host_url, file_id=file_id, sid=s.sid,
+                        study_id=study_id))
+
+    try:
+        # Request the first byte to find the file size and whether Range
+        # requests are supported. Servers without Range support send the whole
+        # file.
+        r = s.get(download_url(), headers={'Range': 'bytes=0-0'}, stream=True)
+        content_range = r.headers.get('Content-Range', '')
+        if r.status_code == 206 and not content_range.endswith('/*'):
+            r.close()
+            size = int(content_range.rsplit('/', 1)[1])
+            print('Downloading to {download_path}'
+                  .format(download_path=download_path))
+            _download_segments(s, download_url, part_path, size, segments,
+                               chunk_size, rate_limit)
+        elif r.status_code == 200:
+            size = (int(r.headers['Content-Length'])
+                    if 'Content-Length' in r.headers else None)
+            print('Downloading to {download_path}'
+                  .format(download_path=download_path))
+            _download_stream(r, part_path, chunk_size, rate_limit)
+        else:
+            print('Unable to download file {file_id} for study {study_id}'
+                  .format(file_id=file_id, study_id=study_id))
+            return None
+    except (IOError, requests.RequestException) as error:
+        print('Download of file {file_id} for study {study_id} failed: {error}'
+              .format(file_id=file_id, study_id=study_id, error=error))
+        return None
+    if not verify_file(part_path, expected_size or size, expected_md5):
+        print('Download of file {file_id} failed verification, removing {path}'
+              .format(file_id=file_id, path=part_path))
+        os.remove(part_path)
+        return None
+    os.replace(part_path, download_path)
+    return download_path
+
+
+def verify_file(path, expected_size=None, expected_md5=None):
+    """Check a file's size and md5 checksum.
+
+    Args:
+        path (str): Path to file.
+        expected_size (int): Expected size in bytes. Not checked if None.
+        expected_md5 (str): Expected md5 hex digest. Not checked if None.
+
+    Returns:
+        True if the file exists and matches the expected size and checksum.
+    """
+    if not os.path.isfile(path):
+        return False
+    if expected_size is not None and os.path.getsize(path) != int(expected_size):
+        return False
+    if expected_md5:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as fin:
+            for block in iter(lambda: fin.read(DOWNLOAD_CHUNK_SIZE), b''):
+                md5.update(block)
+        return md5.hexdigest() == expected_md5.lower()
+    return True
+
+
+def _download_stream(response, part_path, chunk_size, rate_limit=None):
+    """Write a whole-file response to part_path."""
+    with open(part_path, 'wb') as fout:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if rate_limit:
+                rate_limit.acquire(len(chunk))
+            fout.write(chunk)
+
+
+def _download_segments(session, download_url, part_path, size, segments,
+                       chunk_size, rate_limit=None, retries=3):
+    """Download a file to part_path in parallel byte range segments.
+
+    download_url is a function returning the url with a current session id.
+    Segment progress is saved to <part_path>.json after every chunk, so a
+    later call resumes each segment from its last written byte.
+    """
+    state_path = part_path + '.json'
+    state = _load_segment_state(state_path, part_path, size)
+    if state is None:
+        n = max(1, min(segments, -(-size // MIN_SEGMENT_SIZE)))
+        bounds = [size * i // n for i in range(n + 1)]
+        # Segments are [start, end, bytes written] lists
+        state = [[bounds[i], bounds[i + 1], 0] for i in range(n)]
+        with open(part_path, 'wb') as fout:
+            fout.truncate(size)
+    lock = threading.Lock()
+
+    def save_state():
+        tmp_path = state_path + '.tmp'
+        with open(tmp_path, 'w') as fout:
+            json.dump({'size': size, 'segments': state}, fout)
+        os.replace(tmp_path, state_path)
+
+    def fetch(segment):
+        for attempt in range(retries):
+            start, end, written = segment
+            if start + written >= end:
+                return
+            try:
+                r = session.get(download_url(), stream=True, headers={
+                    'Range': 'bytes={}-{}'.format(start + written, end - 1)})
+                if r.status_code != 206:
+                    raise IOError('Range request failed with status {}'
+                                  .format(r.status_code))
+                # Unbuffered, so saved progress never counts bytes still in
+                # a Python buffer
+                with open(part_path, 'r+b', buffering=0) as fout:
+                    fout.seek(start + written)
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        if rate_limit:
+                            rate_limit.acquire(len(chunk))
+                        fout.write(chunk)
+                        with lock:
+                            segment[2] += len(chunk)
+                            save_state()
+            except (IOError, requests.RequestException):
+                if attempt == retries - 1:
+                    raise
+        if segment[0] + segment[2] < segment[1]:
+            raise IOError('Segment {}-{} incomplete'.format(segment[0],
+                                                            segment[1]))
+
+    with ThreadPoolExecutor(len(state)) as executor:
+        list(executor.map(fetch, state))
+    os.remove(state_path)
+
+
+def _load_segment_state(state_path, part_path, size):
+    """Return saved segments for a partial download, or None if there is no usable state."""
+    try:
+        with open(state_path) as fin:
+            saved = json.load(fin)
+    except (IOError, ValueError):
+        return None
+    if (saved.get('size') != size or not os.path.isfile(part_path)
+            or os.path.getsize(part_path) != size):
+        return None
+    print('Resuming download to {}'.format(part_path))
+    return saved['segments']
+
+
+# Columns of download manifests. Completion manifests add the remaining columns.
+MANIFEST_FIELDS = ['study_id', 'format', 'file_name']
+COMPLETION_FIELDS = MANIFEST_FIELDS + ['file_id', 'size', 'checksum', 'path', 'status']
+
+
+class DownloadManager():
+    """Download the openCGA files listed in a manifest over one session.
+
+    File IDs are resolved with batched searches for each study and format. Files
+    are then downloaded concurrently, with a cap on the number of files
+    downloading at once and optionally on total bandwidth. Files already in the
+    download folder that match their openCGA size and checksum are skipped, so
+    an interrupted run can be repeated.
+
+    Args:
+        download_folder (str): Path to download location. Created if it does
+            not exist.
+        session (AuthenticatedOpenCGASession): Session to use. Defaults to
+            a session shared between calls.
+        max_downloads (int): Maximum files downloading at once.
+        segments (int): Maximum parallel Range requests for each file.
+        max_bandwidth (float): Maximum total download rate in bytes per
+            second. Unlimited if None.
+        batch_size (int): Maximum file names in each search request.
+
+    >>> manager = DownloadManager('vcfs/', max_downloads=4, max_bandwidth=200 * 2**20)
+    >>> manager.run(read_manifest('manifest.tsv'), 'vcfs/completed.tsv')
+    """
+
+    def __init__(self, download_folder, session=None, max_downloads=4,
+                 segments=4, max_bandwidth=None, batch_size=100):
+        self.download_folder = download_folder
+        self.session = _session(session)
+        self.max_downloads, self.segments = max_downloads, segments
+        self.batch_size = batch_size
+        self.rate_limit = TokenBucket(max_bandwidth) if max_bandwidth else None
+
+    def resolve(self, entries):
+        """Find openCGA file records for manifest entries.
+
+        Args:
+            entries (list): Manifest entry dictionaries with study_id, format
+                and file_name keys.
+
+        Returns:
+            records (list): openCGA file records for each entry, or None for
+                files that were not found.
+        """
+        names = {}
+        for entry in entries:
+            names.setdefault((entry['study_id'], entry['format']),
+                             []).append(entry['file_name'])
+        found = {}
+        for (study_id, file_format), file_names in names.items():
+            files = find_files(study_id, file_format, file_names,
+                               session=self.session,
+                               batch_size=self.batch_size)
+            for file_name, record in files.items():
+                found[(study_id, file_format, file_name)] = record
+        return [found[(entry['study_id'], entry['format'], entry['file_name'])]
+                for entry in entries]
+
+    def download(self, entry, record):
+        """Download the file for a manifest entry, unless already downloaded and verified.
+
+        Returns:
+            result (dict): The entry with file_id, size, checksum, path and
+                status columns. status is one of downloaded, skipped,
+                not_found or failed.
+        """
+        result = dict(entry, file_id='', size='', checksum='', path='')
+        if record is None:
+            return dict(result, status='not_found')
+        checksum = _md5_checksum(record)
+        path = os.path.join(self.download_folder, entry['file_name'])
+        result.update(file_id=record['id'], size=record.get('size', ''),
+                      checksum=checksum or '', path=path)
+        if verify_file(path, record.get('size'), checksum):
+            return dict(result, status='skipped')
+        downloaded = download_file(
+            record['id'], entry['study_id'], entry['file_name'],
+            self.download_folder, session=self.session,
+            segments=self.segments, expected_size=record.get('size'),
+            expected_md5=checksum, rate_limit=self.rate_limit)
+        return dict(result, status='downloaded' if downloaded else 'failed')
+
+    def run(self, entries, completion_manifest=None):
+        """Resolve and download the files for manifest entries.
+
+        Args:
+            entries (list): Manifest entry dictionaries with study_id, format
+                and file_name keys.
+            completion_manifest (str): If given, write a TSV of results for
+                every entry to this path.
+
+        Returns:
+            results (list): Result dictionaries for each entry, in manifest
+                order (see download).
+        """
+        entries = list(entries)
+        os.makedirs(self.download_folder, exist_ok=True)
+        records = self.resolve(entries)
+        with ThreadPoolExecutor(self.max_downloads) as executor:
+            results = list(executor.map(self.download, entries, records))
+        if completion_manifest:
+            write_manifest(completion_manifest, results, COMPLETION_FIELDS)
+        counts = {}
+        for result in results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        print('Files: {}'.format(', '.join(
+            '{} {}'.format(n, status) for status, n in sorted(counts.items()))))
+        return results
+
+
+def _md5_checksum(record):
+    """Return an openCGA file record's checksum if it is an md5 hex digest, otherwise None."""
+    checksum = (record.get('checksum') or '').lower()
+    if len(checksum) == 32 and all(c in '0123456789abcdef' for c in checksum):
+        return checksum
+    return None
+
+
+def read_manifest(path):
+    """Read a download manifest.
+
+    Manifests are tab separated files with study_id, format and file_name
+    columns and a header row.
+
+    Returns:
+        entries (list): Manifest entry dictionaries.
+    """
+    with open(path) as fin:
+        entries = list(csv.DictReader(fin, delimiter='\t'))
+    missing = [field for field in MANIFEST_FIELDS
+               if entries and field not in entries[0]]
+    if missing:
+        raise ValueError('Manifest {path} is missing columns: {missing}'
+                         .format(path=path, missing=', '.join(missing)))
+    return entries
+
+
+def write_manifest(path, rows, fields):
+    """Write dictionaries to a tab separated manifest file with a header row."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', newline='') as fout:
+        writer = csv.DictWriter(fout, fieldnames=fields, delimiter='\t',
+                                extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, path)
+
+
+def parser_args():
+    """Parse arguments from the command line"""
+    parser = argparse.ArgumentParser(
+        description='Download the openCGA files listed in a manifest of study_id, format and file_name columns')
+    parser.add_argument('manifest', help='Tab separated manifest file with a header row')
+    parser.add_argument('-o', '--outdir', default='.', help='Download folder')
+    parser.add_argument('-c', '--completion-manifest',
+                        help='Results manifest path. Defaults to <outdir>/completed_manifest.tsv')
+    parser.add_argument('-n', '--max-downloads', type=int, default=4, help='Maximum files downloading at once')
+    parser.add_argument('-s', '--segments', type=int, default=4, help='Maximum parallel requests for each file')
+    parser.add_argument('-b', '--max-bandwidth', type=float,
+                        help='Maximum total download rate in megabytes per second')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parser_args()
+    manager = DownloadManager(
+        args.outdir, max_downloads=args.max_downloads, segments=args.segments,
+        max_bandwidth=args.max_bandwidth * 2**20 if args.max_bandwidth else None
+    )
+    manager.run(read_manifest(args.manifest),
+                args.completion_manifest or os.path.join(args.outdir, 'completed_manifest.tsv'))
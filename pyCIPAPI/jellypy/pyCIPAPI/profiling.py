@@ -0,0 +1,106 @@
+"""Optional cProfile and tracemalloc profiling for jellypy command line tools.
+
+Profiling is enabled by passing an output directory, or by setting the JELLYPY_PROFILE environment
+variable to one. When disabled, `profile()` returns a null context manager, so wrapping code in it
+costs nothing.
+
+>>> with profile('tierup_1234-1', output_dir='profiles/'):
+>>> ...     run_case()
+
+Each profiled block writes two files to the output directory:
+    - <name>.prof: cProfile stats. View with `snakeviz <name>.prof` or `python -m pstats <name>.prof`.
+    - <name>.memory.txt: Peak traced memory and the lines allocating the most memory at exit.
+"""
+import contextlib
+import cProfile
+import logging
+import os
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# Environment variable holding a profile output directory. Honoured by jellypy scripts and CLIs.
+PROFILE_ENV = 'JELLYPY_PROFILE'
+
+
+class Profiler():
+    """Context manager that records cProfile stats and tracemalloc memory use for a block of code.
+
+    Args:
+        name(str): Output file name prefix
+        output_dir(str): Directory for output files. Created if it does not exist.
+        top(int): Number of allocation sites listed in the memory report
+        trace_memory(bool): Trace memory allocations with tracemalloc. This slows down allocation
+            heavy code considerably, so can be turned off to profile CPU time only.
+    """
+
+    def __init__(self, name, output_dir, top=25, trace_memory=True):
+        self.name, self.output_dir = name, output_dir
+        self.top, self.trace_memory = top, trace_memory
+        self.profiler = cProfile.Profile()
+        self._started_tracemalloc = False
+
+    @property
+    def stats_path(self):
+        return os.path.join(self.output_dir, f'{self.name}.prof')
+
+    @property
+    def memory_path(self):
+        return os.path.join(self.output_dir, f'{self.name}.memory.txt')
+
+    def __enter__(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        # reset_peak needs Python 3.9. Without it, the peak includes memory traced before the profile started.
+        if self.trace_memory and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.disable()
+        self.profiler.dump_stats(self.stats_path)
+        logger.info(f'Profile written to {self.stats_path}')
+        if self.trace_memory:
+            self._write_memory_report()
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+
+    def _write_memory_report(self):
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+        ])
+        with open(self.memory_path, 'w') as f:
+            f.write(f'Peak traced memory: {peak / 2**20:.1f} MiB\n')
+            f.write(f'Traced memory at exit: {current / 2**20:.1f} MiB\n')
+            f.write(f'Top {self.top} allocation sites at exit:\n')
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                f.write(f'{stat}\n')
+        logger.info(f'Peak traced memory {peak / 2**20:.1f} MiB. Memory report written to {self.memory_path}')
+
+
+@contextlib.contextmanager
+def _disabled():
+    """Context manager that does nothing, as contextlib.nullcontext does from Python 3.7"""
+    yield
+
+
+def profile(name, output_dir=None, **kwargs):
+    """Return a context manager that profiles a block of code.
+
+    Args:
+        name(str): Output file name prefix, e.g. a script or case name
+        output_dir(str): Directory for profile output. Defaults to the JELLYPY_PROFILE environment
+            variable. If neither is set, profiling is disabled.
+        kwargs: Passed to Profiler
+    Returns:
+        A Profiler, or a context manager that does nothing if profiling is disabled
+    """
+    output_dir = output_dir or os.environ.get(PROFILE_ENV)
+    if not output_dir:
+        return _disabled()
+    return Profiler(name, output_dir, **kwargs)
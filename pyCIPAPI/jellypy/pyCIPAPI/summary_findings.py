@@ -3,14 +3,16 @@ Functions for creating a clinical report (aka summary of findings), submitting a
 This is designed to emulate the closing of a case via the interpretation portal.
 """
 import datetime
+import functools
+import json
 
 from protocols.reports_6_0_0 import (ClinicalReport, FamilyLevelQuestions,
-                                     InterpretedGenome,
                                      RareDiseaseExitQuestionnaire)
 
 from .auth import AuthenticatedCIPAPISession
 from .config import beta_testing_base_url, live_100k_data_base_url
-from .interpretation_requests import get_interpretation_request_list
+from .interpretation_requests import (get_interpretation_request_json, get_interpretation_request_list,
+                                     get_interpreted_genome_for_case)
 
 
 def create_cr(
@@ -78,13 +80,8 @@ def create_cr(
         softwareVersions=softwareVersions
         )
     # Check clinical report object is valid using inbuilt validate method. Report errors if not.
-    if not cr.validate(cr.toJsonDict()):
-        raise TypeError("Clinical report object not valid. See details:\n{message}".format(
-            message=cr.validate(cr.toJsonDict(), verbose=True).messages
-            )
-        )
-    else:
-        return cr
+    _validate(cr, "Clinical report")
+    return cr
 
 
 def create_flq(caseSolvedFamily, segregationQuestion, additionalComments):
@@ -105,13 +102,8 @@ def create_flq(caseSolvedFamily, segregationQuestion, additionalComments):
         additionalComments=additionalComments
     )
     # Check family level questions object is valid using inbuilt validate method. Report errors if not.
-    if not flqs.validate(flqs.toJsonDict()):
-        raise TypeError("Family level questions object not valid. See details:\n{message}".format(
-            message=flqs.validate(flqs.toJsonDict(), verbose=True).messages
-            )
-        )
-    else:
-        return flqs
+    _validate(flqs, "Family level questions")
+    return flqs
 
 
 def create_eq(eventDate, reporter, familyLevelQuestions, variantGroupLevelQuestions=[]):
@@ -139,20 +131,162 @@ def create_eq(eventDate, reporter, familyLevelQuestions, variantGroupLevelQuesti
         variantGroupLevelQuestions=variantGroupLevelQuestions
     )
     # Check exit questionnaire object is valid using inbuilt validate method. Report errors if not.
-    if not eq.validate(eq.toJsonDict()):
-        raise TypeError("Exit questionnaire object not valid. See details:\n{message}".format(message=eq.validate(eq.toJsonDict(), verbose=True).messages))
-    else:
-        return eq
+    _validate(eq, "Exit questionnaire")
+    return eq
+
+
+def _validate(obj, name):
+    """
+    Validate a GeL Report Models object, raising a TypeError with the validation messages if it is not valid.
+    The object is serialised once and that JSON is used for both the check and the verbose error report.
+    Returns the object's JSON dictionary.
+    """
+    json_dict = obj.toJsonDict()
+    if not obj.validate(json_dict):
+        raise TypeError("{name} object not valid. See details:\n{message}".format(
+            name=name,
+            message=obj.validate(json_dict, verbose=True).messages
+            )
+        )
+    return json_dict
+
+
+def _check_date(date, field):
+    """Check a date is a YYYY-MM-DD string, returning it in that format"""
+    if not isinstance(date, str):
+        raise TypeError("{field} must be a YYYY-MM-DD string, not {date!r}".format(field=field, date=date))
+    return _format_date(date)
+
+
+@functools.lru_cache(maxsize=1024)
+def _format_date(date):
+    # Cached, as the cases in a batch are normally closed with the same date
+    return datetime.datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d")
+
+
+def _check_string(value, field):
+    """Check a per-case field is a non-empty string"""
+    if not isinstance(value, str) or not value:
+        raise TypeError("{field} must be a non-empty string, not {value!r}".format(field=field, value=value))
+    return value
+
+
+def _check_string_map(value, field):
+    """Check a per-case field is a dictionary of strings, matching an avro map<string>"""
+    if not isinstance(value, dict) or not all(isinstance(k, str) and isinstance(v, str) for k, v in value.items()):
+        raise TypeError("{field} must be a dictionary of strings, not {value!r}".format(field=field, value=value))
+    return value
+
+
+class ClinicalReportTemplate():
+    """A validated clinical report (aka summary of findings) for building many reports with the same content.
+
+    The fields shared by every report, e.g. genomicInterpretation, are validated against GeL Report Models
+    once, when the template is created. build() then only checks the per-case fields and fills them into a
+    copy of the serialised template, which is much faster than create_cr() when closing many cases.
+
+    >>> template = ClinicalReportTemplate(genomicInterpretation="No tier 1 or 2 variants detected")
+    >>> cr = template.build('12345', 1, '2020-01-31', 'jbloggs', get_ref_db_versions(ir_json_v6),
+    ...                     gel_software_versions(ir_json_v6))
+    >>> post_cr(ir_json_v6, cr)
+
+    Args:
+        genomicInterpretation: string (required)
+        Other keyword arguments are passed to create_cr(), e.g. variants=[]
+    """
+
+    def __init__(self, genomicInterpretation, **fields):
+        # Validate the shared fields once, with placeholder values for the per-case fields
+        clinical_report = create_cr(
+            interpretationRequestId="0",
+            interpretationRequestVersion=1,
+            reportingDate="1970-01-01",
+            user="template",
+            genomicInterpretation=genomicInterpretation,
+            referenceDatabasesVersions={},
+            softwareVersions={},
+            **fields
+        )
+        self._template = json.dumps(clinical_report.toJsonDict())
+
+    def build(self, interpretationRequestId, interpretationRequestVersion, reportingDate, user,
+              referenceDatabasesVersions, softwareVersions):
+        """
+        Return a clinical report JSON dictionary for a case, ready to submit with post_cr()
+        Args:
+            interpretationRequestId: string (required)
+            interpretationRequestVersion: integer (required)
+            reportingDate: string (YYYY-MM-DD)
+            user: string (required)
+            referenceDatabasesVersions: dictionary (required) - Use get_ref_db_versions()
+            softwareVersions: dictionary (required) - Use gel_software_versions()
+        """
+        clinical_report = json.loads(self._template)
+        clinical_report.update(
+            interpretationRequestId=_check_string(interpretationRequestId, "interpretationRequestId"),
+            interpretationRequestVersion=int(interpretationRequestVersion),
+            reportingDate=_check_date(reportingDate, "reportingDate"),
+            user=_check_string(user, "user"),
+            referenceDatabasesVersions=_check_string_map(referenceDatabasesVersions, "referenceDatabasesVersions"),
+            softwareVersions=_check_string_map(softwareVersions, "softwareVersions")
+        )
+        return clinical_report
+
+
+class ExitQuestionnaireTemplate():
+    """A validated exit questionnaire for building many questionnaires with the same answers.
+
+    The family level questions and variant group level questions are validated against GeL Report Models
+    once, when the template is created. build() then only checks the event date and reporter.
+
+    >>> template = ExitQuestionnaireTemplate(create_flq("no", "no", "No tier 1 or 2 variants detected"))
+    >>> put_eq(template.build('2020-01-31', 'jbloggs'), '12345', '1')
+
+    Args:
+        familyLevelQuestions: populated FamilyLevelQuestions object (output from create_flq())
+        variantGroupLevelQuestions: VariantGroupLevelQuestions object (optional - see create_eq())
+    """
+
+    def __init__(self, familyLevelQuestions, variantGroupLevelQuestions=[]):
+        exit_questionnaire = create_eq(
+            eventDate="1970-01-01",
+            reporter="template",
+            familyLevelQuestions=familyLevelQuestions,
+            variantGroupLevelQuestions=variantGroupLevelQuestions
+        )
+        self._template = json.dumps(exit_questionnaire.toJsonDict())
+
+    def build(self, eventDate, reporter):
+        """
+        Return an exit questionnaire JSON dictionary, ready to submit with put_eq()
+        Args:
+            eventDate: string (YYYY-MM-DD)
+            reporter: string
+        """
+        exit_questionnaire = json.loads(self._template)
+        exit_questionnaire.update(
+            eventDate=_check_date(eventDate, "eventDate"),
+            reporter=_check_string(reporter, "reporter")
+        )
+        return exit_questionnaire
 
-def post_cr(ir_json_v6, clinical_report, testing_on=False, token=None):
+
+def _json_dict(report):
+    """Return the JSON dictionary for a GeL Report Models object, or a dictionary built from a template"""
+    return report if isinstance(report, dict) else report.toJsonDict()
+
+
+def post_cr(ir_json_v6, clinical_report, testing_on=False, token=None, session=None):
     """
     Submit clinical report (aka summary of findings) to CIP-API.
     This uses genomics_england_tiering as the analysis partner, emulating the closing of a case through
     the interpretation portal. It is currently hardcoded for raredisease.
     Args:
         ir_json_v6 = get using interpretation_requests.get_interpretation_request_json() with reports_v6=True
-        clinical_report = populated clinical report object output from create_cr()
+        clinical_report = populated clinical report object output from create_cr(), or JSON dictionary from
+        ClinicalReportTemplate.build()
         testing_on = setting to True will use beta cip-api rather than live
+        session = authenticated CIP-API session to reuse, e.g. when closing many cases. Created if not given
     """
     # Get the full interpretation request ID (including cip prefix and version e.g. SAP-12345-1)
     ir_id = ir_json_v6.get('case_id')
@@ -168,26 +302,29 @@ def post_cr(ir_json_v6, clinical_report, testing_on=False, token=None):
         cip_api_url = live_100k_data_base_url
     # Create urls for uploading summary of findings
     summary_of_findings_url = cip_api_url + cr_endpoint
-    # Open Authenticated CIP-API session:
-    gel_session = AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
+    # Use the supplied session or open Authenticated CIP-API session:
+    gel_session = session if session else AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
     # Upload Summary of findings:
-    response = gel_session.post(url=summary_of_findings_url, json=clinical_report.toJsonDict())
+    response = gel_session.post(url=summary_of_findings_url, json=_json_dict(clinical_report))
     # Raise error if unsuccessful status code returned
     response.raise_for_status()
 
     return response.json()
 
 
-def put_eq(exit_questionnaire, ir_id, ir_version, clinical_report_version=1, testing_on=False, token=None):
+def put_eq(exit_questionnaire, ir_id, ir_version, clinical_report_version=1, testing_on=False, token=None,
+           session=None):
     """
     Submit exit questionnaire to CIP-API.
     Args:
-        exit_questionnaire = populated exit_questionnaire object output from create_cr()
+        exit_questionnaire = populated exit_questionnaire object output from create_eq(), or JSON dictionary from
+        ExitQuestionnaireTemplate.build()
         ir_id = interpretation request ID (without cip prefix or version, i.e. would be '12345' for SAP-12345-1)
         ir_version = interpretation request version (the version following the ir-id, i.e. would be '1' for SAP-12345-1)
         clinical_report_version = If there are multiple summary of findings for a case (use num_existing_reports() to check)
         which one should the exit questionnaire be attached to? default = 1
         testing_on = setting to True will use beta cip-api rather than live
+        session = authenticated CIP-API session to reuse, e.g. when closing many cases. Created if not given
     """
     # Create endpoint from user supplied variables ir_id and ir_version (hardcoded clinical_report_version 1 is OK
     # because script checks no other clinical reports have been generated before calling this function:
@@ -201,10 +338,10 @@ def put_eq(exit_questionnaire, ir_id, ir_version, clinical_report_version=1, tes
         cip_api_url = live_100k_data_base_url
     # Create urls for uploading exit questionnaire
     exit_questionnaire_url = cip_api_url + eq_endpoint
-    # Open Authenticated CIP-API session:
-    gel_session = AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
+    # Use the supplied session or open Authenticated CIP-API session:
+    gel_session = session if session else AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
     # Upload Exit Questionnaire:
-    response = gel_session.put(url=exit_questionnaire_url, json=exit_questionnaire.toJsonDict())
+    response = gel_session.put(url=exit_questionnaire_url, json=_json_dict(exit_questionnaire))
     # Raise error if unsuccessful status code returned
     response.raise_for_status()
 
@@ -220,6 +357,14 @@ def num_existing_reports(ir_json_v6):
     return len(ir_json_v6.get("clinical_report"))
 
 
+def exit_questionnaire_submitted(ir_json_v6):
+    """
+    This returns True if an exit questionnaire has been submitted for any of the clinical reports for a case
+    This can be used to check that a case has not already been closed before submitting an exit questionnaire
+    """
+    return any(report.get("exit_questionnaire") for report in ir_json_v6.get("clinical_report") or [])
+
+
 def get_ref_db_versions(ir_json_v6):
     """
     This returns a dictionary that can be submitted for the referenceDatabasesVersions field of clinical report
@@ -234,14 +379,65 @@ def gel_software_versions(ir_json_v6):
     This returns a dictionary that can be submitted for the softwareVersions field of clinical report
     This function will pull out the softwareVersions from the genomics_england_tiering interpreted genome
     (equivalent to creating summary of findings in the interpretation portal)
+    Only the interpretationService and softwareVersions fields are read, so interpreted genomes are not
+    parsed into GeL Report Models objects
     """
     # Loop through interpreted genomes, and pull out softwareVersions from the genomics_england_tiering interpreted genome
     interpreted_genomes = ir_json_v6['interpreted_genome']
     for ig in interpreted_genomes:
-        ig_obj = InterpretedGenome.fromJsonDict(ig['interpreted_genome_data'])
-        cip = ig_obj.interpretationService.lower()
+        ig_data = ig['interpreted_genome_data']
+        cip = ig_data['interpretationService'].lower()
         if cip == 'genomics_england_tiering':
-            return ig_obj.softwareVersions
+            return ig_data['softwareVersions']
+
+
+def get_closure_metadata(ir_id, ir_version, software_versions=True, testing_on=False, token=None, session=None):
+    """
+    Get the parts of an interpretation request needed to close a case, without downloading the full IR json.
+    The case ID, assembly and clinical reports are read from the minimised interpretation request listing.
+    If the listing does not show whether each clinical report has an exit questionnaire, the clinical reports
+    are read from the full IR json instead, so closed cases are never reported as open.
+    If software_versions is True, the last genomics_england_tiering interpreted genome is also downloaded.
+    The result can be used in place of ir_json_v6 with num_existing_reports(), exit_questionnaire_submitted(),
+    get_ref_db_versions(), gel_software_versions() and post_cr().
+    Args:
+        ir_id = interpretation request ID (without cip prefix or version, i.e. would be '12345' for SAP-12345-1)
+        ir_version = interpretation request version (the version following the ir-id, i.e. would be '1' for SAP-12345-1)
+        software_versions = download the tiering interpreted genome for gel_software_versions(). Not needed
+        when only submitting an exit questionnaire
+        testing_on = setting to True will use beta cip-api rather than live
+        session = authenticated CIP-API session to reuse, e.g. when closing many cases. Created if not given
+    Returns:
+        A dictionary with case_id, assembly, clinical_report and interpreted_genome keys, or None if the
+        interpretation request is not found
+    """
+    gel_session = session if session else AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
+    # Listing records are returned for every version of an interpretation request, so find the requested one
+    case = "{ir_id}-{ir_version}".format(ir_id=ir_id, ir_version=ir_version)
+    records = [record for record in get_interpretation_request_list(interpretation_request_id=ir_id,
+                                                                    version=ir_version,
+                                                                    testing_on=testing_on,
+                                                                    session=gel_session)
+               if record['interpretation_request_id'] == case]
+    if not records:
+        return None
+    clinical_reports = records[0].get('clinical_reports')
+    if clinical_reports is None or any('exit_questionnaire' not in report for report in clinical_reports):
+        ir_json = get_interpretation_request_json(ir_id, ir_version, testing_on=testing_on, session=gel_session)
+        clinical_reports = ir_json.get('clinical_report')
+    metadata = {
+        "case_id": records[0].get('case_id'),
+        "assembly": records[0].get('assembly'),
+        "clinical_report": clinical_reports or [],
+        "interpreted_genome": []
+    }
+    if software_versions:
+        interpreted_genome = get_interpreted_genome_for_case(ir_id, ir_version, 'genomics_england_tiering',
+                                                             testing_on=testing_on, session=gel_session)
+        # A 'Not found' response is returned if the case has no tiering interpreted genome
+        if interpreted_genome and 'interpreted_genome_data' in interpreted_genome:
+            metadata["interpreted_genome"].append(interpreted_genome)
+    return metadata
 
 
 def download_sum_findings(ir_id, ir_version, clinical_report_version=1):
@@ -0,0 +1,352 @@
+"""Generate synthetic GeL v6 interpretation requests and PanelApp panels for scale testing.
+
+Interpreted genomes match the protocols.reports_6_0_1 InterpretedGenome schema. Report events use
+genes and names from the generated PanelApp panels, so cases can be retiered against panels served by
+jellypy.pyCIPAPI.mock_server or written to a PanelApp snapshot.
+
+Data for each case and panel is generated from the seed and its id alone. Any case can be generated
+independently, in any order, with the same result.
+
+>>> generator = SyntheticCaseGenerator(seed=1, variants=100, events_per_variant=2)
+>>> irjson = generator.interpretation_request(1234, 1)
+>>> panel = generator.panel(1)
+
+Write a cohort of interpretation request json files from the command line:
+
+    $ python -m jellypy.pyCIPAPI.synthetic --cases 10000 --variants 50 --outdir cohort/
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+
+from protocols.reports_6_0_1 import InterpretedGenome
+
+CHROMOSOMES = [str(number) for number in range(1, 23)] + ['X']
+BASES = 'ACGT'
+# (Mode of inheritance, segregation pattern) pairs used by the GeL tiering pipeline
+INHERITANCE = [
+    ('biallelic', 'SimpleRecessive'),
+    ('biallelic', 'CompoundHeterozygous'),
+    ('monoallelic', 'InheritedAutosomalDominant'),
+    ('monoallelic_not_imprinted', 'deNovo'),
+    ('xlinked_monoallelic', 'XLinkedMonoallelic'),
+    ('xlinked_biallelic', 'XLinkedSimpleRecessive'),
+]
+CONSEQUENCES = [
+    ('SO:0001583', 'missense_variant'),
+    ('SO:0001587', 'stop_gained'),
+    ('SO:0001589', 'frameshift_variant'),
+    ('SO:0001575', 'splice_donor_variant'),
+    ('SO:0001630', 'splice_region_variant'),
+    ('SO:0001819', 'synonymous_variant'),
+]
+PANEL_MOIS = [
+    'BIALLELIC, autosomal or pseudoautosomal',
+    'MONOALLELIC, autosomal or pseudoautosomal, NOT imprinted',
+    'MONOALLELIC, autosomal or pseudoautosomal, imprinted status unknown',
+    'BOTH monoallelic and biallelic, autosomal or pseudoautosomal',
+    'X-LINKED: hemizygous mutation in males, biallelic mutations in females',
+    'Unknown',
+]
+RELATIONS = ['Mother', 'Father', 'FullSibling', 'FullSibling', 'Other']
+SOFTWARE_VERSIONS = {'tiering': '1.0.0', 'GelReportModels': '6.0.1'}
+REFERENCE_DATABASES_VERSIONS = {'genomeAssembly': 'GRCh38', 'ensembl': '90'}
+
+
+class SyntheticCaseGenerator():
+    """Generate seeded synthetic interpretation requests and PanelApp panels.
+
+    Args:
+        seed(int): Random seed
+        variants(int): Small variants in each case's tiering interpreted genome
+        events_per_variant(int): Report events for each variant
+        family_members(int): Pedigree members including the proband
+        panels(int): Analysis panels applied to each case
+        total_panels(int): Number of PanelApp panels cases are drawn from
+        panel_genes(int): Genes in each PanelApp panel
+        assembly(str): Reference genome for variant coordinates
+        tiered_variants(bool): Also add legacy TieredVariants, with calledGenotypes keyed by gelId, to
+            the interpretation request data. Used by scripts written against older CIP-API models.
+    """
+
+    def __init__(self, seed=0, variants=50, events_per_variant=2, family_members=3, panels=2,
+                 total_panels=20, panel_genes=200, assembly='GRCh38', tiered_variants=False):
+        self.seed = seed
+        self.variants, self.events_per_variant = variants, events_per_variant
+        self.family_members, self.panels = family_members, panels
+        self.total_panels, self.panel_genes = total_panels, panel_genes
+        self.assembly, self.tiered_variants = assembly, tiered_variants
+        self._panel_cache = {}
+
+    @staticmethod
+    def panel_name(panel_id):
+        return f'Synthetic panel {panel_id}'
+
+    def panel_id(self, panel):
+        """Return the panel id for a panel id or name, or None if the panel does not exist."""
+        panel = str(panel)
+        if panel.startswith('Synthetic panel '):
+            panel = panel[len('Synthetic panel '):]
+        if panel.isdigit() and 1 <= int(panel) <= self.total_panels:
+            return int(panel)
+        return None
+
+    def panel(self, panel_id):
+        """Return PanelApp json for a panel, matching the PanelApp /panels/<id> endpoint."""
+        if panel_id not in self._panel_cache:
+            rng = random.Random(f'{self.seed}-panel-{panel_id}')
+            gene_numbers = rng.sample(range(1, 60000), self.panel_genes)
+            self._panel_cache[panel_id] = {
+                'id': panel_id,
+                'hash_id': f'{self.seed:08x}{panel_id:016x}',
+                'name': self.panel_name(panel_id),
+                'version': f'1.{rng.randint(0, 50)}',
+                'version_created': '2020-01-01T00:00:00.000000Z',
+                'relevant_disorders': [f'Synthetic disorder {panel_id}'],
+                'genes': [
+                    {
+                        'gene_data': {
+                            'hgnc_id': f'HGNC:{number}',
+                            'hgnc_symbol': f'GENE{number}',
+                            'ensembl_genes': {
+                                'GRch37': {'82': {'ensembl_id': f'ENSG{number:011d}'}},
+                                'GRch38': {'90': {'ensembl_id': f'ENSG{number:011d}'}},
+                            },
+                        },
+                        'confidence_level': rng.choice(['0', '1', '2', '3', '3', '4']),
+                        'mode_of_inheritance': rng.choice(PANEL_MOIS),
+                    }
+                    for number in gene_numbers
+                ],
+            }
+        return self._panel_cache[panel_id]
+
+    def panel_summary(self, panel_id):
+        """Return panel data for the PanelApp /panels listing, which excludes genes."""
+        return {key: value for key, value in self.panel(panel_id).items() if key != 'genes'}
+
+    def _case_random(self, ir_id, ir_version):
+        return random.Random(f'{self.seed}-case-{ir_id}-{ir_version}')
+
+    def _created_at(self, ir_id):
+        return datetime.datetime(2019, 1, 1) + datetime.timedelta(minutes=int(ir_id))
+
+    def _participants(self, rng):
+        proband = str(rng.randint(110000000, 119999999))
+        relatives = [
+            (str(rng.randint(110000000, 119999999)), RELATIONS[min(index, len(RELATIONS) - 1)])
+            for index in range(self.family_members - 1)
+        ]
+        return proband, relatives
+
+    def listing_record(self, ir_id, ir_version=1):
+        """Return a record for the case, matching the CIP-API interpretation-request listing."""
+        rng = self._case_random(ir_id, ir_version)
+        proband, _ = self._participants(rng)
+        case_id = f'{ir_id}-{ir_version}'
+        return {
+            'interpretation_request_id': case_id,
+            'case_id': f'SAP-{case_id}',
+            'family_id': str(random.Random(f'{self.seed}-family-{ir_id}').randint(100000, 999999)),
+            'proband': proband,
+            'sites': [random.Random(f'{self.seed}-site-{ir_id}').choice(['RR8', 'RGT', 'RTH', 'RP4'])],
+            'assembly': self.assembly,
+            'sample_type': 'raredisease',
+            'number_of_samples': self.family_members,
+            'last_status': 'sent_to_gmcs',
+            'last_modified': self._created_at(ir_id).isoformat() + 'Z',
+            'clinical_reports': [],
+        }
+
+    def _variant(self, rng, index, proband, relatives, panel_ids):
+        chromosome = rng.choice(CHROMOSOMES)
+        reference = rng.choice(BASES)
+        alternate = rng.choice(BASES.replace(reference, ''))
+        moi, segregation = rng.choice(INHERITANCE)
+        consequence_id, consequence_name = rng.choice(CONSEQUENCES)
+        calls = [(proband, rng.choice(['heterozygous', 'alternate_homozygous']))] + [
+            (participant, rng.choice(['heterozygous', 'reference_homozygous', 'alternate_homozygous']))
+            for participant, _ in relatives
+        ]
+        report_events = []
+        for event_index in range(self.events_per_variant):
+            panel = self.panel(rng.choice(panel_ids))
+            gene = rng.choice(panel['genes'])['gene_data']
+            tier = rng.choice(['TIER1', 'TIER2', 'TIER3', 'TIER3', 'TIER3'])
+            report_events.append({
+                'reportEventId': f'RE{index}-{event_index}',
+                'phenotypes': {'nonStandardPhenotype': None, 'standardPhenotypes': None},
+                'variantConsequences': [{'id': consequence_id, 'name': consequence_name}],
+                'genePanel': {
+                    'panelIdentifier': str(panel['id']), 'panelName': panel['name'],
+                    'panelVersion': panel['version'], 'source': 'panelapp'
+                },
+                'modeOfInheritance': moi,
+                'genomicEntities': [{
+                    'type': 'gene', 'ensemblId': gene['ensembl_genes']['GRch38']['90']['ensembl_id'],
+                    'geneSymbol': gene['hgnc_symbol'],
+                    'otherIds': [{'source': 'HGNC', 'identifier': gene['hgnc_symbol']}]
+                }],
+                'segregationPattern': segregation,
+                'penetrance': rng.choice(['complete', 'incomplete']),
+                'deNovoQualityScore': None,
+                'fullyExplainsPhenotype': None,
+                'groupOfVariants': None,
+                'eventJustification': f'Classified as: {tier.title()}, passed the {segregation} segregation filter',
+                'tier': tier,
+                'domain': None,
+                'score': 0.0,
+                'vendorSpecificScores': None,
+                'variantClassification': None,
+                'guidelineBasedVariantClassification': None,
+                'algorithmBasedVariantClassifications': None,
+                'roleInCancer': None,
+                'actions': None,
+            })
+        return {
+            'variantCoordinates': {
+                'chromosome': chromosome, 'position': rng.randint(10000, 100000000),
+                'reference': reference, 'alternate': alternate, 'assembly': self.assembly
+            },
+            'variantCalls': [
+                {
+                    'participantId': participant, 'sampleId': f'LP{participant}', 'zygosity': zygosity,
+                    'phaseGenotype': None, 'sampleVariantAlleleFrequency': None, 'depthReference': None,
+                    'depthAlternate': None, 'numberOfCopies': None, 'supportingReadTypes': None,
+                    'alleleOrigins': ['germline_variant']
+                }
+                for participant, zygosity in calls
+            ],
+            'reportEvents': report_events,
+            'variantAttributes': None,
+        }
+
+    @staticmethod
+    def _tiered_variant(variant, index):
+        """Return a legacy TieredVariants record for a v6 small variant."""
+        coordinates = variant['variantCoordinates']
+        return {
+            'dbSNPid': f'rs{index}',
+            'chromosome': coordinates['chromosome'],
+            'position': coordinates['position'],
+            'reference': coordinates['reference'],
+            'alternate': coordinates['alternate'],
+            'calledGenotypes': [
+                {'gelId': call['participantId'], 'genotype': call['zygosity']} for call in variant['variantCalls']
+            ],
+            'reportEvents': [{'tier': event['tier']} for event in variant['reportEvents']],
+        }
+
+    def interpretation_request(self, ir_id, ir_version=1):
+        """Return interpretation request json for a case, matching the CIP-API v6 response.
+
+        Args:
+            ir_id(int): Interpretation request id
+            ir_version(int): Interpretation request version
+        """
+        rng = self._case_random(ir_id, ir_version)
+        proband, relatives = self._participants(rng)
+        panel_ids = rng.sample(range(1, self.total_panels + 1), min(self.panels, self.total_panels))
+        variants = [
+            self._variant(rng, index, proband, relatives, panel_ids) for index in range(self.variants)
+        ]
+        created_at = self._created_at(ir_id)
+        record = self.listing_record(ir_id, ir_version)
+        json_request = {
+            'pedigree': {
+                'members': [
+                    {
+                        'participantId': participant, 'isProband': relation is None,
+                        'additionalInformation': {'relation_to_proband': relation} if relation else {}
+                    }
+                    for participant, relation in [(proband, None)] + relatives
+                ],
+                'analysisPanels': [
+                    {'panelName': self.panel_name(panel_id), 'specificDisease': f'Synthetic disorder {panel_id}'}
+                    for panel_id in panel_ids
+                ],
+            },
+        }
+        if self.tiered_variants:
+            json_request['TieredVariants'] = [
+                self._tiered_variant(variant, index) for index, variant in enumerate(variants)
+            ]
+        return {
+            'interpretation_request_id': int(ir_id),
+            'version': int(ir_version),
+            'case_id': record['case_id'],
+            'family_id': record['family_id'],
+            'proband': proband,
+            'assembly': self.assembly,
+            'sample_type': 'raredisease',
+            'last_status': 'sent_to_gmcs',
+            'status': [
+                {'status': 'waiting_payload', 'created_at': created_at.isoformat() + 'Z'},
+                {'status': 'sent_to_gmcs', 'created_at': record['last_modified']},
+            ],
+            'clinical_report': [],
+            'interpreted_genome': [{
+                'created_at': created_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                'interpreted_genome_data': {
+                    'versionControl': {'gitVersionControl': '6.0.1'},
+                    'interpretationRequestId': record['case_id'],
+                    'interpretationRequestVersion': int(ir_version),
+                    'interpretationService': 'genomics_england_tiering',
+                    'reportUrl': None,
+                    'variants': variants,
+                    'structuralVariants': None,
+                    'chromosomalRearrangements': None,
+                    'shortTandemRepeats': None,
+                    'uniparentalDisomies': None,
+                    'karyotypes': None,
+                    'referenceDatabasesVersions': dict(REFERENCE_DATABASES_VERSIONS, genomeAssembly=self.assembly),
+                    'softwareVersions': dict(SOFTWARE_VERSIONS),
+                    'comments': None,
+                },
+            }],
+            'interpretation_request_data': {'json_request': json_request},
+        }
+
+    def cohort(self, cases, start=1):
+        """Yield interpretation request json for `cases` cases with consecutive ids from `start`."""
+        for ir_id in range(start, start + cases):
+            yield self.interpretation_request(ir_id, 1)
+
+    def write_cohort(self, outdir, cases, start=1):
+        """Write interpretation request json files named <irid>-<version>.json to a directory."""
+        os.makedirs(outdir, exist_ok=True)
+        for irjson in self.cohort(cases, start):
+            filename = f"{irjson['interpretation_request_id']}-{irjson['version']}.json"
+            with open(os.path.join(outdir, filename), 'w') as f:
+                json.dump(irjson, f)
+
+
+def is_valid(irjson):
+    """Return True if all interpreted genomes in an interpretation request match the v6 schema."""
+    return all(
+        InterpretedGenome.validate(genome['interpreted_genome_data']) for genome in irjson['interpreted_genome']
+    )
+
+
+def parser_args():
+    """Parse arguments from the command line"""
+    parser = argparse.ArgumentParser(description='Write synthetic GeL v6 interpretation request json files')
+    parser.add_argument('-o', '--outdir', required=True, help='Output directory')
+    parser.add_argument('-n', '--cases', type=int, default=100, help='Number of cases')
+    parser.add_argument('--start', type=int, default=1, help='First interpretation request id')
+    parser.add_argument('--variants', type=int, default=50, help='Variants per case')
+    parser.add_argument('--events', type=int, default=2, help='Report events per variant')
+    parser.add_argument('--family-members', type=int, default=3, help='Pedigree members including the proband')
+    parser.add_argument('--panels', type=int, default=2, help='Analysis panels per case')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parser_args()
+    SyntheticCaseGenerator(
+        seed=args.seed, variants=args.variants, events_per_variant=args.events,
+        family_members=args.family_members, panels=args.panels
+    ).write_cohort(args.outdir, args.cases, start=args.start)
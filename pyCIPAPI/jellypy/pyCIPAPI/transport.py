@@ -0,0 +1,197 @@
+"""Shared HTTP transport for GeL API requests.
+
+Sessions mounted with `mount()` share connection pools, a per-host token bucket rate limiter and a
+retry policy. Requests that fail with a connection error, 429 or 5xx response are retried with
+exponential backoff and jitter. A Retry-After header on the response overrides the backoff delay.
+Transport settings are read from config.py. Observers added with `add_observer()` are called after
+every request attempt, e.g. to collect metrics.
+
+>>> session = new_session()
+>>> session.get('https://panelapp.genomicsengland.co.uk/api/v1/panels/')
+"""
+import datetime
+import email.utils
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .config import (http_backoff, http_max_backoff, http_pool_size, http_rate_limits, http_retries,
+                     http_timeout)
+
+# Response status codes that are retried
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Methods that are safe to retry after a server error or lost connection. A 429 response means the
+#   request was not processed, so it is retried for any method.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'])
+
+
+class TokenBucket():
+    """Thread-safe token bucket rate limiter.
+
+    Args:
+        rate(float): Tokens added per second
+        capacity(float): Maximum tokens held, allowing short bursts. Defaults to `rate`.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Take tokens from the bucket, sleeping until they are available.
+
+        Tokens are reserved before sleeping, so waiting threads are served in the order they arrive.
+
+        Returns:
+            The number of seconds spent waiting
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class RateLimiter():
+    """Token buckets for each host.
+
+    Args:
+        rates(dict): Requests per second for each host name. The 'default' key applies to hosts not
+            listed. A rate of None disables rate limiting for a host.
+    """
+
+    def __init__(self, rates):
+        self.rates = rates
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host):
+        rate = self.rates.get(host, self.rates.get('default'))
+        if not rate:
+            return 0
+        with self._lock:
+            bucket = self._buckets.setdefault(host, TokenBucket(rate))
+        return bucket.acquire()
+
+
+def retry_after(response):
+    """Return the delay in seconds requested by a response's Retry-After header, or None."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def backoff(attempt, base=http_backoff, maximum=http_max_backoff):
+    """Return an exponential backoff delay with full jitter for a retry attempt (0-indexed)."""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+class TransportAdapter(HTTPAdapter):
+    """HTTPAdapter with rate limiting, retries and a default timeout.
+
+    Args:
+        rate_limiter(RateLimiter): Rate limiter shared between adapters
+        retries(int): Maximum retries for each request
+        timeout(float or tuple): Default (connect, read) timeout in seconds for requests without one
+        pool_size(int): Connections kept open for each host
+    """
+
+    def __init__(self, rate_limiter, retries=http_retries, timeout=http_timeout, pool_size=http_pool_size):
+        super().__init__(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.rate_limiter = rate_limiter
+        self.retries = retries
+        self.timeout = timeout
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        host = urlparse(request.url).hostname
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.acquire(host)
+            start = time.monotonic()
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                _notify(host, request.method, None, 0, time.monotonic() - start)
+                if attempt == self.retries or request.method not in IDEMPOTENT_METHODS:
+                    raise
+                delay = backoff(attempt)
+            else:
+                # Streamed response bodies are not read here, so use the Content-Length header
+                size = (
+                    int(response.headers.get('Content-Length') or 0) if kwargs.get('stream')
+                    else len(response.content)
+                )
+                _notify(host, request.method, response.status_code, size, time.monotonic() - start)
+                retryable = response.status_code == 429 or (
+                    response.status_code in RETRY_STATUSES and request.method in IDEMPOTENT_METHODS
+                )
+                if not retryable or attempt == self.retries:
+                    return response
+                delay = retry_after(response)
+                delay = backoff(attempt) if delay is None else min(delay, http_max_backoff)
+                response.close()
+            time.sleep(delay)
+
+
+# Rate limits are shared by all sessions in this process
+_rate_limiter = RateLimiter(http_rate_limits)
+# Callables notified of each request attempt. See add_observer().
+_observers = []
+
+
+def add_observer(observer):
+    """Call `observer(host, method, status, size, seconds)` after every request attempt.
+
+    `status` is None if the attempt failed with a connection error or timeout. `size` is the response
+    body size in bytes. Observers are called from the requesting thread and must be thread-safe.
+    """
+    _observers.append(observer)
+
+
+def remove_observer(observer):
+    """Stop notifying an observer added with add_observer()."""
+    if observer in _observers:
+        _observers.remove(observer)
+
+
+def _notify(*args):
+    for observer in list(_observers):
+        observer(*args)
+
+
+def mount(session, **kwargs):
+    """Mount the shared transport on a requests session. Keyword arguments are passed to TransportAdapter.
+
+    Returns:
+        The session
+    """
+    adapter = TransportAdapter(_rate_limiter, **kwargs)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def new_session(**kwargs):
+    """Return a new requests session using the shared transport."""
+    return mount(requests.Session(), **kwargs)
@@ -2,7 +2,7 @@ from setuptools import find_packages, setup
 
 setup(
     name='jellypy_pyCIPAPI',
-    version='0.2.4',
+    version='0.3.0',
     author="NHS Bioinformatics Group",
     author_email="joowook.ahn@nhs.net",
     description='Python client library the Genomics England CIPAPI',
@@ -12,7 +12,7 @@ setup(
     long_description_content_type='text/markdown',
     url='https://github.com/NHS-NGS/JellyPy/pyCIPAPI',
     packages=find_packages(),
-    python_requires='>=3.6.*',
+    python_requires='>=3.6',
     install_requires=[
         'docopt == 0.6.2',
         'GelReportModels == 7.2.10',
@@ -21,5 +21,8 @@ setup(
         'requests == 2.22.0',
         'pandas == 1.2.4',
         'openpyxl == 2.6.3'
+    ],
+    classifiers=[
+        "Programming Language :: Python :: 3.6"
     ]
 )
@@ -15,11 +15,25 @@ Example config.ini format:
     test_irid = VALID_INTERPRETATION_REQUEST_ID
     test_irversion = VALID_INTERPRETATION_REQUEST_VERSION
 """
+import hashlib
+import json
+import pathlib
+import pstats
+import threading
+import time
+
 import pytest
+import requests
 
 import jellypy.pyCIPAPI.config as config
 import jellypy.pyCIPAPI.auth as auth
 import jellypy.pyCIPAPI.interpretation_requests as irs
+import jellypy.pyCIPAPI.opencga as opencga
+import jellypy.pyCIPAPI.profiling as profiling
+import jellypy.pyCIPAPI.summary_findings as summary_findings
+import jellypy.pyCIPAPI.transport as transport
+from jellypy.pyCIPAPI.mock_server import MockServer
+from jellypy.pyCIPAPI.synthetic import SyntheticCaseGenerator, is_valid
 
 
 def test_import():
@@ -58,3 +72,363 @@ def test_get_irjson(jpconfig, authenticated_session):
     """Interpretation request data can be downloaded from the CIPAPI with an authenticated session"""
     data = irs.get_interpretation_request_json(irid, irversion, reports_v6=True, session=authenticated_session)
     assert 'interpretation_request_id' in data.keys()
+
+def test_token_bucket():
+    """Token bucket allows a burst up to capacity, then limits requests to the rate"""
+    bucket = transport.TokenBucket(rate=50, capacity=5)
+    start = time.monotonic()
+    for _ in range(15):
+        bucket.acquire()
+    # 5 tokens are available immediately and 10 more take 0.2 seconds at 50 per second
+    assert 0.15 < time.monotonic() - start < 0.5
+
+def test_retry_after():
+    """Retry-After headers are parsed as seconds or HTTP dates"""
+    response = requests.Response()
+    assert transport.retry_after(response) is None
+    response.headers['Retry-After'] = '3'
+    assert transport.retry_after(response) == 3
+    response.headers['Retry-After'] = 'Wed, 21 Oct 2015 07:28:00 GMT'
+    assert transport.retry_after(response) == 0
+
+@pytest.fixture()
+def mock_server(monkeypatch):
+    """Start a local mock CIP-API server and point pyCIPAPI at it"""
+    with MockServer(cases=25, page_size=7, error_rate=0.2, error_status=429, seed=1) as server:
+        urls = server.environ()
+        monkeypatch.setattr(auth, 'live_100K_auth_url', urls['JELLYPY_CIPAPI_AUTH_URL'])
+        monkeypatch.setattr(irs, 'live_100k_data_base_url', urls['JELLYPY_CIPAPI_URL'])
+        monkeypatch.setattr(summary_findings, 'live_100k_data_base_url', urls['JELLYPY_CIPAPI_URL'])
+        yield server
+
+@pytest.fixture()
+def mock_session(mock_server):
+    """Create authenticated CIPAPI session against the mock server"""
+    return auth.AuthenticatedCIPAPISession(auth_credentials={'client_id': 'id', 'client_secret': 'secret'})
+
+def test_mock_listing(mock_server, mock_session):
+    """Paginated listings are followed to the end, with simulated errors retried by the transport"""
+    token = mock_session.headers['Authorization'].split()[1]
+    cases = irs.get_interpretation_request_list(token=token)
+    assert [case['interpretation_request_id'] for case in cases] == [f'{i}-1' for i in range(1, 26)]
+    assert mock_server.requests['GET /api/2/interpretation-request'] >= 4
+
+def test_mock_irjson(mock_server, mock_session):
+    """Interpretation request json can be downloaded from the mock server"""
+    for ir_id in range(1, 6):
+        data = irs.get_interpretation_request_json(ir_id, 1, session=mock_session)
+        assert data['interpretation_request_id'] == ir_id
+
+def test_bulk_case_fetch(mock_server, mock_session):
+    """Interpreted genomes and listing records are fetched for many cases over one session"""
+    cases = ['1-1', '2-1', '3-1', '99-1']
+    genomes = irs.get_interpreted_genomes(cases, 'genomics_england_tiering', session=mock_session)
+    assert [case for case in cases if genomes[case]] == ['1-1', '2-1', '3-1']
+    assert not any(irs.get_interpreted_genomes(cases[:2], 'genomics_england_pharmacogenomics',
+                                               session=mock_session).values())
+    metadata = irs.get_case_metadata(cases, session=mock_session)
+    assert metadata['2-1']['interpretation_request_id'] == '2-1' and metadata['99-1'] is None
+
+def test_iter_irjson_cache(tmpdir, mock_server, mock_session):
+    """Interpretation requests stream in listing order and are read from the cache until the case changes"""
+    cases = irs.get_interpretation_request_list(session=mock_session)[:10]
+    cache_dir = str(tmpdir.join('cache'))
+    results = list(irs.iter_interpretation_request_json(cases, max_workers=3, cache_dir=cache_dir,
+                                                        session=mock_session))
+    assert [irjson['interpretation_request_id'] for _, irjson in results] == list(range(1, 11))
+    downloads = mock_server.requests['GET /api/2/interpretation-request/<id>/<id>/']
+    list(irs.iter_interpretation_request_json(cases, cache_dir=cache_dir, session=mock_session))
+    assert mock_server.requests['GET /api/2/interpretation-request/<id>/<id>/'] == downloads
+    cases[0]['last_modified'] = '2999-01-01T00:00:00Z'
+    next(irs.iter_interpretation_request_json(cases[:1], cache_dir=cache_dir, session=mock_session))
+    assert mock_server.requests['GET /api/2/interpretation-request/<id>/<id>/'] > downloads
+    # Cases with an unknown last_modified date are downloaded again, as the cache may be stale
+    downloads = mock_server.requests['GET /api/2/interpretation-request/<id>/<id>/']
+    cases[1]['last_modified'] = 'not a date'
+    next(irs.iter_interpretation_request_json(cases[1:2], cache_dir=cache_dir, session=mock_session))
+    assert mock_server.requests['GET /api/2/interpretation-request/<id>/<id>/'] > downloads
+    assert irs.get_last_modified_timestamp({'last_modified': '2020-01-02T03:04:05.12Z'}) == 1577934245.12
+    assert irs.get_last_modified_timestamp({}) is None
+
+def test_count_variant_tiers():
+    """Tiered variants are counted by their most significant report event tier"""
+    irjson = SyntheticCaseGenerator(seed=2, variants=30, tiered_variants=True).interpretation_request(1, 1)
+    counts = irs.count_variant_tiers(irjson)
+    assert sum(counts.values()) == 30
+    tiered_variants = irjson['interpretation_request_data']['json_request']['TieredVariants']
+    assert counts['T1'] == sum(irs.get_variant_tier(variant) == 1 for variant in tiered_variants)
+
+def test_pedigree_roles():
+    """Zygosities for each pedigree role are read from legacy and v6 variant calls"""
+    irjson = SyntheticCaseGenerator(seed=4, variants=10, family_members=3,
+                                    tiered_variants=True).interpretation_request(1, 1)
+    roles = irs.PedigreeRoles.from_interpretation_request(irjson)
+    assert roles.roles == ['Proband', 'Mother', 'Father']
+    tiered_variant = irjson['interpretation_request_data']['json_request']['TieredVariants'][0]
+    variant = irjson['interpreted_genome'][0]['interpreted_genome_data']['variants'][0]
+    zygosities = roles.zygosities(tiered_variant, ['Proband', 'Mother', 'Sibling'])
+    assert zygosities == {
+        'Proband': variant['variantCalls'][0]['zygosity'],
+        'Mother': variant['variantCalls'][1]['zygosity'],
+        'Sibling': 'Unknown'
+    }
+    assert roles.zygosities(variant) == roles.zygosities(tiered_variant)
+
+def test_genotype_matrix():
+    """A case's variants are exported as a table of zygosities with a column per role"""
+    pytest.importorskip('pandas')
+    irjson = SyntheticCaseGenerator(seed=4, variants=10).interpretation_request(1, 1)
+    variants = irjson['interpreted_genome'][0]['interpreted_genome_data']['variants']
+    roles = irs.PedigreeRoles.from_interpretation_request(irjson)
+    matrix = roles.genotype_matrix(variants)
+    assert matrix.shape == (10, 3) and list(matrix.columns) == roles.roles
+    assert matrix.iloc[0].to_dict() == roles.zygosities(variants[0])
+
+def test_case_closure(mock_server, mock_session):
+    """Clinical reports and exit questionnaires are submitted over one session and show in the IR json"""
+    ir_json = irs.get_interpretation_request_json(4, 1, session=mock_session)
+    assert summary_findings.num_existing_reports(ir_json) == 0
+    cr = summary_findings.create_cr(
+        interpretationRequestId='4', interpretationRequestVersion=1, reportingDate='2020-01-01', user='jbloggs',
+        genomicInterpretation='No tier 1 or 2 variants detected',
+        referenceDatabasesVersions=summary_findings.get_ref_db_versions(ir_json),
+        softwareVersions=summary_findings.gel_software_versions(ir_json))
+    summary_findings.post_cr(ir_json, cr, session=mock_session)
+    ir_json = irs.get_interpretation_request_json(4, 1, session=mock_session)
+    assert summary_findings.num_existing_reports(ir_json) == 1
+    assert not summary_findings.exit_questionnaire_submitted(ir_json)
+    eq = summary_findings.create_eq('2020-01-01', 'jbloggs', summary_findings.create_flq('no', 'no', 'None'))
+    summary_findings.put_eq(eq, 4, 1, session=mock_session)
+    ir_json = irs.get_interpretation_request_json(4, 1, session=mock_session)
+    assert summary_findings.exit_questionnaire_submitted(ir_json)
+
+def test_closure_metadata(mock_server, mock_session, monkeypatch):
+    """Case closure fields read from the listing and tiering interpreted genome match the full IR json"""
+    ir_json = irs.get_interpretation_request_json(6, 1, session=mock_session)
+    metadata = summary_findings.get_closure_metadata(6, 1, session=mock_session)
+    assert metadata['case_id'] == ir_json['case_id']
+    assert summary_findings.get_ref_db_versions(metadata) == summary_findings.get_ref_db_versions(ir_json)
+    assert summary_findings.gel_software_versions(metadata) == summary_findings.gel_software_versions(ir_json)
+    assert summary_findings.num_existing_reports(metadata) == 0
+    assert summary_findings.get_closure_metadata(99, 1, session=mock_session) is None
+    mock_server.clinical_reports[(6, 1)] = [{'clinical_report_version': 1, 'exit_questionnaire': {}}]
+    metadata = summary_findings.get_closure_metadata(6, 1, software_versions=False, session=mock_session)
+    assert summary_findings.num_existing_reports(metadata) == 1 and not metadata['interpreted_genome']
+    # Clinical reports are read from the IR json if the listing does not show their exit questionnaires
+    listing = summary_findings.get_interpretation_request_list
+    def listing_without_exit_questionnaires(*args, **kwargs):
+        records = listing(*args, **kwargs)
+        for record in records:
+            record['clinical_reports'] = [{'clinical_report_version': 1}]
+        return records
+    monkeypatch.setattr(summary_findings, 'get_interpretation_request_list', listing_without_exit_questionnaires)
+    mock_server.clinical_reports[(6, 1)][0]['exit_questionnaire'] = {'eventDate': '2020-01-01'}
+    downloads = mock_server.requests['GET /api/2/interpretation-request/<id>/<id>/']
+    metadata = summary_findings.get_closure_metadata(6, 1, software_versions=False, session=mock_session)
+    assert summary_findings.exit_questionnaire_submitted(metadata)
+    assert mock_server.requests['GET /api/2/interpretation-request/<id>/<id>/'] > downloads
+
+def test_report_templates():
+    """Reports built from templates match validated reports, with per-case fields checked"""
+    versions = {'genomeAssembly': 'GRCh38'}, {'gel-tiering': '1.0.0'}
+    template = summary_findings.ClinicalReportTemplate(genomicInterpretation='No tier 1 or 2 variants detected')
+    cr = summary_findings.create_cr('123', 2, '2020-01-31', 'jbloggs', 'No tier 1 or 2 variants detected', *versions)
+    assert template.build('123', '2', '2020-01-31', 'jbloggs', *versions) == cr.toJsonDict()
+    invalid = [('123', 2, '31-01-2020', 'jbloggs'), ('123', 2, '2020-01-31', None), (123, 2, '2020-01-31', 'jb')]
+    for case_fields in invalid:
+        with pytest.raises((TypeError, ValueError)):
+            template.build(*case_fields, *versions)
+    with pytest.raises(TypeError):
+        template.build('123', 2, '2020-01-31', 'jbloggs', {'genomeAssembly': None}, versions[1])
+    with pytest.raises(TypeError):
+        summary_findings.ClinicalReportTemplate(genomicInterpretation=None)
+    flq = summary_findings.create_flq('no', 'no', 'None')
+    eq = summary_findings.ExitQuestionnaireTemplate(flq).build('2020-01-31', 'jbloggs')
+    assert eq == summary_findings.create_eq('2020-01-31', 'jbloggs', flq).toJsonDict()
+
+@pytest.fixture()
+def opencga_session(mock_server, monkeypatch):
+    """Create an OpenCGA session against the mock server"""
+    monkeypatch.setattr(auth, 'opencga_base_url', mock_server.environ()['JELLYPY_OPENCGA_URL'])
+    monkeypatch.setattr(auth, 'auth_credentials', {'username': 'user', 'password': 'password'})
+    mock_server.error_rate = 0
+    return auth.AuthenticatedOpenCGASession()
+
+def test_opencga_download(tmpdir, mock_server, opencga_session, monkeypatch):
+    """Files are downloaded in parallel segments, verified, and resumed from saved segment progress"""
+    monkeypatch.setattr(opencga, 'MIN_SEGMENT_SIZE', 2**16)
+    content = mock_server.file_content(7)
+    md5 = hashlib.md5(content).hexdigest()
+    path = opencga.download_file(7, 1, 'a.vcf.gz', str(tmpdir), session=opencga_session, segments=4,
+                                 expected_md5=md5, chunk_size=2**14)
+    assert open(path, 'rb').read() == content and not tmpdir.join('a.vcf.gz.part.json').exists()
+    # Resume a download interrupted half way through its only segment
+    half = len(content) // 2
+    tmpdir.join('b.vcf.gz.part').write_binary(content[:half] + bytes(len(content) - half))
+    tmpdir.join('b.vcf.gz.part.json').write(json.dumps({'size': len(content), 'segments': [[0, len(content), half]]}))
+    downloads = mock_server.requests['GET /opencga/files/<id>/download']
+    path = opencga.download_file(7, 1, 'b.vcf.gz', str(tmpdir), session=opencga_session, expected_md5=md5)
+    assert open(path, 'rb').read() == content
+    assert mock_server.requests['GET /opencga/files/<id>/download'] == downloads + 2
+    # Failed verification removes the partial file
+    assert opencga.download_file(7, 1, 'c.vcf.gz', str(tmpdir), session=opencga_session, expected_md5='0') is None
+    assert not tmpdir.join('c.vcf.gz.part').exists()
+    # Servers without Range support send the whole file
+    mock_server.range_requests = False
+    path = opencga.download_file(7, 1, 'd.vcf.gz', str(tmpdir), session=opencga_session, expected_md5=md5)
+    assert open(path, 'rb').read() == content
+    # Network errors on either path return None, as failed verification does
+    def fail(*args, **kwargs):
+        raise requests.ConnectionError('Connection reset')
+    monkeypatch.setattr(opencga, '_download_stream', fail)
+    assert opencga.download_file(7, 1, 'e.vcf.gz', str(tmpdir), session=opencga_session) is None
+    mock_server.range_requests = True
+    monkeypatch.setattr(opencga, '_download_segments', fail)
+    assert opencga.download_file(7, 1, 'e.vcf.gz', str(tmpdir), session=opencga_session) is None
+
+def test_opencga_download_manager(tmpdir, mock_server, opencga_session):
+    """Manifest files are resolved with batched searches, downloaded, verified and skipped on reruns"""
+    names = [f'LP{i}.vcf.gz' for i in range(5)]
+    mock_server.opencga_files = names
+    manifest = str(tmpdir.join('manifest.tsv'))
+    rows = [{'study_id': '1000000032', 'format': 'VCF', 'file_name': name} for name in names + ['missing.vcf.gz']]
+    opencga.write_manifest(manifest, rows, opencga.MANIFEST_FIELDS)
+    manager = opencga.DownloadManager(str(tmpdir.join('vcfs')), session=opencga_session, max_downloads=3,
+                                      max_bandwidth=2**30, batch_size=4)
+    completed = str(tmpdir.join('completed.tsv'))
+    results = manager.run(opencga.read_manifest(manifest), completed)
+    assert [result['status'] for result in results] == ['downloaded'] * 5 + ['not_found']
+    assert mock_server.requests['GET /opencga/files/search'] == 2
+    assert tmpdir.join('vcfs', 'LP0.vcf.gz').read_binary() == mock_server.file_content(results[0]['file_id'])
+    assert [row['status'] for row in opencga.read_manifest(completed)] == ['downloaded'] * 5 + ['not_found']
+    assert {result['status'] for result in manager.run(rows[:5])} == {'skipped'}
+
+def test_opencga_session_provider(mock_server, opencga_session):
+    """Threads share one OpenCGA session, which logs in once again when its session id is about to expire"""
+    provider = auth.OpenCGASessionProvider(margin=5)
+    sessions = []
+    threads = [threading.Thread(target=lambda: sessions.append(provider.get())) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(session) for session in sessions}) == 1
+    logins = mock_server.requests['POST /opencga/users/<user>/login']
+    session = sessions[0]
+    sid = session.sid
+    session.auth_expires = session.auth_time.add(minutes=4)
+    threads = [threading.Thread(target=provider.get) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert mock_server.requests['POST /opencga/users/<user>/login'] == logins + 1
+    assert session.sid != sid and session.auth_current()
+
+def test_synthetic_case():
+    """Synthetic interpretation requests are reproducible and match the v6 interpreted genome schema"""
+    generator = SyntheticCaseGenerator(seed=3, variants=20, events_per_variant=3, family_members=4)
+    irjson = generator.interpretation_request(42, 1)
+    assert is_valid(irjson)
+    assert irjson == SyntheticCaseGenerator(seed=3, variants=20, events_per_variant=3,
+                                            family_members=4).interpretation_request(42, 1)
+    variants = irjson['interpreted_genome'][0]['interpreted_genome_data']['variants']
+    assert len(variants) == 20 and all(len(variant['reportEvents']) == 3 for variant in variants)
+    assert len(irjson['interpretation_request_data']['json_request']['pedigree']['members']) == 4
+    # Report events are in genes from the case's analysis panels
+    panels = {
+        panel['panelName']: generator.panel(generator.panel_id(panel['panelName']))
+        for panel in irjson['interpretation_request_data']['json_request']['pedigree']['analysisPanels']
+    }
+    event = variants[0]['reportEvents'][0]
+    panel_genes = [gene['gene_data']['hgnc_symbol'] for gene in panels[event['genePanel']['panelName']]['genes']]
+    assert event['genomicEntities'][0]['geneSymbol'] in panel_genes
+
+def test_profile(tmpdir, monkeypatch):
+    """Profiles are only written when an output directory is given or set in the environment"""
+    monkeypatch.delenv(profiling.PROFILE_ENV, raising=False)
+    with profiling.profile('disabled') as profiler:
+        assert profiler is None
+    monkeypatch.setenv(profiling.PROFILE_ENV, str(tmpdir))
+    with profiling.profile('case') as profiler:
+        [str(number) for number in range(10000)]
+    assert pstats.Stats(profiler.stats_path).total_calls > 0
+    with open(profiler.memory_path) as f:
+        assert f.readline().startswith('Peak traced memory')
+
+@pytest.fixture()
+def vcfs_compare(monkeypatch):
+    """The scripts/vcfs_compare.py module"""
+    pytest.importorskip('pysam')
+    monkeypatch.syspath_prepend(str(pathlib.Path(__file__).resolve().parents[2] / 'scripts'))
+    import vcfs_compare
+    return vcfs_compare
+
+def write_vcf(path, records, length=1000):
+    """Write VCF records for sample S1 on contig 1 to a bgzipped, tabix indexed file. Returns its path."""
+    import pysam
+    with open(path, 'w') as f:
+        f.write('##fileformat=VCFv4.2\n##contig=<ID=1,length={}>\n'.format(length))
+        f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n')
+        for pos, ref, alt, genotype in records:
+            f.write('1\t{}\t.\t{}\t{}\t50\tPASS\t.\tGT\t{}\n'.format(pos, ref, alt, genotype))
+    return pysam.tabix_index(str(path), preset='vcf', force=True)
+
+def test_vcfs_compare(tmpdir, vcfs_compare):
+    """Records are matched by position and alleles, and duplicate records are counted"""
+    vcf1 = write_vcf(tmpdir / 'vcf1.vcf', [
+        (100, 'A', 'G', '0/1'),  # Concordant
+        (200, 'C', 'T', '0/1'),  # Discordant genotype
+        (300, 'G', 'A', '0/1'),  # vcf1 only
+        (500, 'A', 'C,G', '1/2'),  # Concordant multi-allelic site
+        (600, 'C', 'A', '0/1'),
+        (600, 'C', 'A', '0/1'),  # Duplicate
+    ])
+    vcf2 = write_vcf(tmpdir / 'vcf2.vcf', [
+        (100, 'A', 'G', '0/1'),
+        (200, 'C', 'T', '1/1'),
+        (400, 'T', 'C', '0/1'),  # vcf2 only
+        (500, 'A', 'C,G', '1/2'),
+        (500, 'A', 'T', '0/1'),  # vcf2 only, at a site in both files
+        (600, 'C', 'A', '0/1'),
+    ])
+    discordance_vcf = str(tmpdir / 'discordant.vcf')
+    counts = vcfs_compare.compare_vcfs(vcf1, vcf2, processes=1, discordance_vcf=discordance_vcf)
+    assert {field: counts[field] for field in vcfs_compare.SUMMARY_FIELDS} == {
+        'concordant': 3, 'discordant': 1, 'vcf1_only': 1, 'vcf2_only': 2, 'vcf1_duplicate': 1, 'vcf2_duplicate': 0
+    }
+    assert counts['field sample S1'] == 1
+    with open(discordance_vcf) as f:
+        reasons = [line.split('\t')[7] for line in f if not line.startswith('#')]
+    assert sorted(reasons) == sorted([
+        'VCFS_COMPARE=sample_S1', 'VCFS_COMPARE=vcf1_only', 'VCFS_COMPARE=vcf2_only', 'VCFS_COMPARE=vcf2_only',
+        'VCFS_COMPARE=vcf1_duplicate'
+    ])
+
+def test_vcfs_compare_shards(tmpdir, vcfs_compare):
+    """Comparing in region shards gives the same results as comparing whole contigs"""
+    vcf1 = write_vcf(tmpdir / 'vcf1.vcf', [
+        (50, 'A', 'G', '0/1'),
+        (198, 'ACGTA', 'A', '0/1'),  # Deletion spanning the shard boundary at 200
+        (201, 'C', 'T', '0/1'),  # Starts inside the deletion, in the next shard
+        (301, 'G', 'A', '1/1'),  # First base of a shard
+        (999, 'T', 'C', '0/1'),
+    ])
+    vcf2 = write_vcf(tmpdir / 'vcf2.vcf', [
+        (50, 'A', 'G', '0/1'),
+        (198, 'ACGTA', 'A', '1/1'),
+        (300, 'G', 'C', '0/1'),  # Last base of a shard
+        (301, 'G', 'A', '1/1'),
+        (999, 'T', 'C', '0/1'),
+    ])
+    results = []
+    for shard_size in (None, 100):
+        discordance_vcf = str(tmpdir / 'discordant_{}.vcf'.format(shard_size))
+        counts = vcfs_compare.compare_vcfs(vcf1, vcf2, processes=2, discordance_vcf=discordance_vcf,
+                                           shard_size=shard_size)
+        with open(discordance_vcf) as f:
+            results.append((counts, f.read()))
+    assert results[0] == results[1]
+    assert results[0][0]['concordant'] == 3 and results[0][0]['discordant'] == 1
+    assert results[0][0]['vcf1_only'] == 1 and results[0][0]['vcf2_only'] == 1
@@ -3,8 +3,10 @@ from time import strptime
 from datetime import date, timedelta
 import os
 import pandas as pd
-from jellypy.pyCIPAPI.interpretation_requests import access_date_summary_content, get_interpreted_genome_for_case, \
-    get_interpretation_request_list
+from jellypy.pyCIPAPI.profiling import profile
+from jellypy.pyCIPAPI.auth import AuthenticatedCIPAPISession
+from jellypy.pyCIPAPI.interpretation_requests import access_date_summary_content, get_interpreted_genomes, \
+    get_case_metadata
 
 
 def parser_args():
@@ -22,36 +24,21 @@ def parser_args():
     return parser.parse_args()
 
 
-def get_dpyd_cases(case_list, testing):
+def get_dpyd_cases(case_list, testing, session=None):
     """
     Takes a list of cases, tries to find an interpreted genome for the pharma service, and checks if present
     at time of writing, any pharma variants are DPYD, more granular check may be required in future
+    Interpreted genomes are fetched concurrently over one session
     :param case_list: list of case strings in IR-VER format
+    :param session: an authenticated CIP-API session
     :return:
     """
 
-    dpyd_cases = []
+    pharma_genomes = get_interpreted_genomes(case_list, tiering_service='genomics_england_pharmacogenomics',
+                                             testing_on=testing, session=session)
 
-    for case in case_list:
-        ir, ver = case.split('-')
-
-        pharma_genome = get_interpreted_genome_for_case(ir=ir, version=ver,
-                                                        tiering_service='genomics_england_pharmacogenomics',
-                                                        testing_on=testing)
-
-        if not pharma_genome:
-            continue
-
-        elif pharma_genome == {'detail': 'Not found.'}:
-            continue
-
-        # print(pharma_genome)
-
-        if pharma_genome['interpreted_genome_data']['variants']:
-            if len(pharma_genome['interpreted_genome_data']['variants']) > 0:
-                dpyd_cases.append(case)
-
-    return dpyd_cases
+    return [case for case in case_list
+            if pharma_genomes[case] and pharma_genomes[case]['interpreted_genome_data']['variants']]
 
 
 def create_filename(parsed_args):
@@ -68,11 +55,12 @@ def create_filename(parsed_args):
     return filename
 
 
-def assemble_output(dpyd_cases, output_name, testing):
+def assemble_output(dpyd_cases, output_name, testing, session=None):
     """
 
     :param dpyd_cases:
     :param output_name:
+    :param session: an authenticated CIP-API session
     :return:
     """
 
@@ -92,9 +80,13 @@ def assemble_output(dpyd_cases, output_name, testing):
             quit()
 
     # provided we're not overwriting files and there are cases to write, write them!
+    # get the minimal endpoint details for all cases in one batch
+    case_metadata = get_case_metadata(dpyd_cases, testing_on=testing, session=session)
     for count, case in enumerate(dpyd_cases):
-        # get the minimmal endpoint details for a single case - could try/except wrap, but should work
-        case_json = get_interpretation_request_list(interpretation_request_id=case.split('-')[0], testing_on=testing)[0]
+        case_json = case_metadata[case]
+        if case_json is None:
+            print('No interpretation request listing found for {}'.format(case))
+            continue
         ldp = case_json['sites'][0]
         proband = case_json['proband']
         case_count_df.loc[count] = [case, proband, ldp]  # lookup of LDP to GMC shouldn't be required at GMC level
@@ -108,6 +100,9 @@ if __name__ == '__main__':
 
     cases_to_check = []
 
+    # one authenticated session is shared by all CIP-API requests
+    session = AuthenticatedCIPAPISession(testing_on=parsed_args.testing)
+
     # check if we are using a delta or a pair of dates
     if parsed_args.delta:
         today = date.today()
@@ -116,7 +111,8 @@ if __name__ == '__main__':
         date1 = (today - timedelta(days=parsed_args.delta)).strftime('%d-%m-%Y')
         date2 = today.strftime('%d-%m-%Y')
 
-        response_cases = access_date_summary_content(date1=date1, date2=date2, testing_on=parsed_args.testing)['cases']
+        response_cases = access_date_summary_content(date1=date1, date2=date2, testing_on=parsed_args.testing,
+                                                     session=session)['cases']
 
     # otherwise we need to take user specified dates
     else:
@@ -135,7 +131,8 @@ if __name__ == '__main__':
         response_cases = \
         access_date_summary_content(date1=parsed_args.date1,
                                     date2=parsed_args.date2,
-                                    testing_on=parsed_args.testing)['cases']
+                                    testing_on=parsed_args.testing,
+                                    session=session)['cases']
 
     if 'illumina-sent_to_gmcs' in response_cases.keys():
         cases_to_check = response_cases['illumina-sent_to_gmcs']
@@ -145,7 +142,9 @@ if __name__ == '__main__':
         print('No cases were identified within the specified time period')
         quit()
 
-    dpyd_cases = get_dpyd_cases(cases_to_check, parsed_args.testing)
+    # Set the JELLYPY_PROFILE environment variable to a directory to profile the case checks
+    with profile('cancer_cases_with_pharma_results'):
+        dpyd_cases = get_dpyd_cases(cases_to_check, parsed_args.testing, session=session)
 
     if not dpyd_cases:
         print('None of the {num} cases during this time period contain DPYD variants'.format(num=len(cases_to_check)))
@@ -155,4 +154,4 @@ if __name__ == '__main__':
         parsed_args.output_prefix = create_filename(parsed_args)
 
     # might wanna amend this method to export cases checked and cases positive, indicator in output
-    assemble_output(dpyd_cases, parsed_args.output_prefix, parsed_args.testing)
+    assemble_output(dpyd_cases, parsed_args.output_prefix, parsed_args.testing, session=session)
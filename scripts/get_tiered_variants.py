@@ -1,7 +1,7 @@
 """Output TSV file of tiered variants ready for Alamut Batch annotation.
 
 Usage:
-    get_tiered_variants.py [--force-update] [--site SITE ...]
+    get_tiered_variants.py [--force-update] [--workers N] [--site SITE ...]
     get_tiered_variants.py (-h | --help)
     get_tiered_variants.py --version
 
@@ -9,6 +9,9 @@ Options:
     -h, --help      Show this screen.
     --version       Show version.
     --force_update  Get data from API even if a cached version exists.
+    --workers N     Export cases concurrently with N worker threads. Each case
+                    is downloaded and written independently, and cases whose
+                    TSV is newer than the case's last update are skipped.
     --site          One or more site codes to limit output by site, eg: RR8.
 
 """
@@ -20,16 +23,31 @@ except ImportError:
 import os
 import datetime
 import json
+from concurrent.futures import ThreadPoolExecutor
 from docopt import docopt
+from jellypy.pyCIPAPI.auth import AuthenticatedCIPAPISession
+from jellypy.pyCIPAPI.profiling import profile
 from jellypy.pyCIPAPI.interpretation_requests import (
     get_interpretation_request_json, get_interpretation_request_list,
-    get_pedigree_dict, get_variant_tier, save_interpretation_request_list_json)
+    get_last_modified_timestamp, get_pedigree_dict, get_variant_tier,
+    save_interpretation_request_list_json, PedigreeRoles)
+
+# Family members with a zygosity column in the variant TSV
+ZYGOSITY_ROLES = ('Proband', 'Mother', 'Father')
 
 
 def _main(args):
     # load or get interpretation_request_list
     interpretation_request_list = (get_latest_interpretation_request_list(
                                    args['--force-update']))
+    if args['--workers']:
+        export_interpretation_requests(
+            [case for case in interpretation_request_list
+             if not args['--site'] or set(case['sites']).intersection(set(args['SITE']))],
+            int(args['--workers']), args['--force-update'])
+        save_interpretation_request_list_json(interpretation_request_list,
+                                              args['--force-update'])
+        return
     for case in interpretation_request_list:
         # Ignore cases where the site is not in the list of given sites
         # Or if no sites have been given do the case handling anyway
@@ -77,6 +95,98 @@ def get_latest_interpretation_request_list(force_update=False):
     return interpretation_request_list
 
 
+def export_interpretation_requests(interpretation_request_list, workers,
+                                   force_update=False):
+    """Export variant TSVs for interpretation requests on a pool of worker threads.
+
+    Each case is downloaded, written and released independently, so
+    interpretation request data is never added to the listing. Failed cases
+    are reported and do not stop the export.
+
+    Args:
+        interpretation_request_list: List of interpretation request listing
+            records.
+        workers: Number of cases exported at once.
+        force_update: Boolean switch to enforce output file overwriting.
+
+    Returns:
+        failed: Dictionary of interpretation request ids and errors for
+            cases that could not be exported.
+
+    """
+    # Share one authenticated session between all workers
+    session = AuthenticatedCIPAPISession()
+
+    def export(case):
+        try:
+            export_interpretation_request(case, force_update, session)
+        except Exception as error:
+            return error
+
+    failed = {}
+    with ThreadPoolExecutor(workers) as executor:
+        for case, error in zip(interpretation_request_list,
+                               executor.map(export, interpretation_request_list)):
+            if error is not None:
+                print('Failed to export {}: {}'.format(
+                    case['interpretation_request_id'], error))
+                failed[case['interpretation_request_id']] = error
+    print('Exported {} cases, {} failed'.format(
+        len(interpretation_request_list) - len(failed), len(failed)))
+    return failed
+
+
+def export_interpretation_request(case, force_update=False, session=None):
+    """Download an interpretation request and write its variant TSV.
+
+    The case is skipped without a download if its variant TSV is up to date.
+    Interpretation request data is held on a copy of the listing record, so
+    it is freed once the TSV has been written.
+
+    Args:
+        case: Interpretation request listing record.
+        force_update: Boolean switch to enforce output file overwriting.
+        session: An authenticated CIP-API session.
+
+    Returns:
+        Path to the variant TSV, or None if the existing file is up to date.
+
+    """
+    if not force_update and variant_tsv_is_current(case):
+        return None
+    ir_id, ir_version = case['interpretation_request_id'].split('-')
+    interpretation_request = dict(case)
+    interpretation_request['interpretation_request_data'] = (
+        get_interpretation_request_json(ir_id, ir_version, session=session))
+    interpretation_request['simple_pedigree'] = (get_pedigree_dict(
+        interpretation_request))
+    output_variant_tsv(interpretation_request, force_update=True)
+    return get_variant_tsv_path(case)
+
+
+def get_variant_tsv_path(interpretation_request):
+    """Return the variant TSV output path for an interpretation request."""
+    ir_id, ir_version = (interpretation_request['interpretation_request_id']
+                         .split('-'))
+    variant_tsv = '{}_{}_{}_{}_tiered_variants.tsv'.format(
+        interpretation_request['family_id'], ir_id, ir_version,
+        interpretation_request['assembly'])
+    return os.path.join(os.getcwd(), 'output', variant_tsv)
+
+
+def variant_tsv_is_current(interpretation_request):
+    """Check if the variant TSV exists and was written after the case was last updated.
+
+    If the listing record's last_modified date is missing or cannot be
+    parsed, the file is treated as out of date and regenerated.
+    """
+    variant_tsv_path = get_variant_tsv_path(interpretation_request)
+    if not os.path.isfile(variant_tsv_path):
+        return False
+    last_modified = get_last_modified_timestamp(interpretation_request)
+    return last_modified is not None and os.path.getmtime(variant_tsv_path) >= last_modified
+
+
 def handle_interpretation_request(interpretation_request, force_update=False):
     """Handle an interpretation request for getting tiered variants.
 
@@ -111,7 +221,8 @@ def output_variant_tsv(interpretation_request, force_update=False):
     """Output a variant TSV to match Alamut Batch format for annotation.
 
     If a variant TSV for the given interpretation_request (version, and genome
-    build) exists then pass. If a matching file does not exist or the
+    build) exists and was written after the case was last updated then pass.
+    If a matching file does not exist, is out of date or the
     force_update boolean is True then for each of the variants in the
     interpretation_request get the zygosity for the proband, mother, and father
     (where they are known) and output into a TSV.
@@ -123,20 +234,21 @@ def output_variant_tsv(interpretation_request, force_update=False):
 
     """
     # Make the file paths for existance checking
-    ir_id, ir_version = (interpretation_request['interpretation_request_id']
-                         .split('-'))
-    variant_tsv = '{}_{}_{}_{}_tiered_variants.tsv'.format(
-        interpretation_request['family_id'], ir_id, ir_version,
-        interpretation_request['assembly'])
-    variant_tsv_path = os.path.join(os.getcwd(), 'output', variant_tsv)
-    # Check for file existance or force_update boolean
-    if not (os.path.isfile(variant_tsv_path)) or (force_update is True):
+    variant_tsv_path = get_variant_tsv_path(interpretation_request)
+    # Check for an up to date file or force_update boolean
+    if not variant_tsv_is_current(interpretation_request) or (force_update is True):
         print('Writing variants to {}'.format(variant_tsv_path))
-        with open(variant_tsv_path, 'w') as fout:
+        # Write to a temporary file so an interrupted export never leaves a
+        # partial file that looks up to date
+        tmp_path = '{}.{}.tmp'.format(variant_tsv_path, os.getpid())
+        with open(tmp_path, 'w') as fout:
             # Write header row ofr human readability
             header = ('#id\tchr\tposition\tref\talt\tTier\tproband_zygosity\t'
                       'mother_zygosity\tfather_zygosity\n')
             fout.write(header)
+            # Index the pedigree by gelId once for the whole case
+            pedigree_roles = PedigreeRoles(
+                interpretation_request['simple_pedigree'])
             # Construct the row for a given variant
             for variant in (
                  interpretation_request['interpretation_request_data']
@@ -149,50 +261,17 @@ def output_variant_tsv(interpretation_request, force_update=False):
                 alt = variant['alternate']
                 # Get variant tier
                 tier = str(get_variant_tier(variant))
-                # Get the zygosities where known
-                proband_zygosity = (get_call_zygosity(
-                                    variant,
-                                    interpretation_request['simple_pedigree'],
-                                    'Proband'))
-                mother_zygosity = (get_call_zygosity(
-                                   variant,
-                                   interpretation_request['simple_pedigree'],
-                                   'Mother'))
-                father_zygosity = (get_call_zygosity(
-                                   variant,
-                                   interpretation_request['simple_pedigree'],
-                                   'Father'))
+                # Get the zygosities where known in one pass over the calls
+                zygosities = pedigree_roles.zygosities(
+                    variant, ZYGOSITY_ROLES)
                 fout.write('\t'.join([dbSNPid, chromosome, str(position), ref,
-                           alt, tier, proband_zygosity, mother_zygosity,
-                           father_zygosity]) + '\n')
-
-
-def get_call_zygosity(variant, simple_pedigree, family_member):
-    """Get the zygosity for the given variant for the fiven family member.
-
-    Using the simple_pedigree dictionary extract the genotype for the given
-    variant which matches the desired type of family member. If not record is
-    found for the given family member return the zygosity as 'Unknown'.
-
-    Args:
-        variant: Variant object from the TieredVariants in an interpretation
-            request.
-        simple_pedigree: Simple dictionary representation of the GEL pedigree.
-        family_member: String denoting which family member; eg 'Proband',
-            'Mother', or 'Father'.
-
-    Returns:
-        zygosity: String representing the variant zygosity for the family
-            member. 'Unknown' if not present.
-
-    """
-    zygosity = 'Unknown'
-    for genotype in variant['calledGenotypes']:
-        if genotype['gelId'] == simple_pedigree.get(family_member, False):
-            zygosity = genotype['genotype']
-    return zygosity
+                           alt, tier] + [zygosities[role] for role in
+                           ZYGOSITY_ROLES]) + '\n')
+        os.replace(tmp_path, variant_tsv_path)
 
 
 if __name__ == '__main__':
     arguments = docopt(__doc__, version='1.0')
-    _main(arguments)
+    # Set the JELLYPY_PROFILE environment variable to a directory to profile the run
+    with profile('get_tiered_variants'):
+        _main(arguments)
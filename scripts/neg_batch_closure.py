@@ -0,0 +1,188 @@
+"""Close many negative (no tier 1 or 2 variant) cases by submitting a clinical report (summary of findings)
+and exit questionnaire for each case.
+
+Cases are processed concurrently over one authenticated CIP-API session. Each case's clinical reports
+are checked, using the minimised interpretation request listing, before anything is submitted:
+    - No clinical report: submit a clinical report, then an exit questionnaire
+    - One clinical report without an exit questionnaire: submit the exit questionnaire
+    - One clinical report with an exit questionnaire: already closed, nothing is submitted
+    - More than one clinical report: skipped for manual review
+
+The result for every case is appended to a JSON lines log. Cases logged as closed are skipped when the
+command is run again, so an interrupted batch can simply be rerun.
+"""
+import argparse
+import datetime
+import json
+import os
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from jellypy.pyCIPAPI.auth import AuthenticatedCIPAPISession
+from jellypy.pyCIPAPI.profiling import profile
+from jellypy.pyCIPAPI.summary_findings import (ClinicalReportTemplate, ExitQuestionnaireTemplate, create_flq,
+                                               post_cr, put_eq, get_closure_metadata, num_existing_reports,
+                                               exit_questionnaire_submitted, get_ref_db_versions,
+                                               gel_software_versions)
+
+# Log statuses for cases that need no further submissions
+CLOSED_STATUSES = ('closed', 'already_closed')
+
+GENOMIC_INTERPRETATION = "No tier 1 or 2 variants detected"
+
+
+def parser_args():
+    """Parse arguments from the command line"""
+    parser = argparse.ArgumentParser(
+        description='Submits clinical reports (summary of findings) and exit questionnaires for many NegNeg '
+                    'cases via CIP API')
+    parser.add_argument(
+        '-r', '--reporter',
+        help='CIP-API user name of person who is generating the reports, normally in the format "jbloggs"',
+        required=True, type=str)
+    parser.add_argument(
+        '-d', '--date',
+        help='Date in YYYY-MM-DD format recorded in the clinical reports and exit questionnaires.',
+        required=True, type=str)
+    parser.add_argument(
+        '-t', '--testing',
+        help='Flag to use the CIP-API Beta data during testing', action='store_true')
+    parser.add_argument(
+        '-c', '--cases',
+        help='File of interpretation request IDs including version number, in the format 11111-1, one per line',
+        required=True, type=str)
+    parser.add_argument(
+        '-l', '--log',
+        help='JSON lines file recording the result for each case. Cases logged as closed are skipped on reruns',
+        default='neg_batch_closure.jsonl', type=str)
+    parser.add_argument(
+        '-w', '--workers',
+        help='Number of cases processed at once', default=4, type=int)
+    return parser.parse_args()
+
+
+def read_cases(path):
+    """Read interpretation request IDs from a file, checking each matches the format 11111-1"""
+    with open(path) as fin:
+        cases = [line.strip() for line in fin if line.strip()]
+    invalid = [case for case in cases if not re.match(r"^\d+-\d+$", case)]
+    if invalid:
+        sys.exit("Interpretation request IDs don't match the format 11111-1: {}".format(', '.join(invalid)))
+    # Remove duplicates, keeping the file order
+    return list(dict.fromkeys(cases))
+
+
+def read_closed_cases(log_path):
+    """Return the cases logged as closed by previous runs"""
+    closed = set()
+    if os.path.exists(log_path):
+        with open(log_path) as fin:
+            for line in fin:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted run
+                    continue
+                if result.get('status') in CLOSED_STATUSES:
+                    closed.add(result['case'])
+    return closed
+
+
+class ResultLog():
+    """Thread-safe JSON lines log of case results, written as each case finishes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, case, status, detail=None):
+        result = {'case': case, 'status': status, 'detail': detail,
+                  'time': datetime.datetime.now().isoformat(timespec='seconds')}
+        with self._lock:
+            with open(self.path, 'a') as fout:
+                fout.write(json.dumps(result) + '\n')
+            print('{case}: {status}{detail}'.format(case=case, status=status,
+                                                    detail=' ({})'.format(detail) if detail else ''))
+        return result
+
+
+def close_case(case, clinical_report_template, exit_questionnaire, parsed_args, session):
+    """
+    Check a case and submit its clinical report and exit questionnaire as required
+    :param case: interpretation request ID and version, e.g. 11111-1
+    :param clinical_report_template: ClinicalReportTemplate for the clinical reports
+    :param exit_questionnaire: exit questionnaire JSON to submit, from ExitQuestionnaireTemplate.build()
+    :param session: an authenticated CIP-API session shared by all cases
+    :return: (status, detail) for the result log
+    """
+    ir_id, ir_version = case.split('-')
+    # Only the listing and tiering interpreted genome are downloaded, not the full interpretation request JSON
+    ir_json_v6 = get_closure_metadata(ir_id, ir_version, testing_on=parsed_args.testing, session=session)
+    if ir_json_v6 is None:
+        return 'failed', 'Interpretation request not found'
+    reports = num_existing_reports(ir_json_v6)
+    if reports > 1:
+        return 'skipped', 'Expected at most 1 clinical report but found {}'.format(reports)
+    if reports == 1 and exit_questionnaire_submitted(ir_json_v6):
+        return 'already_closed', None
+    if reports == 0:
+        cr = clinical_report_template.build(
+            interpretationRequestId=ir_id,
+            interpretationRequestVersion=int(ir_version),
+            reportingDate=parsed_args.date,
+            user=parsed_args.reporter,
+            referenceDatabasesVersions=get_ref_db_versions(ir_json_v6),
+            softwareVersions=gel_software_versions(ir_json_v6)
+        )
+        post_cr(clinical_report=cr, ir_json_v6=ir_json_v6, testing_on=parsed_args.testing, session=session)
+        clinical_report_version = 1
+    else:
+        clinical_report_version = ir_json_v6['clinical_report'][0].get('clinical_report_version', 1)
+    put_eq(exit_questionnaire=exit_questionnaire, ir_id=ir_id, ir_version=ir_version,
+           clinical_report_version=clinical_report_version, testing_on=parsed_args.testing, session=session)
+    return 'closed', 'clinical report submitted' if reports == 0 else 'exit questionnaire submitted'
+
+
+def main(parsed_args):
+    cases = read_cases(parsed_args.cases)
+    closed = read_closed_cases(parsed_args.log)
+    to_close = [case for case in cases if case not in closed]
+    print('{} cases, {} already closed by previous runs, {} to check'.format(
+        len(cases), len(cases) - len(to_close), len(to_close)))
+    # Reports share their content, so validate it once and only check the per-case fields for each case
+    clinical_report_template = ClinicalReportTemplate(genomicInterpretation=GENOMIC_INTERPRETATION)
+    # The exit questionnaire is the same for every negative case, so it is built once
+    exit_questionnaire = ExitQuestionnaireTemplate(
+        familyLevelQuestions=create_flq(
+            caseSolvedFamily="no",
+            segregationQuestion="no",
+            additionalComments=GENOMIC_INTERPRETATION
+        )
+    ).build(eventDate=parsed_args.date, reporter=parsed_args.reporter)
+    # One authenticated session, with pooled connections, is shared by all workers
+    session = AuthenticatedCIPAPISession(testing_on=parsed_args.testing)
+    log = ResultLog(parsed_args.log)
+
+    def process(case):
+        try:
+            status, detail = close_case(case, clinical_report_template, exit_questionnaire, parsed_args, session)
+        except Exception as error:
+            status, detail = 'failed', '{}: {}'.format(type(error).__name__, error)
+        return log.write(case, status, detail)
+
+    with ThreadPoolExecutor(parsed_args.workers) as executor:
+        results = list(executor.map(process, to_close))
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    print('Results: {}'.format(', '.join('{} {}'.format(n, status) for status, n in sorted(counts.items()))))
+    return results
+
+
+if __name__ == '__main__':
+    # Parse arguments from the command line
+    parsed_args = parser_args()
+    # Set the JELLYPY_PROFILE environment variable to a directory to profile the run
+    with profile('neg_batch_closure'):
+        main(parsed_args)
@@ -2,8 +2,8 @@ import argparse
 import datetime
 import re
 import sys
-from jellypy.pyCIPAPI.interpretation_requests import get_interpretation_request_json
-from jellypy.pyCIPAPI.summary_findings import create_cr, post_cr, num_existing_reports, get_ref_db_versions, gel_software_versions
+from jellypy.pyCIPAPI.profiling import profile
+from jellypy.pyCIPAPI.summary_findings import get_closure_metadata, create_cr, post_cr, num_existing_reports, get_ref_db_versions, gel_software_versions
 
 
 def parser_args():
@@ -44,8 +44,11 @@ def main():
     parsed_args = parser_args()
     # Check interpretation request ID matches expected pattern, and split into ID and version
     ir_id, ir_version = get_request_details(parsed_args.interpretation_request)
-    # Get v6 of interpretation request JSON
-    ir_json_v6 = get_interpretation_request_json(ir_id, ir_version, reports_v6=True, testing_on=parsed_args.testing)
+    # Get the clinical reports, assembly and software versions from the minimised listing and tiering interpreted
+    # genome, rather than downloading the full v6 interpretation request JSON
+    ir_json_v6 = get_closure_metadata(ir_id, ir_version, testing_on=parsed_args.testing)
+    if ir_json_v6 is None:
+        sys.exit("Interpretation request {ir_id}-{ir_version} not found".format(ir_id=ir_id, ir_version=ir_version))
     # Check that there is not already an exisitng clinical report
     if num_existing_reports(ir_json_v6):
         sys.exit("Existing clinical reports detected for interpretation request {ir_id}-{ir_version}".format(
@@ -68,4 +71,6 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    # Set the JELLYPY_PROFILE environment variable to a directory to profile the run
+    with profile('neg_clinical_report'):
+        main()
@@ -1,48 +1,80 @@
+"""Audit the number of tier 1, 2 and 3 variants in every interpretation request.
+
+Interpretation requests are downloaded concurrently and cached in a local directory, so reruns only
+download cases updated since the last run. Each case is counted and dropped as soon as it arrives and
+its TSV line is written straight away, so memory use does not grow with the cohort size.
+"""
+import argparse
 import datetime
+from jellypy.pyCIPAPI.auth import AuthenticatedCIPAPISession
+from jellypy.pyCIPAPI.profiling import profile
 from jellypy.pyCIPAPI.interpretation_requests import (
-    get_interpretation_request_list, get_interpretation_request_json,
-    get_variant_tier, save_interpretation_request_list_json)
+    get_interpretation_request_list, iter_interpretation_request_json,
+    count_variant_tiers, save_interpretation_request_list_json)
+
+
+def parser_args():
+    """Parse arguments from the command line"""
+    parser = argparse.ArgumentParser(
+        description='Output a date stamped TSV of tiered variant counts for every interpretation request')
+    parser.add_argument('-w', '--workers', help='Number of interpretation requests downloaded at once',
+                        type=int, default=8)
+    parser.add_argument('-c', '--cache-dir', help='Directory for cached interpretation request json files',
+                        type=str, default='ir_cache')
+    parser.add_argument('-o', '--output', help='Output TSV file. Defaults to <date>_interpretation_request_audit.tsv',
+                        type=str)
+    parser.add_argument('-t', '--testing', help='Flag to use the CIP-API Beta data during testing', action='store_true')
+    return parser.parse_args()
 
 
-def _main():
-    interpretation_requests_list = get_interpretation_request_list()
-    for case in interpretation_requests_list:
-        count_tiered_variants(case)
-    output_tsv(interpretation_requests_list)
+def _main(parsed_args):
+    session = AuthenticatedCIPAPISession(testing_on=parsed_args.testing)
+    interpretation_requests_list = get_interpretation_request_list(testing_on=parsed_args.testing, session=session)
+    cases = iter_interpretation_request_json(interpretation_requests_list, max_workers=parsed_args.workers,
+                                             cache_dir=parsed_args.cache_dir, testing_on=parsed_args.testing,
+                                             session=session)
+    output_tsv((count_tiered_variants(case, interpretation_request) for case, interpretation_request in cases),
+               parsed_args.output)
     save_interpretation_request_list_json(interpretation_requests_list)
 
 
-def count_tiered_variants(case):
-    """Count the number of variants in each tier for a case."""
-    case['T1'] = 0
-    case['T2'] = 0
-    case['T3'] = 0
-    ir_id, ir_version = case['interpretation_request_id'].split('-')
-    interpretation_request = get_interpretation_request_json(ir_id, ir_version)
-    case['interpretation-request_data'] = interpretation_request
-    for variant in (interpretation_request['interpretation_request_data']
-                    ['json_request']['TieredVariants']):
-        tier = get_variant_tier(variant)
-        case['T{}'.format(tier)] += 1
+def count_tiered_variants(case, interpretation_request):
+    """Count the number of variants in each tier for a case.
+
+    Counts are added to the listing record. The interpretation request is not stored, so it can be freed
+    once counted. Counts are None if the interpretation request could not be downloaded.
+    """
+    if interpretation_request is None:
+        case.update({'T1': None, 'T2': None, 'T3': None})
+    else:
+        case.update(count_variant_tiers(interpretation_request))
+    return case
 
 
-def output_tsv(interpretation_requests_list):
-    """Output a date stamped TSV file of the interpretation_requests_list.
+def output_tsv(interpretation_requests, output_file=None):
+    """Output a date stamped TSV file of interpretation requests, writing each line as it is counted.
 
     Output file fields: Gel Family ID, Number of samples, Site(s), Sample Type,
     Tier 1, Tier 2, and Tier 3 variant counts.
     """
-    output_file = ('{}_interpretation_request_audit.tsv'
-                   .format(datetime.datetime.today().strftime('%Y%m%d')))
+    output_file = output_file or ('{}_interpretation_request_audit.tsv'
+                                  .format(datetime.datetime.today().strftime('%Y%m%d')))
     with open(output_file, 'w') as fout:
-        for case in interpretation_requests_list:
+        for count, case in enumerate(interpretation_requests, 1):
             line = ('\t'.join(
-                    [str(n) for n in [
+                    ['NA' if n is None else str(n) for n in [
                         case['family_id'], case['number_of_samples'],
                         ','.join(case['sites']), case['sample_type'],
                         case['T1'], case['T2'], case['T3']]]))
             fout.write(line + '\n')
+            if count % 100 == 0:
+                fout.flush()
+                print('{} interpretation requests counted'.format(count))
 
 
 if __name__ == '__main__':
-    _main()
+    # Parse arguments from the command line
+    parsed_args = parser_args()
+    # Set the JELLYPY_PROFILE environment variable to a directory to profile the run
+    with profile('variant_count_audit'):
+        _main(parsed_args)
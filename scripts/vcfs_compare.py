@@ -1,29 +1,49 @@
 #!/usr/bin/python
 """
- 
- Script to compare the variants in two vcf files, to ensure the 
- variants are the same. Everythig is compared but data in the 
+
+ Script to compare the variants in two vcf files, to ensure the
+ variants are the same. Everythig is compared but data in the
  info field
 
+ Both vcf files must be bgzipped and tabix indexed (tabix -p vcf file.vcf.gz).
+ The genome is split into region shards, one per contig or fixed size windows,
+ and each shard is compared in a worker process, streaming records from both
+ files in position order, so memory use does not grow with the file size.
+ Variants are matched by position, reference and alternate alleles. Records
+ repeating the position and alleles of an earlier record in the same file are
+ counted as duplicates.
+
 
  Kim Brugger (10 Jan 2018), contact: kim@brugger.dk
 """
 
 import sys
 import argparse
-import pprint
-pp = pprint.PrettyPrinter(indent=4)
+import itertools
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import pysam
 
 
+# INFO field added to records in the discordance vcf, holding the reason for the discordance
+DISCORDANCE_INFO = 'VCFS_COMPARE'
+
+# Summary counts, in the order they are reported. Duplicates are records with the same position and
+# alleles as an earlier record in the same vcf, which are not compared.
+SUMMARY_FIELDS = ['concordant', 'discordant', 'vcf1_only', 'vcf2_only', 'vcf1_duplicate', 'vcf2_duplicate']
+
 
 def handle_error( error, exit_on_error = False):
     """ Print the error, and if flag is set exits
 
     Args:
        error (str): error string to print
-       exit_on_error (bool): default false, if true terminates the program after printing the error 
+       exit_on_error (bool): default false, if true terminates the program after printing the error
 
     """
     print( "{}".format(error))
@@ -32,100 +52,309 @@ def handle_error( error, exit_on_error = False):
         exit(10)
 
 
+def compare_records( vcf1_rec, vcf2_rec, samples ):
+    """ compare two vcf records at the same position with the same alleles
+
+    Args:
+       vcf1_rec (obj): pysam vcf record from vcf file nr 1
+       vcf2_rec (obj): pysam vcf record from vcf file nr 2
+       samples (list): sample names to compare
+
+    Returns:
+       list of names of the fields that differ
+    """
+    errors = []
+
+    if ( vcf1_rec.id != vcf2_rec.id ):
+        errors.append('ID')
+
+    # Some odd rounding errors and making strings into float bug,
+    # so as long as the qual score is with in +/- 1 I am happy
+    # with it.
+    if ( (vcf1_rec.qual is None) != (vcf2_rec.qual is None) or
+         (vcf1_rec.qual is not None and abs(vcf1_rec.qual - vcf2_rec.qual) > 1) ):
+        errors.append('qual')
 
-def next_vcf_rec( vcf_handle ):
-    """ reads next vcf record, or returns none
+    if ( list(vcf1_rec.filter) != list(vcf2_rec.filter) ):
+        errors.append('filter')
+
+    if ( list(vcf1_rec.format) != list(vcf2_rec.format) ):
+        errors.append('format')
+
+    for sample in samples:
+        if ( dict(vcf1_rec.samples[ sample ]) != dict(vcf2_rec.samples[ sample ]) ):
+            errors.append('sample {}'.format( sample ))
+
+    return errors
+
+
+def fetch_records( vcf, contig, start = None, end = None ):
+    """ iterate over the records of a region, or nothing if the contig is not in the index
+
+    Only records starting in the region are returned, so a record overlapping two
+    regions belongs to the region containing its start.
 
     Args:
-      vcf_handle (obj): pysam vcf handle
+      vcf (obj): pysam vcf handle
+      contig (str): contig name
+      start (int): 0-based region start, or None for the start of the contig
+      end (int): 0-based exclusive region end, or None for the end of the contig
 
     """
     try:
-        vcf_rec = vcf_handle.next()
-        return vcf_rec
-    except:
-        return None
+        records = vcf.fetch( contig, start, end )
+    except ValueError:
+        return iter(())
+    if ( start is None ):
+        return records
+    return ( rec for rec in records if rec.start >= start )
+
+
+def _positions( records ):
+    """ group sorted vcf records by position, yielding (pos, {(ref, alts): record}, duplicates)
+
+    duplicates is a list of the records with the same alleles as an earlier record at the position
+    """
+    for pos, group in itertools.groupby( records, key=lambda rec: rec.pos ):
+        recs, duplicates = {}, []
+        for rec in group:
+            if ( (rec.ref, rec.alts) in recs ):
+                duplicates.append( rec )
+            else:
+                recs[ (rec.ref, rec.alts) ] = rec
+        yield pos, recs, duplicates
 
 
-def compare_vcfs( vcf_file1, vcf_file2, exit_on_error = False):
-    """ compare variants and sample information in two vcfs to ensure their integrity
-    
+def _discordance_line( vcf_rec, reason ):
+    """ return a vcf line for the record, with the discordance reason added to the INFO field """
+    fields = str( vcf_rec ).rstrip('\n').split('\t')
+    tag = '{}={}'.format( DISCORDANCE_INFO, reason.replace(' ', '_') )
+    fields[7] = tag if fields[7] == '.' else '{};{}'.format( fields[7], tag )
+    return '\t'.join( fields ) + '\n'
+
+
+def compare_region( vcf_file1, vcf_file2, contig, start = None, end = None, discordance_file = None ):
+    """ compare the variants of one region in two indexed vcfs
+
+    Records are streamed from both files in position order. Records at the same
+    position are matched by their reference and alternate alleles. A record with the
+    same position and alleles as an earlier record in its file is counted as a
+    duplicate rather than compared. Only the records at one position are held in
+    memory at a time.
+
     Args:
        vcf_file1 (str): filename of vcf file nr 1
        vcf_file2 (str): filename of vcf file nr 2
-       exit_on_error (bool): print error and exit program on first found error
-    
+       contig (str): contig to compare
+       start (int): 0-based region start, or None to compare the whole contig
+       end (int): 0-based exclusive region end, or None to compare to the end of the contig
+       discordance_file (str): if given, discordant records are written to this file as vcf lines
+
     Returns:
-       list of disconcodant variants
+       Counter of concordant, discordant, vcf1_only, vcf2_only, vcf1_duplicate and vcf2_duplicate
+       variants, and the number of discordances for each field
     """
-
     vcf1 = pysam.VariantFile( vcf_file1 )
     vcf2 = pysam.VariantFile( vcf_file2 )
+    samples = list( vcf1.header.samples )
+    counts = Counter()
+    discordances = open( discordance_file, 'w' ) if discordance_file else None
+
+    def discordant( vcf_rec, reason ):
+        if discordances:
+            discordances.write( _discordance_line( vcf_rec, reason ) )
+
+    def next_position( positions, duplicate ):
+        pos, recs, duplicates = next( positions, (None, None, ()) )
+        for vcf_rec in duplicates:
+            counts[ duplicate ] += 1
+            discordant( vcf_rec, duplicate )
+        return pos, recs
+
+    positions1 = _positions( fetch_records( vcf1, contig, start, end ) )
+    positions2 = _positions( fetch_records( vcf2, contig, start, end ) )
+    pos1, recs1 = next_position( positions1, 'vcf1_duplicate' )
+    pos2, recs2 = next_position( positions2, 'vcf2_duplicate' )
+
+    while ( pos1 is not None or pos2 is not None ):
+        if ( pos2 is None or (pos1 is not None and pos1 < pos2) ):
+            for vcf1_rec in recs1.values():
+                counts['vcf1_only'] += 1
+                discordant( vcf1_rec, 'vcf1_only' )
+            pos1, recs1 = next_position( positions1, 'vcf1_duplicate' )
+            continue
+
+        if ( pos1 is None or pos2 < pos1 ):
+            for vcf2_rec in recs2.values():
+                counts['vcf2_only'] += 1
+                discordant( vcf2_rec, 'vcf2_only' )
+            pos2, recs2 = next_position( positions2, 'vcf2_duplicate' )
+            continue
+
+        for alleles, vcf1_rec in recs1.items():
+            vcf2_rec = recs2.pop( alleles, None )
+            if ( vcf2_rec is None ):
+                counts['vcf1_only'] += 1
+                discordant( vcf1_rec, 'vcf1_only' )
+                continue
+            errors = compare_records( vcf1_rec, vcf2_rec, samples )
+            if ( errors ):
+                counts['discordant'] += 1
+                counts.update( 'field {}'.format( error ) for error in errors )
+                discordant( vcf1_rec, ','.join( errors ) )
+            else:
+                counts['concordant'] += 1
+        for vcf2_rec in recs2.values():
+            counts['vcf2_only'] += 1
+            discordant( vcf2_rec, 'vcf2_only' )
+        pos1, recs1 = next_position( positions1, 'vcf1_duplicate' )
+        pos2, recs2 = next_position( positions2, 'vcf2_duplicate' )
+
+    if discordances:
+        discordances.close()
+    return counts
+
+
+def _contigs( vcf1, vcf2 ):
+    """ contigs in either vcf, in vcf nr 1 header order followed by any only in vcf nr 2 """
+    contigs = list( vcf1.header.contigs )
+    seen = set( contigs )
+    return contigs + [ contig for contig in vcf2.header.contigs if contig not in seen ]
+
+
+def region_shards( vcf1, vcf2, shard_size = None ):
+    """ split the contigs of two vcfs into region shards
 
-    vcf1_samples = vcf1.header.samples
-    vcf2_samples = vcf2.header.samples
-
-    vcf1_rec = vcf1.next()
-    vcf2_rec = vcf2.next()
-            
-
-    if ( list(vcf1_samples) != list(vcf2_samples) ):
-        error  = "Sample name differs. VCF1: [{}], VCF2: [{}]".format(",".join(list(vcf1_samples)), ",".join(list(vcf2_samples)))
-#        errors = handle_error( error, errors, exit_on_error  )
-
-    while ( vcf1_rec is not None and vcf2_rec is not None ):
+    Args:
+       vcf1 (obj): pysam vcf handle for vcf file nr 1
+       vcf2 (obj): pysam vcf handle for vcf file nr 2
+       shard_size (int): shard length in bases. If None, or for contigs without a length
+                         in either header, each contig is one shard.
 
-        error_string= "{type}\n[%s]\n[%s]" % (vcf1_rec, vcf2_rec)
-#        print error_string
-        errors = []
-        # Check on the various fields and append to the error list that is printed later on.
-        if ( vcf1_rec.chrom != vcf2_rec.chrom ):
-            errors.append('chromosome')
+    Returns:
+       list of (contig, start, end) tuples in contig and position order. start and end are
+       None for whole contig shards.
+    """
+    shards = []
+    for contig in _contigs( vcf1, vcf2 ):
+        length = None
+        for vcf in (vcf1, vcf2):
+            if ( contig in vcf.header.contigs and vcf.header.contigs[ contig ].length ):
+                length = max( length or 0, vcf.header.contigs[ contig ].length )
+        if ( shard_size is None or length is None ):
+            shards.append( (contig, None, None) )
+            continue
+        for start in range( 0, length, shard_size ):
+            # The last shard runs to the end of the contig, in case records lie beyond the header length
+            end = start + shard_size if start + shard_size < length else None
+            shards.append( (contig, start, end) )
+    return shards
+
+
+def _compare_region( args ):
+    """ compare_region for a tuple of arguments. Runs in a worker process """
+    return compare_region( *args )
+
+
+def _progress( done, total, variants, started ):
+    """ print comparison progress to stderr """
+    elapsed = time.time() - started
+    sys.stderr.write( "Compared {}/{} shards ({:.1f}%), {} variants in {:.0f}s\n".format(
+        done, total, 100.0 * done / total, variants, elapsed ) )
+
+
+def compare_vcfs( vcf_file1, vcf_file2, processes = None, discordance_vcf = None, shard_size = None,
+                  progress = False ):
+    """ compare variants and sample information in two indexed vcfs to ensure their integrity
+
+    The genome is split into region shards that are compared in parallel worker processes.
+    Results are merged in shard order, so the summary and discordance vcf do not depend on
+    the number of processes or the order shards finish in.
 
-        if ( vcf1_rec.pos != vcf2_rec.pos ):
-            errors.append('chromosome')
+    Args:
+       vcf_file1 (str): filename of vcf file nr 1
+       vcf_file2 (str): filename of vcf file nr 2
+       processes (int): number of worker processes, defaults to the number of cpus
+       discordance_vcf (str): if given, write discordant records to this vcf file
+       shard_size (int): shard length in bases, defaults to one shard per contig
+       progress (bool): print progress to stderr as shards finish
 
-        if ( vcf1_rec.id != vcf2_rec.id ):
-            errors.append('ID')
+    Returns:
+       Counter of concordant, discordant, vcf1_only, vcf2_only, vcf1_duplicate and vcf2_duplicate
+       variants, and the number of discordances for each field
+    """
 
-        if ( vcf1_rec.alts != vcf2_rec.alts ):
-            errors.append('Alts')
+    vcf1 = pysam.VariantFile( vcf_file1 )
+    vcf2 = pysam.VariantFile( vcf_file2 )
 
-        # Some odd rounding errors and making strings into float bug,
-        # so as long as the qual score is with in +/- 1 I am happy
-        # with it.
-        if ( abs(vcf1_rec.qual - vcf2_rec.qual) > 1 ):
-            if ( vcf1_rec.qual != vcf2_rec.qual ):
-                errors.append('qual')
+    vcf1_samples = list( vcf1.header.samples )
+    vcf2_samples = list( vcf2.header.samples )
 
-            if ( vcf1_rec.filter != vcf2_rec.filter ):
-                errors.append('filter')
+    if ( vcf1_samples != vcf2_samples ):
+        handle_error( "Sample name differs. VCF1: [{}], VCF2: [{}]".format(",".join(vcf1_samples), ",".join(vcf2_samples)), True )
 
-            if ( list(vcf1_rec.format) != list(vcf2_rec.format) ):
-                errors.append('format')
+    for vcf_file, vcf in ((vcf_file1, vcf1), (vcf_file2, vcf2)):
+        if ( vcf.index is None ):
+            handle_error( "{} has no tabix index, create one with: tabix -p vcf {}".format( vcf_file, vcf_file ), True )
 
-            for sample in vcf1_samples:
-                if ( vcf1_rec.samples[ sample] != vcf2_rec.samples[ sample] ):
-                    errors.append('sample {}'.format( sample ))
+    shards = region_shards( vcf1, vcf2, shard_size )
+    tmpdir = tempfile.mkdtemp() if discordance_vcf else None
+    parts = [ os.path.join( tmpdir, '{}.vcf'.format( index ) ) if tmpdir else None for index in range( len( shards ) ) ]
 
-            if (errors ):
-                errors = handle_error( error_string.format( type="Error(s) on: {}".format( ", ".join(errors))), exit_on_error  )
+    shard_counts = [ None ] * len( shards )
+    started = time.time()
+    try:
+        with ProcessPoolExecutor( processes ) as executor:
+            futures = {
+                executor.submit( _compare_region, (vcf_file1, vcf_file2) + shard + (part,) ): index
+                for index, (shard, part) in enumerate( zip( shards, parts ) )
+            }
+            variants, reported = 0, started
+            for done, future in enumerate( as_completed( futures ), 1 ):
+                shard_counts[ futures[ future ] ] = future.result()
+                variants += sum( future.result()[ field ] for field in SUMMARY_FIELDS )
+                # Report at most once a second, and when the last shard is done
+                if ( progress and (time.time() - reported >= 1 or done == len( shards )) ):
+                    _progress( done, len( shards ), variants, started )
+                    reported = time.time()
+
+        # Merge shard results in shard order
+        counts = Counter()
+        for region_counts in shard_counts:
+            counts.update( region_counts )
+
+        if ( discordance_vcf ):
+            header = vcf1.header.copy()
+            header.add_line( '##INFO=<ID={},Number=1,Type=String,Description="Reason the variant is '
+                             'discordant: fields that differ, vcf1_only, vcf2_only, vcf1_duplicate or vcf2_duplicate">'.format( DISCORDANCE_INFO ) )
+            with open( discordance_vcf, 'w' ) as out:
+                out.write( str( header ) )
+                for part in parts:
+                    with open( part ) as part_file:
+                        shutil.copyfileobj( part_file, out )
+    finally:
+        if ( tmpdir ):
+            shutil.rmtree( tmpdir )
+
+    return counts
+
+
+def format_summary( counts ):
+    """ return a compact tab separated summary of comparison counts """
+    lines = [ '{}\t{}'.format( field, counts[ field ] ) for field in SUMMARY_FIELDS ]
+    lines += [ '{}\t{}'.format( field, counts[ field ] ) for field in sorted( counts ) if field.startswith( 'field ' ) ]
+    return '\n'.join( lines )
 
-                
-        # Track the positions in the vcf files so one does not come ahead of the other 
-        if ( vcf1_rec.pos > vcf2_rec.pos ):
-            vcf2_rec = next_vcf_rec(vcf2 )
-        elif( vcf1_rec.pos < vcf2_rec.pos ):
-            vcf1_rec = next_vcf_rec( vcf1 )
-        else:
-            vcf1_rec = next_vcf_rec( vcf1 )
-            vcf2_rec = next_vcf_rec( vcf2 )
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='vcf_integrity_check: checks the variants and sample information in two vcf files are identical ')
 
-    parser.add_argument('-e', '--exit-on-error', action="store_true", default=False,  help="exit on first error observed, defualt FALSE")
-    parser.add_argument('vcf_file', metavar='vcf-file', nargs=2,   help="vcf files compare")
+    parser.add_argument('-e', '--exit-on-error', action="store_true", default=False,  help="exit with status 10 if any discordant variants are found, defualt FALSE")
+    parser.add_argument('-p', '--processes', type=int, default=None, help="number of worker processes, defaults to the number of cpus")
+    parser.add_argument('-d', '--discordance-vcf', default=None, help="write discordant variants to this vcf file")
+    parser.add_argument('-s', '--shard-mb', type=float, default=None, help="compare the genome in region shards of this many megabases, default one shard per chromosome")
+    parser.add_argument('-q', '--quiet', action="store_true", default=False, help="do not print progress to stderr")
+    parser.add_argument('vcf_file', metavar='vcf-file', nargs=2,   help="bgzipped and tabix indexed vcf files compare")
 
     args = parser.parse_args()
 
@@ -133,5 +362,10 @@ if __name__ == '__main__':
     vcf1 = args.vcf_file[ 0 ]
     vcf2 = args.vcf_file[ 1 ]
 
-    compare_vcfs( vcf1, vcf2, args.exit_on_error)
+    shard_size = int( args.shard_mb * 1000000 ) if args.shard_mb else None
+
+    counts = compare_vcfs( vcf1, vcf2, args.processes, args.discordance_vcf, shard_size, progress = not args.quiet )
+    print( format_summary( counts ) )
 
+    if ( args.exit_on_error and any( counts[ field ] for field in SUMMARY_FIELDS[1:] ) ):
+        sys.exit(10)
@@ -1,7 +1,15 @@
 # content of conftest.py
+import pathlib
+
 import pytest
 from configparser import ConfigParser
 
+from jellypy.tierup import panelapp
+
+
+# A small snapshot of the PanelApp panels used by the tests, so they run offline by default
+TEST_SNAPSHOT = pathlib.Path(__file__).parent / "test" / "test_data" / "panelapp.snapshot"
+
 
 def read_config(ini_path):
     config = ConfigParser()
@@ -13,8 +21,48 @@ def pytest_addoption(parser):
     parser.addoption(
         "--jpconfig", action="store", type=read_config, help="JellyPy config ini file"
     )
+    parser.addoption(
+        "--panelapp-snapshot", action="store", default=str(TEST_SNAPSHOT),
+        help="PanelApp snapshot file. Tests read PanelApp data from this file instead of the API. "
+             "Defaults to the snapshot in test/test_data."
+    )
+    parser.addoption(
+        "--panelapp-live", action="store_true",
+        help="Read PanelApp data from the PanelApp API instead of a snapshot"
+    )
+    parser.addoption(
+        "--run-benchmarks", action="store_true",
+        help="Run the benchmarks in test_benchmark.py, which are skipped by default"
+    )
+    parser.addoption(
+        "--update-benchmark-baseline", action="store_true",
+        help="Write benchmark events per second and memory peaks to the baseline file instead of checking them"
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: slow benchmark, only run with --run-benchmarks")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--run-benchmarks") or config.getoption("--update-benchmark-baseline"):
+        return
+    skip = pytest.mark.skip(reason="benchmark: pass --run-benchmarks to run")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
 
 
 @pytest.fixture
 def jpconfig(request):
     return request.config.getoption("--jpconfig")
+
+
+@pytest.fixture(autouse=True)
+def panelapp_snapshot(request):
+    if not request.config.getoption("--panelapp-live"):
+        panelapp.use_snapshot(request.config.getoption("--panelapp-snapshot"))
+    yield
+    panelapp.use_snapshot(None)
+    panelapp.use_gene_table(None)
+    panelapp.use_panel_cache(None)
@@ -0,0 +1,107 @@
+"""A persistent reverse index from PanelApp panel genes to TierUp report events.
+
+The index answers the question "which cases does a PanelApp update affect?". Keys are a PanelApp
+panel id and an Ensembl gene id. Values are the interpretation request ids and report event ids
+for proband report events in that gene and panel.
+
+>>> index = PanelEventIndex('tierup_index.json')
+>>> index.add(irjo)
+>>> index.save()
+>>> index.lookup(123, 'ENSG00000139567')
+[('1234-1', 'RE999')]
+"""
+import json
+import logging
+import pathlib
+
+from jellypy.tierup.irtools import IRJson
+from jellypy.tierup.lib import TierUpRunner
+from jellypy.tierup.panelapp import GeLPanel, diff_panels
+
+logger = logging.getLogger(__name__)
+
+
+class PanelEventIndex:
+    """Reverse index mapping (panel id, ensembl id) keys to (irid, report event id) pairs.
+
+    Args:
+        path(str): Path to the index json file. The index is loaded from this file if it exists.
+    Attributes:
+        events(dict): 'panel_id:ensembl_id' keys mapped to lists of [irid, report event id] pairs
+        cases(dict): Interpretation request ids mapped to the index keys added for that case. This
+            allows a case to be re-indexed without leaving stale entries behind.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.events = {}
+        self.cases = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.events, self.cases = data["events"], data["cases"]
+
+    @staticmethod
+    def _key(panel_id, ensembl_id):
+        return f"{panel_id}:{ensembl_id}"
+
+    def add(self, irjo: IRJson, runner=None):
+        """Add proband report events from an interpretation request to the index.
+
+        Any entries from a previous index of the same interpretation request are replaced.
+
+        Args:
+            irjo: An interpretation request json object
+            runner: A TierUpRunner instance used to find proband report events
+        """
+        runner = runner or TierUpRunner()
+        self.remove(irjo.irid)
+        keys = []
+        for event in runner._get_proband_report_events(irjo):
+            panel = irjo.panels.get(event.panelname)
+            if panel is None:
+                logger.warning(f'Not indexing {event.data["reportEventId"]}: No panel for {event.panelname}')
+                continue
+            key = self._key(panel.id, event.ensembl)
+            entry = [irjo.irid, event.data["reportEventId"]]
+            if entry not in self.events.setdefault(key, []):
+                self.events[key].append(entry)
+            keys.append(key)
+        self.cases[irjo.irid] = sorted(set(keys))
+
+    def remove(self, irid):
+        """Remove all entries for an interpretation request id from the index."""
+        for key in self.cases.pop(irid, []):
+            remaining = [entry for entry in self.events.get(key, []) if entry[0] != irid]
+            if remaining:
+                self.events[key] = remaining
+            else:
+                self.events.pop(key, None)
+
+    def lookup(self, panel_id, ensembl_id) -> list:
+        """Return a list of (irid, report event id) tuples for a panel id and ensembl gene id."""
+        return [tuple(entry) for entry in self.events.get(self._key(panel_id, ensembl_id), [])]
+
+    def save(self):
+        """Write the index to its json file."""
+        with open(self.path, "w") as f:
+            json.dump({"events": self.events, "cases": self.cases}, f)
+
+
+def changed_genes(old: GeLPanel, new: GeLPanel) -> dict:
+    """Compare the gene lists of two versions of a panel.
+
+    A summary of panelapp.diff_panels, which gives the old and new value of each change.
+
+    Args:
+        old: The earlier version of a PanelApp panel
+        new: The later version of a PanelApp panel
+    Returns:
+        A dictionary mapping ensembl gene ids to a change label: 'added', 'removed' or 'changed'.
+            Genes are 'changed' if their confidence level or mode of inheritance differs.
+    """
+    changes = {}
+    for change in diff_panels(old, new):
+        for ensembl_id in change.ensembl_ids:
+            changes[ensembl_id] = change.change if change.change in ('added', 'removed') else 'changed'
+    return changes
@@ -1,10 +1,14 @@
 import click
 import configparser
 import logging
+import multiprocessing
+import pathlib
 import pkg_resources
 
 import jellypy.tierup.main
 
+from jellypy.pyCIPAPI import profiling
+from jellypy.tierup import jobqueue, panelapp, pipeline
 from jellypy.tierup.logger import log_setup
 
 
@@ -44,9 +48,257 @@ def parse_config(ctx: click.Context, param, value) -> configparser.ConfigParser:
 @click.option(
     "-o", "--outdir", type=click.Path(), help="Output directory for tierup files", default=""
 )
+@click.option(
+    "-x", "--index", type=click.Path(), help="Add report events to a panel event index file. E.g. tierup_index.json"
+)
+@click.option(
+    "-s", "--snapshot", type=click.Path(exists=True), help="Read PanelApp data from a snapshot file"
+)
+@click.option(
+    "-g", "--gene-table", type=click.Path(exists=True), help="Read panel genes from a compact gene table file"
+)
+@click.option(
+    "-m", "--metrics-file", type=click.Path(), help="Write run metrics to a Prometheus text file. E.g. tierup.prom"
+)
+@click.option(
+    "-p", "--profile", type=click.Path(),
+    help=f"Write cProfile stats and a memory report for the case to a directory. Defaults to ${profiling.PROFILE_ENV}"
+)
 @click.version_option(version=pkg_resources.require("jellypy_tierup")[0].version)
-def cli(config: str, irid: int, irversion: int, irjson: str, outdir: str):
+def cli(
+    config: str, irid: int, irversion: int, irjson: str, outdir: str, index: str, snapshot: str, gene_table: str,
+    metrics_file: str, profile: str
+):
     """Parse command line arguments and run TierUp."""
-    logger.info(f'CLI args: {config[0]}, {irid}, {irversion}, {irjson}, {outdir}')
-    jellypy.tierup.main.main(config[1], outdir, irid_irversion=(irid, irversion), irjson=irjson)
+    logger.info(
+        f'CLI args: {config[0]}, {irid}, {irversion}, {irjson}, {outdir}, {index}, {snapshot}, {gene_table}, '
+        f'{metrics_file}, {profile}'
+    )
+    panelapp.use_snapshot(snapshot)
+    panelapp.use_gene_table(gene_table)
+    case_name = pathlib.Path(irjson).stem if irjson else f'{irid}-{irversion}'
+    with profiling.profile(f'tierup_{case_name}', output_dir=profile):
+        jellypy.tierup.main.main(
+            config[1], outdir, irid_irversion=(irid, irversion), irjson=irjson, index=index, metrics_file=metrics_file
+        )
+
+@click.command()
+@click.option(
+    "-x", "--index", type=click.Path(exists=True), help="A panel event index file. E.g. tierup_index.json",
+    required=True
+)
+@click.option(
+    "-p", "--panel", type=click.STRING, help="PanelApp panel ID. E.g. 123", required=True
+)
+@click.option(
+    "-f", "--from-version", type=click.STRING, help="Panel version to compare against. E.g. 1.2", required=True
+)
+@click.option(
+    "-t", "--to-version", type=click.STRING, help="Updated panel version. Defaults to the latest version"
+)
+@click.option(
+    "-d", "--irjson-dir", type=click.Path(exists=True),
+    help="Directory of interpretation request json files. If given, impacted report events are retiered."
+)
+@click.option(
+    "-c", "--cache-dir", type=click.Path(), help="Directory for caching PanelApp panel versions"
+)
+@click.option(
+    "-o", "--outdir", type=click.Path(), help="Output directory for tierup files", default=""
+)
+@click.version_option(version=pkg_resources.require("jellypy_tierup")[0].version)
+def panel_update_cli(
+    index: str, panel: str, from_version: str, to_version: str, irjson_dir: str, cache_dir: str, outdir: str
+):
+    """Find, and optionally retier, report events affected by a PanelApp panel update."""
+    logger.info(f'CLI args: {index}, {panel}, {from_version}, {to_version}, {irjson_dir}, {cache_dir}, {outdir}')
+    jellypy.tierup.main.panel_update(
+        index, panel, from_version, to_version, outdir, irjson_dir=irjson_dir, cache_dir=cache_dir
+    )
 
+@click.command()
+@click.option(
+    "-o", "--output", type=click.Path(), help="Output snapshot file path", default="panelapp.snapshot"
+)
+@click.option(
+    "--head", type=click.INT, help="Limit the number of panels exported. Useful for testing."
+)
+@click.option(
+    "-p", "--panel", type=click.INT, multiple=True, help="Only export this PanelApp panel id. Can be repeated."
+)
+@click.option(
+    "-g", "--gene-table", type=click.Path(), help="Also write a compact gene table file from the snapshot"
+)
+@click.version_option(version=pkg_resources.require("jellypy_tierup")[0].version)
+def snapshot_cli(output: str, head: int, panel: tuple, gene_table: str):
+    """Export all PanelApp panels to a snapshot file for offline TierUp runs."""
+    logger.info(f'CLI args: {output}, {head}, {panel}, {gene_table}')
+    panelapp.PanelAppSnapshot.export(output, head=head, panel_ids=panel)
+    logger.info(f'PanelApp snapshot written to {output}')
+    if gene_table:
+        panelapp.PanelGeneTable.from_snapshot(output, gene_table)
+        logger.info(f'Gene table written to {gene_table}')
+
+@click.command()
+@click.option(
+    "-c", "--config", type=click.Path(exists=True), callback=parse_config,
+    help="A jellypy.tierup config file path", required=True
+)
+@click.option(
+    "--host", type=click.STRING, help="Host address to bind", default="127.0.0.1"
+)
+@click.option(
+    "--port", type=click.INT, help="Port to bind", default=8080
+)
+@click.option(
+    "-w", "--workers", type=click.INT, help="Number of cases retiered at once", default=4
+)
+@click.option(
+    "--panel-ttl", type=click.FLOAT, help="Seconds before the latest version of a panel is fetched again",
+    default=3600
+)
+@click.option(
+    "-s", "--snapshot", type=click.Path(exists=True), help="Read PanelApp data from a snapshot file"
+)
+@click.option(
+    "-g", "--gene-table", type=click.Path(exists=True), help="Read panel genes from a compact gene table file"
+)
+@click.version_option(version=pkg_resources.require("jellypy_tierup")[0].version)
+def service_cli(
+    config: str, host: str, port: int, workers: int, panel_ttl: float, snapshot: str, gene_table: str
+):
+    """Run TierUp as an HTTP service with warm sessions and panel caches."""
+    logger.info(f'CLI args: {config[0]}, {host}, {port}, {workers}, {panel_ttl}, {snapshot}, {gene_table}')
+    panelapp.use_snapshot(snapshot)
+    panelapp.use_gene_table(gene_table)
+    # Imported here so the HTTP server is only loaded by the service command
+    from jellypy.tierup import service
+    service.TierUpService(config[1], workers=workers, panel_ttl=panel_ttl).serve(host=host, port=port)
+
+@click.group()
+@click.version_option(version=pkg_resources.require("jellypy_tierup")[0].version)
+def queue_cli():
+    """Run TierUp for a cohort from a persistent job queue."""
+
+@queue_cli.command("add")
+@click.option(
+    "-q", "--queue", type=click.Path(), help="Job queue database file. E.g. cohort.db", required=True
+)
+@click.option(
+    "-f", "--cases-file", type=click.File(), help="File listing one case per line"
+)
+@click.argument("cases", nargs=-1)
+def queue_add_cli(queue: str, cases_file, cases: tuple):
+    """Add cases to the queue. Cases are irid-irversion strings (e.g. 1234-1) or IR json file paths."""
+    cases = list(cases) + ([line.strip() for line in cases_file if line.strip()] if cases_file else [])
+    added = jobqueue.JobQueue(queue).add(*cases)
+    logger.info(f'Added {added} of {len(cases)} cases to {queue}')
+
+@queue_cli.command("work")
+@click.option(
+    "-q", "--queue", type=click.Path(exists=True), help="Job queue database file. E.g. cohort.db", required=True
+)
+@click.option(
+    "-c", "--config", type=click.Path(exists=True), callback=parse_config,
+    help="A jellypy.tierup config file path", required=True
+)
+@click.option(
+    "-o", "--outdir", type=click.Path(), help="Output directory for tierup files", default=""
+)
+@click.option(
+    "-n", "--processes", type=click.INT, help="Number of worker processes to start", default=1
+)
+@click.option(
+    "--max-attempts", type=click.INT, help="Attempts for each case before it is marked failed", default=3
+)
+@click.option(
+    "-s", "--snapshot", type=click.Path(exists=True), help="Read PanelApp data from a snapshot file"
+)
+@click.option(
+    "-g", "--gene-table", type=click.Path(exists=True), help="Read panel genes from a compact gene table file"
+)
+def queue_work_cli(
+    queue: str, config: str, outdir: str, processes: int, max_attempts: int, snapshot: str, gene_table: str
+):
+    """Run jobs from the queue until no jobs are left. Start on several nodes to scale out."""
+    logger.info(f'CLI args: {queue}, {config[0]}, {outdir}, {processes}, {max_attempts}, {snapshot}, {gene_table}')
+    panelapp.use_snapshot(snapshot)
+    panelapp.use_gene_table(gene_table)
+    job_queue = jobqueue.JobQueue(queue, max_attempts=max_attempts)
+    workers = [
+        multiprocessing.Process(target=job_queue.work, args=(config[1], outdir)) for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    logger.info(f'Queue status: {job_queue.status()}')
+
+@queue_cli.command("status")
+@click.option(
+    "-q", "--queue", type=click.Path(exists=True), help="Job queue database file. E.g. cohort.db", required=True
+)
+@click.option(
+    "--retry-failed", is_flag=True, help="Return failed cases to the queue"
+)
+def queue_status_cli(queue: str, retry_failed: bool):
+    """Print job counts for each state and errors for failed cases."""
+    job_queue = jobqueue.JobQueue(queue)
+    for case_id, attempts, error in job_queue.failures():
+        click.echo(f'{case_id}\tfailed after {attempts} attempts\t{error}')
+    if retry_failed:
+        click.echo(f'Requeued {job_queue.retry_failed()} failed cases')
+    for state in jobqueue.STATES:
+        click.echo(f'{state}\t{job_queue.status().get(state, 0)}')
+
+@click.command()
+@click.option(
+    "-c", "--config", type=click.Path(exists=True), callback=parse_config,
+    help="A jellypy.tierup config file path", required=True
+)
+@click.option(
+    "-f", "--cases-file", type=click.File(), help="File listing one case per line"
+)
+@click.option(
+    "-o", "--outdir", type=click.Path(), help="Output directory for tierup files", default=""
+)
+@click.option(
+    "--fetch-workers", type=click.INT, help="Threads downloading interpretation requests", default=8
+)
+@click.option(
+    "--validate-workers", type=click.INT, help="Processes validating interpretation requests. Defaults to the CPU count"
+)
+@click.option(
+    "--retier-workers", type=click.INT, help="Threads retiering cases", default=2
+)
+@click.option(
+    "--queue-size", type=click.INT, help="Maximum cases waiting between pipeline stages", default=16
+)
+@click.option(
+    "-s", "--snapshot", type=click.Path(exists=True), help="Read PanelApp data from a snapshot file"
+)
+@click.option(
+    "-g", "--gene-table", type=click.Path(exists=True), help="Read panel genes from a compact gene table file"
+)
+@click.argument("cases", nargs=-1)
+@click.version_option(version=pkg_resources.require("jellypy_tierup")[0].version)
+def batch_cli(
+    config: str, cases_file, outdir: str, fetch_workers: int, validate_workers: int, retier_workers: int,
+    queue_size: int, snapshot: str, gene_table: str, cases: tuple
+):
+    """Run TierUp for many cases. Cases are irid-irversion strings (e.g. 1234-1) or IR json file paths."""
+    cases = list(cases) + ([line.strip() for line in cases_file if line.strip()] if cases_file else [])
+    logger.info(
+        f'CLI args: {config[0]}, {len(cases)} cases, {outdir}, {fetch_workers}, {validate_workers}, '
+        f'{retier_workers}, {queue_size}, {snapshot}, {gene_table}'
+    )
+    panelapp.use_snapshot(snapshot)
+    panelapp.use_gene_table(gene_table)
+    # Panels are shared by many cases in a batch, so keep them for the length of the run
+    panelapp.use_panel_cache(float("inf"))
+    result = pipeline.Pipeline(
+        config[1], outdir, fetch_workers=fetch_workers, validate_workers=validate_workers,
+        retier_workers=retier_workers, queue_size=queue_size
+    ).run(cases)
+    for case, (stage, error) in sorted(result["failed"].items()):
+        logger.error(f'{case} failed at {stage}: {error}')
@@ -116,7 +116,7 @@ class IRJson:
         proband_id(str): The proband GeL ID
         tiering(dict): The GeL interpreted genome with tiering pipeline data
         panels(dict): name:jellypy.tierup.panelapp.GeLPanel objects for each panel in the
-            interpretation request metadata
+            interpretation request metadata. These are CompactPanel objects if a gene table is in use.
         updated_panels(list): A list of panel ids added to self.panels using `self.update_panel()`.
     Methods:
         update_panel: Assign a more recent PanelApp ID to a panel in the interpretation request
@@ -156,7 +156,7 @@ class IRJson:
         ]
         for item in data:
             try:
-                panel = pa.GeLPanel(item["panelName"])
+                panel = pa.get_panel(item["panelName"])
                 _panels[panel.name] = panel
             except requests.HTTPError:
                 logger.warning(f"Warning. No PanelApp API reponse for {item}")
@@ -164,7 +164,7 @@ class IRJson:
 
     def update_panel(self, panel_name, panel_id):
         """Add or update a panel name in self.panels using a GeL panel app ID."""
-        new_panel = pa.GeLPanel(panel_id)
+        new_panel = pa.get_panel(panel_id)
         self.panels[panel_name] = new_panel
         self.updated_panels.append(f"{panel_name}, {panel_id}")
 
@@ -199,10 +199,12 @@ class IRJIO:
         Returns:
             An IRJson object
         """
-        json_response = irs.get_interpretation_request_json(
-            irid, irversion, reports_v6=True, session=session
-        )
-        return IRJson(json_response)
+        return IRJson(cls.get_json(irid, irversion, session))
+
+    @classmethod
+    def get_json(cls, irid: int, irversion: int, session: AuthenticatedCIPAPISession) -> dict:
+        """Get interpretation request json data from the CIPAPI without parsing it into an IRJson object"""
+        return irs.get_interpretation_request_json(irid, irversion, reports_v6=True, session=session)
 
     @classmethod
     def read(cls, filepath: str) -> IRJson:
@@ -212,8 +214,13 @@ class IRJIO:
             filepath: Path to interpretation request json file
         Returns:
             An IRJson object"""
+        return IRJson(cls.read_json(filepath))
+
+    @classmethod
+    def read_json(cls, filepath: str) -> dict:
+        """Read interpretation request json data from a file without parsing it into an IRJson object"""
         with open(filepath, "r") as f:
-            return IRJson(json.load(f))
+            return json.load(f)
 
     @classmethod
     def save(cls, irjson: IRJson, filename: str = None, outdir: str = ""):
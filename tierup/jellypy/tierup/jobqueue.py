@@ -0,0 +1,264 @@
+"""A persistent SQLite job queue for running TierUp on large cohorts.
+
+Each case is a job in one of four states: pending, running, done or failed. Workers claim jobs
+atomically, so any number of worker processes, on one machine or on several nodes sharing a
+filesystem, can pull from the same queue. Failed jobs are retried with exponential backoff. A job is
+marked done only after its results file has been written, so a restarted run skips completed cases
+and picks up where it stopped. Jobs held by a worker that died are claimed again once their lease
+expires, counting as another attempt. A worker whose lease has expired can no longer complete or fail
+its job, so a reclaimed job is only finished once.
+
+>>> queue = JobQueue('cohort.db')
+>>> queue.add('1234-1')
+>>> queue.add('jsons/5678-1.json')
+>>> queue.work(config, outdir='results/')
+>>> queue.status()
+{'done': 2}
+"""
+import logging
+import os
+import pathlib
+import socket
+import sqlite3
+import time
+
+from collections import Counter
+
+from jellypy.tierup import main
+
+logger = logging.getLogger(__name__)
+
+STATES = ('pending', 'running', 'done', 'failed')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    case_id TEXT PRIMARY KEY,
+    irjson TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    worker TEXT,
+    started REAL,
+    finished REAL,
+    output TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, not_before);
+"""
+
+
+class JobQueue():
+    """A TierUp job queue stored in an SQLite database file.
+
+    Args:
+        path(str): Path to the queue database. Created if it does not exist.
+        max_attempts(int): Attempts for each job before it is marked failed
+        backoff(float): Seconds before the first retry of a failed job. Doubles with each attempt.
+        lease(float): Seconds after which a running job is assumed lost and can be claimed again
+    """
+
+    def __init__(self, path, max_attempts=3, backoff=60, lease=3600):
+        self.path = str(path)
+        self.max_attempts, self.backoff, self.lease = max_attempts, backoff, lease
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        # isolation_level=None leaves transactions to explicit BEGIN statements. A long timeout lets
+        #   workers wait for each other's short write transactions.
+        return _Connection(sqlite3.connect(self.path, timeout=60, isolation_level=None))
+
+    @staticmethod
+    def case_id(case):
+        """Return the job id for a case: the irid-irversion string, or the file name of an IR json file."""
+        return pathlib.Path(case).stem if case.endswith('.json') else case
+
+    def add(self, *cases):
+        """Add cases to the queue. Cases already in the queue are left unchanged.
+
+        Args:
+            cases: Interpretation request ids and versions e.g. "1234-1", or paths to IR json files
+        Returns:
+            The number of jobs added
+        """
+        rows = [
+            (self.case_id(case), os.path.abspath(case) if case.endswith('.json') else None) for case in cases
+        ]
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            before = db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+            db.executemany('INSERT OR IGNORE INTO jobs (case_id, irjson) VALUES (?, ?)', rows)
+            added = db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0] - before
+            db.execute('COMMIT')
+        return added
+
+    def claim(self, worker):
+        """Claim the next job that is ready to run.
+
+        Jobs whose lease expired on their last attempt are marked failed rather than claimed, so a case
+        that crashes its workers is not retried forever.
+
+        Returns:
+            A (case_id, irjson) tuple, or None if no job is ready
+        """
+        now = time.time()
+        with self._connect() as db:
+            # BEGIN IMMEDIATE takes the database write lock, so no other worker can claim the same job
+            db.execute('BEGIN IMMEDIATE')
+            db.execute(
+                "UPDATE jobs SET state = 'failed', finished = ?, error = 'Lease expired on the last attempt'"
+                " WHERE state = 'running' AND started < ? AND attempts >= ?",
+                (now, now - self.lease, self.max_attempts)
+            )
+            job = db.execute(
+                "SELECT case_id, irjson FROM jobs WHERE (state = 'pending' AND not_before <= ?)"
+                " OR (state = 'running' AND started < ?) ORDER BY not_before, rowid LIMIT 1",
+                (now, now - self.lease)
+            ).fetchone()
+            if job:
+                db.execute(
+                    "UPDATE jobs SET state = 'running', worker = ?, started = ?, attempts = attempts + 1"
+                    " WHERE case_id = ?",
+                    (worker, now, job[0])
+                )
+            db.execute('COMMIT')
+        return job
+
+    def complete(self, case_id, worker, output):
+        """Mark a job done, recording its results file.
+
+        Returns:
+            False if the worker no longer holds the job because its lease expired, otherwise True
+        """
+        with self._connect() as db:
+            return db.execute(
+                "UPDATE jobs SET state = 'done', finished = ?, output = ?, error = NULL"
+                " WHERE case_id = ? AND worker = ? AND state = 'running'",
+                (time.time(), str(output), case_id, worker)
+            ).rowcount == 1
+
+    def fail(self, case_id, worker, error):
+        """Record a job failure. The job is retried after a backoff delay until max_attempts is reached.
+
+        Returns:
+            The job's new state, 'pending' or 'failed', or None if the worker no longer holds the job
+            because its lease expired
+        """
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            job = db.execute(
+                "SELECT attempts FROM jobs WHERE case_id = ? AND worker = ? AND state = 'running'",
+                (case_id, worker)
+            ).fetchone()
+            if job is None:
+                db.execute('COMMIT')
+                return None
+            attempts = job[0]
+            if attempts < self.max_attempts:
+                state, not_before = 'pending', time.time() + self.backoff * 2 ** (attempts - 1)
+            else:
+                state, not_before = 'failed', 0
+            db.execute(
+                'UPDATE jobs SET state = ?, not_before = ?, finished = ?, error = ? WHERE case_id = ?',
+                (state, not_before, time.time(), str(error), case_id)
+            )
+            db.execute('COMMIT')
+        return state
+
+    def retry_failed(self):
+        """Return failed jobs to the pending state with their attempts reset. Returns the number of jobs."""
+        with self._connect() as db:
+            return db.execute(
+                "UPDATE jobs SET state = 'pending', attempts = 0, not_before = 0 WHERE state = 'failed'"
+            ).rowcount
+
+    def status(self):
+        """Return a dictionary of job counts for each state."""
+        with self._connect() as db:
+            return dict(db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def failures(self):
+        """Return (case_id, attempts, error) tuples for failed jobs."""
+        with self._connect() as db:
+            return db.execute(
+                "SELECT case_id, attempts, error FROM jobs WHERE state = 'failed' ORDER BY case_id"
+            ).fetchall()
+
+    def _next_ready(self):
+        """Return seconds until the next pending job is ready, or None if no jobs are pending or running."""
+        with self._connect() as db:
+            pending = db.execute(
+                "SELECT MIN(not_before) FROM jobs WHERE state = 'pending'"
+            ).fetchone()[0]
+            running = db.execute("SELECT MIN(started) FROM jobs WHERE state = 'running'").fetchone()[0]
+        waits = [wait for wait in (
+            pending - time.time() if pending is not None else None,
+            running + self.lease - time.time() if running is not None else None
+        ) if wait is not None]
+        return max(0, min(waits)) if waits else None
+
+    def work(self, config, outdir, worker=None, run=None, poll=10):
+        """Run jobs until the queue has no pending or running jobs.
+
+        Args:
+            config(dict): A config parser config object parsed from a jellypy config.ini
+            outdir(str): Output directory for tierup results
+            worker(str): A name for this worker. Defaults to the host name and process id.
+            run: Function called with (config, outdir, irid_irversion=, irjson=, session=) for each job.
+                Returns the results file path. Defaults to jellypy.tierup.main.run_case.
+            poll(float): Maximum seconds to wait before checking for jobs that are not ready yet
+        Returns:
+            A Counter of jobs completed and failed by this worker, and jobs it lost because their lease
+            expired before they finished
+        """
+        worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+        run = run or main.run_case
+        counts = Counter()
+        session = None
+        while True:
+            job = self.claim(worker)
+            if job is None:
+                wait = self._next_ready()
+                if wait is None:
+                    break
+                time.sleep(min(wait, poll) or 0.1)
+                continue
+            case_id, irjson = job
+            try:
+                if irjson is None:
+                    irid, irversion = case_id.split('-')
+                    session = main.cipapi_session(config, session)
+                    output = run(config, outdir, irid_irversion=(int(irid), int(irversion)), session=session)
+                else:
+                    output = run(config, outdir, irjson=irjson)
+            except Exception as error:
+                state = self.fail(case_id, worker, f'{type(error).__name__}: {error}')
+                if state is None:
+                    logger.warning(f'Job {case_id} failed after its lease expired and was claimed again: {error}')
+                    counts['lost'] += 1
+                else:
+                    logger.warning(f'Job {case_id} failed ({state}): {error}')
+                    counts['failed'] += 1
+            else:
+                if self.complete(case_id, worker, output):
+                    logger.info(f'Job {case_id} done: {output}')
+                    counts['done'] += 1
+                else:
+                    logger.warning(f'Job {case_id} finished after its lease expired and was claimed again')
+                    counts['lost'] += 1
+        return counts
+
+
+class _Connection():
+    """Context manager that closes an sqlite3 connection on exit, rolling back an open transaction."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, *exc):
+        if self.connection.in_transaction:
+            self.connection.execute('ROLLBACK')
+        self.connection.close()
@@ -1,4 +1,5 @@
 import datetime
+import functools
 import pkg_resources
 import json
 import logging
@@ -11,6 +12,12 @@ from jellypy.tierup.panelapp import PanelApp, GeLPanel
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def tierup_version():
+    """Return the installed jellypy-tierup version. Looked up once per process."""
+    return pkg_resources.require("jellypy-tierup")[0].version
+
+
 class ReportEvent:
     """Data objects for a GeL tiering report event.
 
@@ -144,7 +151,12 @@ class TieringLite():
     }
 
     def __init__(self):
-        pass
+        self._moi_patterns = {
+            moi: [re.compile(regex) for regex in regexes] for moi, regexes in self.MOI_REGEX.items()
+        }
+        # Results of _moi_match for each (tiering moi, panelapp moi) pair. There are few distinct
+        #   pairs, so each is only matched once per TieringLite instance.
+        self._moi_matches = {}
 
     def _moi_match(self, tiering_moi, pa_moi):
         """Match a variant's mode of inheritance (tiering_moi) with a gene's mode of inheritance from
@@ -160,16 +172,18 @@ class TieringLite():
         ):
             return True
 
-        # Clean tiering pipeline and panelapp data
-        pa_clean = pa_moi.lower().strip().replace(',','').replace(' ','_')
-        ti_clean = tiering_moi.lower()
+        key = (tiering_moi, pa_moi)
+        if key not in self._moi_matches:
+            # Clean tiering pipeline and panelapp data
+            pa_clean = pa_moi.lower().strip().replace(',','').replace(' ','_')
+            ti_clean = tiering_moi.lower()
 
-        # Get regular expresssions for the variant's mode of inheritance in panelapp
-        regexes = self.MOI_REGEX.get(ti_clean)
-        # Return True if the variant's mode of inheritance matches the gene's in panelapp
-        any_regex_match = any([ re.search(regex, pa_clean) for regex in regexes ])
+            # Get regular expresssions for the variant's mode of inheritance in panelapp
+            patterns = self._moi_patterns.get(ti_clean)
+            # Return True if the variant's mode of inheritance matches the gene's in panelapp
+            self._moi_matches[key] = any(pattern.search(pa_clean) for pattern in patterns)
 
-        return any_regex_match
+        return self._moi_matches[key]
 
     def _is_high_impact(self, segregation: str, consequences: list):
         """Return True if a variant's segregation data or transcript consequences indicate that it is
@@ -234,13 +248,16 @@ class TierUpRunner:
     def __init__(self, TL=TieringLite):
         self.tiering_lite = TL()
 
-    def run(self, irjo:IRJson):
+    def run(self, irjo:IRJson, re_ids=None):
         """Run TierUp.
         Args:
             irjo: Interpretation request json object
+            re_ids: An optional collection of report event ids. If given, only these events are retiered.
         """
         proband_report_events = self._get_proband_report_events(irjo)
         for event in proband_report_events:
+            if re_ids is not None and event.data["reportEventId"] not in re_ids:
+                continue
             # Try to get a jellypy.tierup.panelapp.GeLPanel object for the variants panel. These are
             # stored under the irjo.panels dictionary.
             try:
@@ -327,7 +344,7 @@ class TierUpRunner:
             "reference_db_versions": str(
                 irjo.tiering["interpreted_genome_data"]["referenceDatabasesVersions"]
             ),            
-            "tu_version": pkg_resources.require("jellypy-tierup")[0].version,
+            "tu_version": tierup_version(),
         }
         return record
 
@@ -1,62 +1,194 @@
+import csv
+import datetime
 import logging
+import os
 import pathlib
 
 from jellypy.tierup import lib
-from jellypy.tierup import interface
 from jellypy.pyCIPAPI.auth import AuthenticatedCIPAPISession
-from jellypy.tierup.irtools import IRJIO
+from jellypy.tierup.index import PanelEventIndex
+from jellypy.tierup.irtools import IRJIO, IRJson, IRJValidator
+from jellypy.tierup.metrics import RunMetrics
+from jellypy.tierup.panelapp import PanelVersionCache, diff_panels
 
 logger = logging.getLogger(__name__)
 
 
-def set_irj_object(config, irid_irversion=None, irjson=None):
+def cipapi_session(config, session=None):
+    """Return an authenticated CIP-API session.
+
+    Args:
+        config(dict): A config parser config object parsed from a jellypy config.ini
+        session(AuthenticatedCIPAPISession): An existing session. Returned unless its token expires
+            within 10 minutes.
+    """
+    if session is not None and datetime.datetime.now() < session.auth_expires - datetime.timedelta(minutes=10):
+        return session
+    logger.info('Authenticating with the CIP-API')
+    return AuthenticatedCIPAPISession(
+        auth_credentials={
+            'client_id': config.get('pyCIPAPI', 'client_id'),
+            'client_secret': config.get('pyCIPAPI', 'client_secret')
+        }
+    )
+
+def get_irjson(config, irid_irversion=None, irjson=None, session=None):
+    """Return interpretation request json data from a local file or the CIP-API.
+
+    A new CIP-API session is created if `session` is None.
+    """
     if irjson:
         logger.info(f'Reading from local file: {irjson}')
-        irjo = IRJIO.read(irjson)
+        return IRJIO.read_json(irjson)
     elif irid_irversion:
         irid, irversion = irid_irversion
         logger.info(f'Downloading from CIPAPI: {irid}-{irversion}')
-        sess = AuthenticatedCIPAPISession(
-            auth_credentials={
-                'client_id': config.get('pyCIPAPI', 'client_id'),
-                'client_secret': config.get('pyCIPAPI', 'client_secret')
-            }
-        )
-        irjo = IRJIO.get(irid, irversion, sess)
+        return IRJIO.get_json(irid, irversion, cipapi_session(config, session))
     else:
         raise Exception('Invalid arguments. Either irjson or irid_irversion must be supplied.')
-    return irjo
 
-def main(config, outdir, irid_irversion=None, irjson=None):
-    """Call TierUp and write results to output directory. Requires irid_irversion or irjson to be supplied.
+def set_irj_object(config, irid_irversion=None, irjson=None):
+    return IRJson(get_irjson(config, irid_irversion=irid_irversion, irjson=irjson))
 
-    If `irid_irversion` is supplied, cased data is pulled from the CIP-API for TierUp. Alternatively,
-    a local interpretation request json filepath can be given via the `irjson` argument.
+def write_records(irjo, records, outdir, filename=None):
+    """Write TierUp records to <outdir>/<irid>.tierup.csv, or <outdir>/<filename> if given, and return the path.
+
+    Records are written to a temporary file that is renamed when complete, so an interrupted run never
+    leaves a partial results file behind.
+    """
+    outfile = pathlib.Path(outdir, filename or irjo.irid + ".tierup.csv")
+    tmpfile = outfile.with_name(outfile.name + ".tmp")
+    csv_writer = lib.TierUpCSVWriter(outfile=tmpfile)
+    logger.info(f'Writing results to: {outfile}')
+    csv_writer.write(records)
+    csv_writer.close_file()
+    os.replace(tmpfile, outfile)
+    return outfile
+
+def run_case(config, outdir, irid_irversion=None, irjson=None, index=None, session=None, run_metrics=None):
+    """Run TierUp for one case and write results to the output directory.
 
     Args:
         config(dict): A config parser config object parsed from a jellypy config.ini
+        outdir(str): Output directory for tierup results
         irid_irversion(Tuple[int,int]): Interpretation request id and version e.g. (1234, 2)
         irjson(str): Path to a local interpretation request json file e.g. "jsons/local/1234-1.json"
-        outdir(str): Output directory for tierup results
+        index(str): Optional path to a PanelEventIndex json file. Report events for the case are added.
+        session(AuthenticatedCIPAPISession): Optional CIP-API session, reused across cases
+        run_metrics(RunMetrics): Optional metrics object for recording stage timings
+    Returns:
+        The path to the tierup results file
     """
+    run_metrics = run_metrics or RunMetrics()
     pathlib.Path(outdir).mkdir(parents=True, exist_ok=True)
-    irjo = set_irj_object(config, irid_irversion=irid_irversion, irjson=irjson)
+    with run_metrics.stage('fetch'):
+        data = get_irjson(config, irid_irversion=irid_irversion, irjson=irjson, session=session)
+    with run_metrics.stage('validate'):
+        IRJValidator().validate(data)
+    with run_metrics.stage('load_panels'):
+        irjo = IRJson(data, validator=None)
+    run_metrics.labels['case'] = irjo.irid
     if not irjson:
         logger.info(f'Saving IRJson to output directory.')
         IRJIO.save(irjo, outdir=outdir)
 
     logger.info('Searching for merged PanelApp panels')
-    lib.PanelUpdater().add_event_panels(irjo)
+    with run_metrics.stage('update_panels'):
+        lib.PanelUpdater().add_event_panels(irjo)
 
     logger.info(f'Running tierup for {irjo}')
-    records = lib.TierUpRunner().run(irjo)
+    with run_metrics.stage('retier'):
+        records = list(lib.TierUpRunner().run(irjo))
+    run_metrics.count('report_events', len(records))
 
-    csv_writer = lib.TierUpCSVWriter(outfile=pathlib.Path(outdir, irjo.irid + ".tierup.csv"))
-    logger.info(f'Writing results to: {csv_writer.outfile}')
-    csv_writer.write(records) # Records is a generator of tierup results, exhausted in one loop.
-    csv_writer.close_file()
+    with run_metrics.stage('write'):
+        outfile = write_records(irjo, records, outdir)
+
+    if index:
+        logger.info(f'Adding report events to index: {index}')
+        with run_metrics.stage('index'):
+            panel_index = PanelEventIndex(index)
+            panel_index.add(irjo)
+            panel_index.save()
+    return outfile
+
+def main(config, outdir, irid_irversion=None, irjson=None, index=None, metrics_file=None):
+    """Call TierUp and write results to output directory. Requires irid_irversion or irjson to be supplied.
+
+    If `irid_irversion` is supplied, cased data is pulled from the CIP-API for TierUp. Alternatively,
+    a local interpretation request json filepath can be given via the `irjson` argument.
+
+    Stage timings, HTTP requests and cache hits are logged as json when the run completes.
+
+    Args:
+        config(dict): A config parser config object parsed from a jellypy config.ini
+        irid_irversion(Tuple[int,int]): Interpretation request id and version e.g. (1234, 2)
+        irjson(str): Path to a local interpretation request json file e.g. "jsons/local/1234-1.json"
+        outdir(str): Output directory for tierup results
+        index(str): Optional path to a PanelEventIndex json file. Report events for the case are added.
+        metrics_file(str): Optional path for writing run metrics in the Prometheus text format
+    """
+    with RunMetrics() as run_metrics:
+        run_case(
+            config, outdir, irid_irversion=irid_irversion, irjson=irjson, index=index, run_metrics=run_metrics
+        )
+    run_metrics.log(logger)
+    if metrics_file:
+        logger.info(f'Writing metrics to: {metrics_file}')
+        run_metrics.write_prometheus(metrics_file)
+    logger.info('END')
+
+def panel_update(index, panel, from_version, to_version, outdir, irjson_dir=None, cache_dir=None):
+    """Find report events affected by changes between two versions of a PanelApp panel.
+
+    Writes a TSV of impacted report events to the output directory. If `irjson_dir` is supplied,
+    only the impacted report events are retiered for each case using interpretation request json
+    files named `<irid>.json`, as saved by `main()`. Retiered events are written to
+    `<irid>.<panel>_<from>_<to>.tierup.csv`, so a case's full results in the same directory are kept.
+
+    Args:
+        index(str): Path to a PanelEventIndex json file
+        panel(str): PanelApp panel id
+        from_version(str): The panel version to compare against e.g. "1.2"
+        to_version(str): The updated panel version e.g. "1.5". If None, the latest version is used.
+        outdir(str): Output directory for tierup results
+        irjson_dir(str): Directory containing interpretation request json files
+        cache_dir(str): Optional directory for caching PanelApp panel versions
+    """
+    pathlib.Path(outdir).mkdir(parents=True, exist_ok=True)
+    cache = PanelVersionCache(cache_dir)
+    old_panel, new_panel = cache.get(panel, from_version), cache.get(panel, to_version)
+    changes = diff_panels(old_panel, new_panel)
+    logger.info(f'{len(changes)} gene changes between {old_panel.version_string} and {new_panel.version_string} of {new_panel}')
+
+    panel_index = PanelEventIndex(index)
+    impacted_path = pathlib.Path(
+        outdir, f'{new_panel.id}_{old_panel.version_string}_{new_panel.version_string}.impacted.tsv'
+    )
+    impacted = {}
+    with open(impacted_path, "w") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["#interpretation_request_id", "re_id", "ensembl_id", "gene", "change", "old", "new"])
+        for change in changes:
+            for ensembl_id in change.ensembl_ids:
+                for irid, event_id in panel_index.lookup(new_panel.id, ensembl_id):
+                    writer.writerow([irid, event_id, ensembl_id, change.hgnc_symbol, change.change, change.old, change.new])
+                    impacted.setdefault(irid, set()).add(event_id)
+    logger.info(f'{len(impacted)} cases impacted. Written to {impacted_path}')
+
+    if irjson_dir:
+        for irid, event_ids in impacted.items():
+            logger.info(f'Retiering {len(event_ids)} report events for {irid}')
+            irjo = IRJIO.read(pathlib.Path(irjson_dir, irid + ".json"))
+            lib.PanelUpdater().add_event_panels(irjo)
+            records = lib.TierUpRunner().run(irjo, re_ids=event_ids)
+            write_records(
+                irjo, records, outdir,
+                filename=f'{irid}.{new_panel.id}_{old_panel.version_string}_{new_panel.version_string}.tierup.csv'
+            )
 
     logger.info('END')
 
 if __name__ == "__main__":
+    from jellypy.tierup import interface
     interface.cli()
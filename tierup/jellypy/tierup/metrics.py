@@ -0,0 +1,171 @@
+"""Stage timings, HTTP and cache counters for TierUp runs.
+
+While a RunMetrics object is active, HTTP requests made through the jellypy.pyCIPAPI transport are
+counted per host, along with PanelApp data served from snapshots, gene tables and panel caches.
+Results are logged as a single json line and can be written to a Prometheus text file for the
+node_exporter textfile collector.
+
+>>> with RunMetrics(case="1234-1") as run_metrics:
+>>> ...     with run_metrics.stage("retier"):
+>>> ...         records = list(TierUpRunner().run(irjo))
+>>> ...     run_metrics.count("report_events", len(records))
+>>> run_metrics.log()
+>>> run_metrics.write_prometheus("tierup.prom")
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from jellypy.pyCIPAPI import transport
+
+logger = logging.getLogger(__name__)
+
+# RunMetrics objects currently collecting metrics. See cache_hit().
+_active = []
+
+
+def cache_hit(host):
+    """Count a request for data from `host` that was served from a local cache or file."""
+    for run_metrics in list(_active):
+        with run_metrics._lock:
+            run_metrics.cache_hits[host] += 1
+
+
+class RunMetrics():
+    """Collect metrics for a TierUp run. Use as a context manager to collect HTTP and cache counts.
+
+    Args:
+        labels: Labels added to every Prometheus metric e.g. case="1234-1"
+    Attributes:
+        stages(dict): Stage names mapped to total seconds spent in the stage
+        counts(Counter): Named counts e.g. report_events
+        http(dict): Host names mapped to Counters of requests, errors, bytes and seconds
+        cache_hits(Counter): Host names mapped to requests served from a local cache
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self.stages = {}
+        self.counts = Counter()
+        self.http = defaultdict(Counter)
+        self.cache_hits = Counter()
+        self.seconds = None
+        self._start = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        _active.append(self)
+        transport.add_observer(self._observe_http)
+        return self
+
+    def __exit__(self, *exc):
+        transport.remove_observer(self._observe_http)
+        _active.remove(self)
+        self.seconds = time.perf_counter() - self._start
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block of code. Time for stages entered more than once is summed."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0) + elapsed
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] += value
+
+    def _observe_http(self, host, method, status, size, seconds):
+        with self._lock:
+            http = self.http[host]
+            http["requests"] += 1
+            http["bytes"] += size
+            http["seconds"] += seconds
+            if status is None or status >= 400:
+                http["errors"] += 1
+
+    @property
+    def events_per_second(self):
+        """Report events retiered per second of the retier stage, or None if not measured."""
+        seconds = self.stages.get("retier")
+        return self.counts["report_events"] / seconds if seconds else None
+
+    def as_dict(self):
+        return {
+            "labels": self.labels,
+            "seconds": self.seconds,
+            "stages": self.stages,
+            "counts": dict(self.counts),
+            "events_per_second": self.events_per_second,
+            "http": {host: dict(counter) for host, counter in self.http.items()},
+            "cache_hits": dict(self.cache_hits),
+        }
+
+    def log(self, log=logger):
+        """Log metrics as a json line."""
+        log.info(f"Metrics: {json.dumps(self.as_dict())}")
+
+    def _prometheus_lines(self):
+        def metric(name, value, labels):
+            labels = {**self.labels, **labels}
+            label_text = ",".join(f'{key}="{label}"' for key, label in sorted(labels.items()))
+            return f"{name}{{{label_text}}} {value}"
+
+        samples = {
+            "tierup_run_seconds": ("Total run time in seconds", [({}, self.seconds or 0)]),
+            "tierup_stage_seconds": (
+                "Time spent in each run stage in seconds",
+                [({"stage": stage}, seconds) for stage, seconds in sorted(self.stages.items())]
+            ),
+            "tierup_count": (
+                "Items processed in the run",
+                [({"name": name}, value) for name, value in sorted(self.counts.items())]
+            ),
+            "tierup_events_per_second": (
+                "Report events retiered per second", [({}, self.events_per_second or 0)]
+            ),
+            "tierup_http_requests_total": (
+                "HTTP request attempts by host",
+                [({"host": host}, counter["requests"]) for host, counter in sorted(self.http.items())]
+            ),
+            "tierup_http_errors_total": (
+                "HTTP request attempts that failed or returned an error status by host",
+                [({"host": host}, counter["errors"]) for host, counter in sorted(self.http.items())]
+            ),
+            "tierup_http_bytes_total": (
+                "HTTP response bytes by host",
+                [({"host": host}, counter["bytes"]) for host, counter in sorted(self.http.items())]
+            ),
+            "tierup_http_seconds_total": (
+                "Time spent waiting for HTTP responses by host",
+                [({"host": host}, counter["seconds"]) for host, counter in sorted(self.http.items())]
+            ),
+            "tierup_cache_hits_total": (
+                "Requests served from local caches or files by host",
+                [({"host": host}, hits) for host, hits in sorted(self.cache_hits.items())]
+            ),
+        }
+        for name, (help_text, values) in samples.items():
+            yield f"# HELP {name} {help_text}"
+            yield f"# TYPE {name} gauge"
+            for labels, value in values:
+                yield metric(name, value, labels)
+
+    def write_prometheus(self, path):
+        """Write metrics to a file in the Prometheus text format.
+
+        The file is replaced atomically so that collectors never read a partially written file.
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(self._prometheus_lines()) + "\n")
+        os.replace(tmp_path, path)
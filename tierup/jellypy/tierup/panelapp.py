@@ -1,20 +1,114 @@
 """Utilities for working with PanelApp"""
+import datetime
+import json
+import mmap
+import pathlib
+import struct
+import sys
+import threading
+import time
 
 import requests
 
+from collections import namedtuple
+from urllib.parse import urlparse
+from jellypy.pyCIPAPI import transport
+from jellypy.pyCIPAPI.config import panelapp_url
+from jellypy.tierup import metrics
+
+# A requests session shared by all PanelApp API calls. Connections are pooled and requests are rate
+#   limited and retried by the jellypy.pyCIPAPI transport.
+_session = transport.new_session()
+# A PanelAppSnapshot set by use_snapshot(). When set, GeLPanel and PanelApp read panel data from the
+#   snapshot instead of the PanelApp API.
+_snapshot = None
+# A PanelGeneTable set by use_gene_table(). When set, get_panel() returns CompactPanel objects.
+_gene_table = None
+# A PanelCache set by use_panel_cache(). When set, get_panel() and PanelApp reuse recently fetched data.
+_panel_cache = None
+# PanelApp host name, used to count cache hits in jellypy.tierup.metrics
+_host = urlparse(panelapp_url).hostname
+
+
+def use_snapshot(path):
+    """Load PanelApp data from a snapshot file for all subsequent GeLPanel and PanelApp objects.
+
+    Args:
+        path(str): Path to a snapshot file created with PanelAppSnapshot.export(). If None, the
+            PanelApp API is used.
+    """
+    global _snapshot
+    _snapshot = PanelAppSnapshot(path) if path else None
+
+
+def use_gene_table(path):
+    """Return compact panels from a gene table file for all subsequent get_panel() calls.
+
+    Args:
+        path(str): Path to a gene table file created with PanelGeneTable.write(). If None,
+            get_panel() returns GeLPanel objects.
+    """
+    global _gene_table
+    _gene_table = PanelGeneTable.open(path) if path else None
+
+
+def use_panel_cache(ttl):
+    """Cache panels returned by get_panel() and the PanelApp panel listing in memory.
+
+    Used by long-running processes that retier many cases, such as jellypy.tierup.service.
+
+    Args:
+        ttl(float): Seconds before the latest version of a panel is fetched again. If None, caching is
+            turned off.
+    """
+    global _panel_cache
+    _panel_cache = PanelCache(ttl) if ttl is not None else None
+
+
+def panel_cache_size():
+    """Return the number of entries in the panel cache set by use_panel_cache(), or 0 if caching is off."""
+    return len(_panel_cache) if _panel_cache is not None else 0
+
+
+def get_panel(panel, version=None):
+    """Return a panel object for a PanelApp panel id or name.
+
+    Returns a CompactPanel if a gene table has been loaded with use_gene_table(), otherwise a GeLPanel.
+    Both objects support the attributes and `query()` method used by TierUp.
+    """
+    if _panel_cache is not None:
+        return _panel_cache.get((str(panel), str(version)), lambda: _get_panel(panel, version))
+    return _get_panel(panel, version)
+
+
+def _get_panel(panel, version=None):
+    if _gene_table:
+        metrics.cache_hit(_host)
+        return _gene_table.panel(panel, version)
+    return GeLPanel(panel, version)
+
 class GeLPanel():
-    """A GeL PanelApp Panel."""
-    host = "https://panelapp.genomicsengland.co.uk/api/v1/panels"
+    """A GeL PanelApp Panel.
 
-    def __init__(self, panel, version=None):
+    Args:
+        panel: PanelApp panel id or name
+        version: PanelApp panel version e.g. "1.10". The latest version is returned if None.
+        panel_json: PanelApp panel json data. If given, no request is made to the PanelApp API.
+    """
+    host = panelapp_url
+
+    def __init__(self, panel, version=None, panel_json=None):
         self.url = f'{self.host}/{panel}'
-        self.version = float(version) if version else None
-        self._json = self._get_panel_json()
+        self._panel = panel
+        # Keep the requested version as a string. As floats, versions 1.1 and 1.10 are equal.
+        self._version_param = str(version) if version else None
+        self._json = panel_json or self._get_panel_json()
 
         # Initialise attributes
         self.name, self.id, self.hash = self._json['name'], self._json['id'], self._json['hash_id']
         self.created = self._json['version_created']
         self.version = float(self._json['version'])
+        self._genes = None
 
     def query(self, ensembl_id):
         """Query the panel app panel for gene data.
@@ -33,37 +127,207 @@ class GeLPanel():
                 )
                 If a matching gene is not found, query_result is (None, None, None, None, None).
         """
-        # Iterate over genes in this panel
-        for panel_gene in self._json['genes']:
-            # Get ensembl ids for the current gene. An ensembl id is present for each reference
-            #   genome. For example, p_ensembl_ids = ['ENSG00000139567',  'ENSG00000139567'].
-            p_ensembl_ids = [
-                ensembl_version['ensembl_id'] 
-                for reference, ensembl_dict in panel_gene['gene_data']['ensembl_genes'].items()
-                for ensembl_version in ensembl_dict.values() 
-            ]
-            # If the gene's ensembl id matches the function input, return gene metadata and exit.
-            if ensembl_id in p_ensembl_ids:
-                hgnc_id = panel_gene['gene_data']['hgnc_id']
-                hgnc_symbol = panel_gene['gene_data']['hgnc_symbol']
-                confidence_level = panel_gene['confidence_level']
-                p_ensembl_id = ensembl_id
-                mode_of_inheritance = panel_gene['mode_of_inheritance']
-                return (hgnc_id, hgnc_symbol, confidence_level, p_ensembl_id, mode_of_inheritance)
-        # Here, we have iterated over all genes and could not find ensemblID, hence the gene is not
-        #   not present in the panel. Return a tuple containing None.
-        else:
-            return (None,None,None,None,None)
+        return self.genes.get(ensembl_id, (None, None, None, None, None))
+
+    @property
+    def genes(self):
+        """Returns a dictionary mapping each ensembl gene identifier in the panel to its gene metadata.
+
+        Values are tuples in the same format returned by `query()`. Where more than one gene in the
+        panel carries an ensembl id, the first gene in the panel is kept. The dictionary is built on
+        first access and reused for all later queries.
+        """
+        if self._genes is None:
+            self._genes = {}
+            # Iterate over genes in this panel
+            for panel_gene in self._json['genes']:
+                # Get ensembl ids for the current gene. An ensembl id is present for each reference
+                #   genome. For example, p_ensembl_ids = ['ENSG00000139567',  'ENSG00000139567'].
+                p_ensembl_ids = [
+                    ensembl_version['ensembl_id']
+                    for reference, ensembl_dict in panel_gene['gene_data']['ensembl_genes'].items()
+                    for ensembl_version in ensembl_dict.values()
+                ]
+                for p_ensembl_id in p_ensembl_ids:
+                    self._genes.setdefault(p_ensembl_id, (
+                        panel_gene['gene_data']['hgnc_id'],
+                        panel_gene['gene_data']['hgnc_symbol'],
+                        panel_gene['confidence_level'],
+                        p_ensembl_id,
+                        panel_gene['mode_of_inheritance']
+                    ))
+        return self._genes
 
     def _get_panel_json(self):
         """Returns json response object for API request."""
-        data = requests.get(self.url, params={"version" : self.version})
+        if _snapshot:
+            metrics.cache_hit(_host)
+            return _snapshot.panel_json(self._panel, self._version_param)
+        data = _session.get(self.url, params={"version" : self._version_param})
         data.raise_for_status() # Raise error if invalid response code
         return data.json()
 
+    @property
+    def version_string(self):
+        """The panel version as returned by PanelApp e.g. "1.10"."""
+        return str(self._json['version'])
+
     def __str__(self):
         return f"{self.name}, {self.id}"
 
+
+# A gene-level change between two versions of a panel. `change` is one of 'added', 'removed',
+#   'confidence' or 'moi'. `old` and `new` hold the changed values: confidence levels for 'added',
+#   'removed' and 'confidence' changes, and modes of inheritance for 'moi' changes.
+GeneChange = namedtuple(
+    'GeneChange',
+    ['panel_id', 'from_version', 'to_version', 'hgnc_id', 'hgnc_symbol', 'ensembl_ids', 'change', 'old', 'new']
+)
+
+
+def _parse_version(version):
+    """Return a PanelApp version string as a (major, minor) tuple of integers."""
+    major, minor = str(version).split('.')
+    return int(major), int(minor)
+
+
+def _genes_by_hgnc(panel):
+    """Group a panel's gene records by gene. Returns a dictionary mapping gene identifiers to
+    (hgnc_symbol, confidence_level, mode_of_inheritance, ensembl_ids) tuples."""
+    table = {}
+    for ensembl_id, (hgnc_id, symbol, confidence, _, moi) in panel.genes.items():
+        record = table.setdefault(hgnc_id or symbol, [symbol, confidence, moi, []])
+        record[3].append(ensembl_id)
+    return {gene: (symbol, conf, moi, tuple(sorted(ens))) for gene, (symbol, conf, moi, ens) in table.items()}
+
+
+def diff_panels(old, new):
+    """Compute gene-level changes between two versions of a panel.
+
+    Genes are compared by HGNC identifier using dictionaries built once per panel, so the comparison
+    scales linearly with the number of genes.
+
+    Args:
+        old(GeLPanel): The earlier version of a PanelApp panel
+        new(GeLPanel): The later version of a PanelApp panel
+    Returns:
+        A list of GeneChange tuples sorted by gene symbol. A gene with a changed confidence level and
+            mode of inheritance has one GeneChange for each.
+    """
+    old_genes, new_genes = _genes_by_hgnc(old), _genes_by_hgnc(new)
+    change = lambda gene, record, *fields: GeneChange(
+        new.id, old.version_string, new.version_string, gene, record[0], record[3], *fields
+    )
+    changes = []
+    for gene in old_genes.keys() | new_genes.keys():
+        old_record, new_record = old_genes.get(gene), new_genes.get(gene)
+        if old_record is None:
+            changes.append(change(gene, new_record, 'added', None, new_record[1]))
+        elif new_record is None:
+            changes.append(change(gene, old_record, 'removed', old_record[1], None))
+        else:
+            if old_record[1] != new_record[1]:
+                changes.append(change(gene, new_record, 'confidence', old_record[1], new_record[1]))
+            if old_record[2] != new_record[2]:
+                changes.append(change(gene, new_record, 'moi', old_record[2], new_record[2]))
+    return sorted(changes, key=lambda c: (c.hgnc_symbol or '', c.change))
+
+
+class PanelVersionCache():
+    """Fetch and cache versions of PanelApp panels.
+
+    Panels are held in memory and, if `cache_dir` is given, written to disk as json so that
+    versions are only downloaded once. Published panel versions do not change, so cached files
+    never expire. The latest version of a panel is always requested from PanelApp.
+
+    Args:
+        cache_dir(str): Optional directory for panel json files
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = pathlib.Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._panels = {}
+
+    def get(self, panel, version=None):
+        """Return a GeLPanel for a panel id and version, using cached data where available."""
+        if version is None:
+            latest = GeLPanel(panel)
+            self._store(panel, latest)
+            return latest
+        key = (str(panel), str(version))
+        if key in self._panels:
+            metrics.cache_hit(_host)
+            return self._panels[key]
+        path = self._path(*key)
+        if path and path.exists():
+            metrics.cache_hit(_host)
+            with open(path, "r") as f:
+                gel_panel = GeLPanel(panel, version, panel_json=json.load(f))
+        else:
+            gel_panel = GeLPanel(panel, version)
+        self._store(panel, gel_panel)
+        return gel_panel
+
+    def _path(self, panel, version):
+        return self.cache_dir / f'{panel}_{version}.json' if self.cache_dir else None
+
+    def _store(self, panel, gel_panel):
+        key = (str(panel), gel_panel.version_string)
+        self._panels[key] = gel_panel
+        path = self._path(*key)
+        if path and not path.exists():
+            with open(path, "w") as f:
+                json.dump(gel_panel._json, f)
+
+
+class PanelChangeFeed():
+    """Iterable feed of gene-level changes across successive versions of a panel.
+
+    Successive versions are found by incrementing the minor version, then the major version when a
+    minor version does not exist (e.g. 1.24 -> 2.0 after promotion). Each consecutive pair of
+    versions is compared with `diff_panels`.
+
+    Args:
+        panel: PanelApp panel id
+        from_version: The first panel version in the feed e.g. "1.2"
+        to_version: The last panel version in the feed. Defaults to the latest version.
+        cache(PanelVersionCache): Panel cache. A new in-memory cache is used if None.
+
+    >>> for change in PanelChangeFeed(123, "1.2"):
+    >>> ...  # Retier report events for change.ensembl_ids
+    """
+
+    def __init__(self, panel, from_version, to_version=None, cache=None):
+        self.panel = panel
+        self.cache = cache or PanelVersionCache()
+        self.from_version = str(from_version)
+        self.to_version = str(to_version) if to_version else self.cache.get(panel).version_string
+
+    def versions(self):
+        """Yield GeLPanel objects for each version of the panel from `from_version` to `to_version`."""
+        current = self.cache.get(self.panel, self.from_version)
+        yield current
+        last = _parse_version(self.to_version)
+        major, minor = _parse_version(current.version_string)
+        while (major, minor) < last:
+            try:
+                current = self.cache.get(self.panel, f'{major}.{minor + 1}')
+            except requests.HTTPError:
+                current = self.cache.get(self.panel, f'{major + 1}.0')
+            if _parse_version(current.version_string) <= (major, minor):
+                raise ValueError(f'Could not find the version after {major}.{minor} for panel {self.panel}')
+            major, minor = _parse_version(current.version_string)
+            yield current
+
+    def __iter__(self):
+        previous = None
+        for current in self.versions():
+            if previous is not None:
+                yield from diff_panels(previous, current)
+            previous = current
+
 class PanelApp():
     """Iterable container for panel data from PanelApp /panels endpoint.
 
@@ -78,7 +342,7 @@ class PanelApp():
 
     def __init__(
         self,
-        endpoint="https://panelapp.genomicsengland.co.uk/api/v1/panels",
+        endpoint=panelapp_url,
         head=None
     ):
         self.endpoint = endpoint
@@ -90,7 +354,15 @@ class PanelApp():
 
     def _get_panels(self):
         """Get all panels from instance endpoint"""
-        response = requests.get(self.endpoint)
+        if _snapshot:
+            yield from _snapshot.panels
+        elif _panel_cache is not None:
+            yield from _panel_cache.get(('panels', self.endpoint), lambda: list(self._fetch_panels()))
+        else:
+            yield from self._fetch_panels()
+
+    def _fetch_panels(self):
+        response = _session.get(self.endpoint)
         response.raise_for_status()
         r = response.json()
         # Yield panels from the first response
@@ -100,7 +372,8 @@ class PanelApp():
         # While the response dictionary contains a url for the next page.
         while r['next']:
             # Get panels from the next page of API results.
-            response = requests.get(r['next'])
+            response = _session.get(r['next'])
+            response.raise_for_status()
             r = response.json()
             for panel in r['results']:
                 yield panel
@@ -117,3 +390,335 @@ class PanelApp():
                 raise StopIteration()
         else:
             return next(self._panels)
+
+
+class PanelCache():
+    """Thread-safe in-memory cache with a time to live for PanelApp data.
+
+    Concurrent requests for the same missing key wait for a single fetch. Errors are not cached.
+
+    Args:
+        ttl(float): Seconds an entry is kept. Published panel versions never change, but the latest
+            version of a panel and the panel listing do, so entries expire for all keys.
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """Return the cached value for key, calling `load()` to fetch it if missing or expired."""
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                metrics.cache_hit(_host)
+                return entry[1]
+            value = load()
+            self._entries[key] = (time.monotonic(), value)
+            return value
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class PanelAppSnapshot():
+    """Read-only PanelApp data loaded from a snapshot file.
+
+    A snapshot holds the /panels listing, which includes relevant disorders, and the full json for the
+    latest version of every panel. The file is a json header followed by each panel's json. The file
+    is memory-mapped and a panel's json is only parsed when it is requested.
+
+    Args:
+        path(str): Path to a snapshot file created with `PanelAppSnapshot.export()`
+
+    >>> PanelAppSnapshot.export("panelapp.snapshot")
+    >>> use_snapshot("panelapp.snapshot")
+    >>> GeLPanel(123)  # No network call
+    """
+    MAGIC = b"JELLYPY-PANELAPP-SNAPSHOT 1\n"
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError(f"Not a PanelApp snapshot file: {path}")
+        header_start = len(self.MAGIC) + 17
+        header_length = int(self._mmap[len(self.MAGIC):header_start])
+        self.header = json.loads(self._mmap[header_start:header_start + header_length])
+        self._data_start = header_start + header_length
+        self._ids = {name.lower(): panel_id for name, panel_id in self.header["names"].items()}
+
+    @property
+    def panels(self):
+        """A list of panel data from the PanelApp /panels endpoint."""
+        return self.header["panels"]
+
+    def panel_json(self, panel, version=None):
+        """Return json data for a panel.
+
+        Args:
+            panel: PanelApp panel id or name
+            version: PanelApp panel version. The snapshot only holds the latest version of each panel.
+        Raises:
+            requests.HTTPError: The panel or panel version is not in the snapshot. This matches the
+                error raised for a missing panel when using the PanelApp API.
+        """
+        panel_id = self._ids.get(str(panel).lower(), str(panel))
+        try:
+            offset, length, snapshot_version = self.header["offsets"][panel_id]
+        except KeyError:
+            raise requests.HTTPError(f"Panel {panel} not found in snapshot {self.path}")
+        if version and str(version) != snapshot_version:
+            raise requests.HTTPError(
+                f"Panel {panel} version {version} not found in snapshot {self.path}. "
+                f"Snapshot version is {snapshot_version}"
+            )
+        start = self._data_start + offset
+        return json.loads(self._mmap[start:start + length])
+
+    def close(self):
+        self._mmap.close()
+
+    @classmethod
+    def write(cls, path, panels, panel_jsons):
+        """Write a snapshot file.
+
+        Args:
+            path(str): Output file path
+            panels(list): Panel data from the PanelApp /panels endpoint
+            panel_jsons(Iterable[dict]): Full json data for each panel
+        """
+        offsets, names, blobs, offset = {}, {}, [], 0
+        for panel_json in panel_jsons:
+            blob = json.dumps(panel_json).encode()
+            offsets[str(panel_json["id"])] = (offset, len(blob), str(panel_json["version"]))
+            names[panel_json["name"]] = str(panel_json["id"])
+            blobs.append(blob)
+            offset += len(blob)
+        header = json.dumps({
+            "created": datetime.datetime.now().isoformat(),
+            "source": GeLPanel.host,
+            "panels": list(panels),
+            "offsets": offsets,
+            "names": names
+        }).encode()
+        with open(path, "wb") as f:
+            f.write(cls.MAGIC)
+            f.write(b"%016d\n" % len(header))
+            f.write(header)
+            for blob in blobs:
+                f.write(blob)
+
+    @classmethod
+    def export(cls, path, head=None, panel_ids=None):
+        """Download all panels from PanelApp and write them to a snapshot file.
+
+        Args:
+            path(str): Output file path
+            head(int): Optional limit on the number of panels exported. Useful for testing.
+            panel_ids(Iterable[int]): Optional PanelApp ids of the panels to export
+        """
+        panels = list(PanelApp(head=head))
+        if panel_ids:
+            panel_ids = {int(panel_id) for panel_id in panel_ids}
+            panels = [panel for panel in panels if panel["id"] in panel_ids]
+        cls.write(path, panels, (GeLPanel(panel["id"])._json for panel in panels))
+
+
+class CompactPanel():
+    """A read-only PanelApp panel backed by a PanelGeneTable.
+
+    CompactPanel has the same attributes and `query()` method as GeLPanel, but only holds the gene
+    fields used by TierUp. Gene records stay in the memory-mapped gene table file, so many panels can
+    be loaded in each worker process without copying PanelApp json into memory.
+    """
+    __slots__ = ('table', 'name', 'id', 'hash', 'created', 'version', 'version_string', '_start', '_count')
+
+    def __init__(self, table, metadata):
+        self.table = table
+        self.name, self.id, self.hash = metadata['name'], metadata['id'], metadata['hash']
+        self.created, self.version_string = metadata['created'], metadata['version']
+        self.version = float(metadata['version'])
+        self._start, self._count = metadata['start'], metadata['count']
+
+    def query(self, ensembl_id):
+        """Query the panel for gene data. Returns the same tuple as GeLPanel.query()."""
+        return self.table.query(self._start, self._count, ensembl_id)
+
+    @property
+    def genes(self):
+        """Returns a dictionary mapping each ensembl gene identifier in the panel to its gene metadata."""
+        return dict(self.table.records(self._start, self._count))
+
+    def __reduce__(self):
+        # Pickle by reference to the gene table file. Worker processes map the same file.
+        return (_load_compact_panel, (self.table.path, self.id, self.version_string))
+
+    def __str__(self):
+        return f"{self.name}, {self.id}"
+
+
+def _load_compact_panel(path, panel, version):
+    return PanelGeneTable.open(path).panel(panel, version)
+
+
+class PanelGeneTable():
+    """A memory-mapped table of panel gene records for TierUp.
+
+    Each gene record holds the ensembl id, hgnc id, hgnc symbol, confidence level and mode of
+    inheritance for a gene in a panel. Records are fixed width and sorted by ensembl id within each
+    panel, so queries are a binary search over the mapped file. Record fields are indexes into a table
+    of unique strings, so repeated values such as modes of inheritance are stored once. The file is
+    mapped read-only, so worker processes using the same file share its pages.
+
+    File layout: magic line, 16-digit header length line, json header, records, string offsets,
+    utf-8 string data.
+
+    Args:
+        path(str): Path to a gene table file created with `PanelGeneTable.write()`
+    """
+    MAGIC = b"JELLYPY-PANEL-GENES 1\n"
+    RECORD = struct.Struct("<20s4I")
+    OFFSET = struct.Struct("<I")
+    NONE = 0xFFFFFFFF
+    # Gene tables opened in this process, by path. See PanelGeneTable.open().
+    _open_tables = {}
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError(f"Not a PanelApp gene table file: {path}")
+        header_start = len(self.MAGIC) + 17
+        header_length = int(self._mmap[len(self.MAGIC):header_start])
+        self.header = json.loads(self._mmap[header_start:header_start + header_length])
+        self._records_start = header_start + header_length
+        self._offsets_start = self._records_start + self.header["n_records"] * self.RECORD.size
+        self._strings_start = self._offsets_start + (self.header["n_strings"] + 1) * self.OFFSET.size
+        self._ids = {name.lower(): panel_id for name, panel_id in self.header["names"].items()}
+
+    @classmethod
+    def open(cls, path):
+        """Return the gene table for a file, reusing a table already opened in this process."""
+        key = str(pathlib.Path(path).resolve())
+        if key not in cls._open_tables:
+            cls._open_tables[key] = cls(path)
+        return cls._open_tables[key]
+
+    def panel(self, panel, version=None):
+        """Return a CompactPanel for a panel id or name.
+
+        Raises:
+            requests.HTTPError: The panel or panel version is not in the table. This matches the
+                error raised for a missing panel when using the PanelApp API.
+        """
+        panel_id = self._ids.get(str(panel).lower(), str(panel))
+        try:
+            metadata = self.header["panels"][panel_id]
+        except KeyError:
+            raise requests.HTTPError(f"Panel {panel} not found in gene table {self.path}")
+        if version and str(version) != metadata["version"]:
+            raise requests.HTTPError(f"Panel {panel} version {version} not found in gene table {self.path}")
+        return CompactPanel(self, metadata)
+
+    def _string(self, index):
+        if index == self.NONE:
+            return None
+        start, end = struct.unpack_from("<2I", self._mmap, self._offsets_start + index * self.OFFSET.size)
+        return sys.intern(self._mmap[self._strings_start + start:self._strings_start + end].decode())
+
+    def _record(self, position):
+        key, hgnc_id, symbol, confidence, moi = self.RECORD.unpack_from(
+            self._mmap, self._records_start + position * self.RECORD.size
+        )
+        ensembl_id = key.rstrip(b"\0").decode()
+        return ensembl_id, (
+            self._string(hgnc_id), self._string(symbol), self._string(confidence), ensembl_id, self._string(moi)
+        )
+
+    def _key(self, position):
+        return self._mmap[
+            self._records_start + position * self.RECORD.size:
+            self._records_start + position * self.RECORD.size + 20
+        ]
+
+    def query(self, start, count, ensembl_id):
+        """Binary search a panel's records for an ensembl id. Returns a GeLPanel.query() style tuple."""
+        key = str(ensembl_id).encode().ljust(20, b"\0")
+        low, high = start, start + count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < start + count and self._key(low) == key:
+            return self._record(low)[1]
+        return (None, None, None, None, None)
+
+    def records(self, start, count):
+        """Yield (ensembl_id, gene metadata tuple) pairs for a range of records."""
+        for position in range(start, start + count):
+            yield self._record(position)
+
+    def close(self):
+        self._open_tables.pop(str(pathlib.Path(self.path).resolve()), None)
+        self._mmap.close()
+
+    @classmethod
+    def write(cls, path, panels):
+        """Write a gene table file.
+
+        Args:
+            path(str): Output file path
+            panels(Iterable[GeLPanel]): Panels to include in the table
+        """
+        strings, records, metadata, names = {}, [], {}, {}
+        intern = lambda value: cls.NONE if value is None else strings.setdefault(str(value), len(strings))
+        for panel in panels:
+            genes = sorted(
+                (ensembl_id, gene) for ensembl_id, gene in panel.genes.items() if len(ensembl_id.encode()) <= 20
+            )
+            metadata[str(panel.id)] = {
+                "name": panel.name, "id": panel.id, "hash": panel.hash, "created": panel.created,
+                "version": panel.version_string, "start": len(records), "count": len(genes)
+            }
+            names[panel.name] = str(panel.id)
+            for ensembl_id, (hgnc_id, symbol, confidence, _, moi) in genes:
+                records.append(cls.RECORD.pack(
+                    ensembl_id.encode(), intern(hgnc_id), intern(symbol), intern(confidence), intern(moi)
+                ))
+        encoded = [string.encode() for string in strings]
+        header = json.dumps({
+            "created": datetime.datetime.now().isoformat(),
+            "panels": metadata,
+            "names": names,
+            "n_records": len(records),
+            "n_strings": len(encoded)
+        }).encode()
+        with open(path, "wb") as f:
+            f.write(cls.MAGIC)
+            f.write(b"%016d\n" % len(header))
+            f.write(header)
+            f.writelines(records)
+            offset = 0
+            f.write(cls.OFFSET.pack(offset))
+            for string in encoded:
+                offset += len(string)
+                f.write(cls.OFFSET.pack(offset))
+            f.writelines(encoded)
+
+    @classmethod
+    def from_snapshot(cls, snapshot_path, path):
+        """Write a gene table file for every panel in a PanelApp snapshot."""
+        snapshot = PanelAppSnapshot(snapshot_path)
+        cls.write(path, (
+            GeLPanel(panel_id, panel_json=snapshot.panel_json(panel_id)) for panel_id in snapshot.header["offsets"]
+        ))
+        snapshot.close()
@@ -0,0 +1,169 @@
+"""A staged pipeline for running TierUp on many cases, overlapping network and CPU work.
+
+Cases move through four stages connected by bounded queues:
+    1. fetch: Threads download interpretation requests from the CIP-API or read them from files
+    2. validate: Interpretation requests are validated in a process pool
+    3. retier: Threads load PanelApp panels and retier report events
+    4. write: A single thread writes results files
+
+While one case is being retiered, later cases are already downloading and validating. Bounded queues
+stop fast stages from running ahead of slow ones and holding many cases in memory.
+
+>>> pipeline = Pipeline(config, outdir='results/', fetch_workers=8)
+>>> pipeline.run(['1234-1', '5678-2', 'jsons/9999-1.json'])
+{'done': 3, 'failed': {}}
+"""
+import logging
+import multiprocessing
+import os
+import pathlib
+import queue
+import threading
+import time
+
+from jellypy.tierup import lib, main
+from jellypy.tierup.irtools import IRJIO, IRJson, IRJValidator
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the cases in a stage queue
+_DONE = object()
+
+
+def _validate(irjson):
+    """Validate interpretation request json data. Runs in a worker process."""
+    IRJValidator().validate(irjson)
+
+
+class Pipeline():
+    """Run TierUp for many cases with concurrent fetch, validate, retier and write stages.
+
+    Args:
+        config: A config parser object parsed from a jellypy config.ini. Used to authenticate with the
+            CIP-API when cases are given as ids.
+        outdir(str): Output directory for tierup results
+        fetch_workers(int): Threads downloading interpretation requests
+        validate_workers(int): Processes validating interpretation requests. Defaults to the CPU count.
+        retier_workers(int): Threads loading panels and retiering cases
+        queue_size(int): Maximum cases waiting between each pair of stages
+        save_irjson(bool): Save interpretation requests downloaded from the CIP-API to the output directory
+    Attributes:
+        failed(dict): Case ids mapped to the stage and error for cases that failed
+    """
+
+    def __init__(
+        self, config, outdir, fetch_workers=8, validate_workers=None, retier_workers=2, queue_size=16,
+        save_irjson=True
+    ):
+        self.config, self.outdir = config, outdir
+        self.fetch_workers = fetch_workers
+        self.validate_workers = validate_workers or os.cpu_count()
+        self.retier_workers = retier_workers
+        self.queue_size = queue_size
+        self.save_irjson = save_irjson
+        self.failed = {}
+        self.done = 0
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _cipapi_session(self):
+        with self._lock:
+            self._session = main.cipapi_session(self.config, self._session)
+            return self._session
+
+    def _fetch(self, case):
+        if case.endswith('.json'):
+            return IRJIO.read_json(case)
+        irid, irversion = case.split('-')
+        return IRJIO.get_json(int(irid), int(irversion), self._cipapi_session())
+
+    def _validate(self, irjson):
+        # The worker thread waits for the process pool, so at most validate_workers cases are validated at once
+        self._pool.apply(_validate, (irjson,))
+        return irjson
+
+    def _retier(self, irjson):
+        irjo = IRJson(irjson, validator=None)
+        lib.PanelUpdater().add_event_panels(irjo)
+        return irjo, list(lib.TierUpRunner().run(irjo))
+
+    def _write(self, case, result):
+        irjo, records = result
+        if self.save_irjson and not case.endswith('.json'):
+            IRJIO.save(irjo, outdir=self.outdir)
+        main.write_records(irjo, records, self.outdir)
+        with self._lock:
+            self.done += 1
+
+    def _stage(self, name, function, inbox, outbox, workers):
+        """Start threads that apply `function` to cases from `inbox` and put the results in `outbox`.
+
+        Returns:
+            A thread that puts _DONE in `outbox` once all cases from `inbox` are processed
+        """
+        def work():
+            while True:
+                item = inbox.get()
+                if item is _DONE:
+                    # Pass the end marker on to the other threads in this stage
+                    inbox.put(_DONE)
+                    return
+                case, value = item
+                try:
+                    result = function(case, value) if outbox is None else (case, function(value))
+                except Exception as error:
+                    logger.warning(f'{case} failed at the {name} stage: {error}')
+                    with self._lock:
+                        self.failed[case] = (name, f'{type(error).__name__}: {error}')
+                    continue
+                if outbox is not None:
+                    outbox.put(result)
+
+        threads = [threading.Thread(target=work, name=f'{name}-{i}', daemon=True) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+
+        def finish():
+            for thread in threads:
+                thread.join()
+            if outbox is not None:
+                outbox.put(_DONE)
+
+        finisher = threading.Thread(target=finish, name=f'{name}-finish', daemon=True)
+        finisher.start()
+        return finisher
+
+    def run(self, cases):
+        """Run TierUp for cases.
+
+        Args:
+            cases(Iterable[str]): Interpretation request ids and versions e.g. "1234-1", or paths to IR
+                json files
+        Returns:
+            A dictionary with the number of cases done and failed case errors
+        """
+        pathlib.Path(self.outdir).mkdir(parents=True, exist_ok=True)
+        start = time.perf_counter()
+        fetch_queue, validate_queue, retier_queue, write_queue = (
+            queue.Queue(self.queue_size) for _ in range(4)
+        )
+        # Spawn rather than fork worker processes, as forking a process with running threads is unsafe.
+        #   A spawn context pool is used as ProcessPoolExecutor only accepts a context from Python 3.7.
+        with multiprocessing.get_context('spawn').Pool(self.validate_workers) as pool:
+            self._pool = pool
+            stages = [
+                self._stage('fetch', self._fetch, fetch_queue, validate_queue, self.fetch_workers),
+                self._stage('validate', self._validate, validate_queue, retier_queue, self.validate_workers),
+                self._stage('retier', self._retier, retier_queue, write_queue, self.retier_workers),
+                self._stage('write', self._write, write_queue, None, 1),
+            ]
+            for case in cases:
+                fetch_queue.put((case, case))
+            fetch_queue.put(_DONE)
+            for stage in stages:
+                stage.join()
+        logger.info(
+            f'Pipeline finished in {time.perf_counter() - start:.1f}s: '
+            f'{self.done} cases done, {len(self.failed)} failed'
+        )
+        return {'done': self.done, 'failed': dict(self.failed)}
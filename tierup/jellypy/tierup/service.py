@@ -0,0 +1,165 @@
+"""A long-running TierUp HTTP service with warm sessions and caches.
+
+The service keeps an authenticated CIP-API session, a PanelApp panel cache and TierUp tiering state
+between requests, so each case avoids process startup, authentication and panel downloads.
+
+Endpoints:
+    - POST /retier: Retier a case. The json body is either {"irid": 1234, "irversion": 1}, to fetch the
+        case from the CIP-API, or interpretation request json data. Returns TierUp records as json.
+    - GET /health: Service status
+
+>>> service = TierUpService(config, workers=4)
+>>> service.serve(port=8080)
+
+    $ curl -X POST localhost:8080/retier -d '{"irid": 1234, "irversion": 1}'
+"""
+import json
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+
+from jellypy.tierup import lib, main, panelapp
+from jellypy.tierup.irtools import IRJIO, IRJson
+
+logger = logging.getLogger(__name__)
+
+
+class TierUpService():
+    """Retier cases on a worker pool, reusing sessions and caches between cases.
+
+    Args:
+        config: A config parser object parsed from a jellypy config.ini. Used to authenticate with the
+            CIP-API when cases are requested by id.
+        workers(int): Maximum number of cases retiered at once
+        panel_ttl(float): Seconds before the latest version of a PanelApp panel is fetched again
+    """
+
+    def __init__(self, config, workers=4, panel_ttl=3600):
+        self.config = config
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.runner = lib.TierUpRunner()
+        self.panel_updater = lib.PanelUpdater()
+        panelapp.use_panel_cache(panel_ttl)
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._httpd = None
+
+    @property
+    def session(self):
+        """An authenticated CIP-API session. Authenticates again when the token is about to expire."""
+        with self._session_lock:
+            self._session = main.cipapi_session(self.config, self._session)
+            return self._session
+
+    def _retier(self, irid=None, irversion=None, irjson=None):
+        start = time.perf_counter()
+        if irjson is None:
+            irjson = IRJIO.get_json(irid, irversion, self.session)
+        irjo = IRJson(irjson)
+        self.panel_updater.add_event_panels(irjo)
+        records = list(self.runner.run(irjo))
+        logger.info(f'Retiered {len(records)} report events for {irjo} in {time.perf_counter() - start:.2f}s')
+        return {
+            'interpretation_request_id': irjo.irid,
+            'updated_panels': irjo.updated_panels,
+            'records': records,
+            'seconds': time.perf_counter() - start,
+        }
+
+    def retier(self, irid=None, irversion=None, irjson=None):
+        """Retier a case on the worker pool and return TierUp records.
+
+        Args:
+            irid(int): Interpretation request id. Used with irversion if irjson is None.
+            irversion(int): Interpretation request version
+            irjson(dict): Interpretation request json data
+        Returns:
+            A dictionary with the case id, updated panels, TierUp records and time taken in seconds
+        """
+        return self.executor.submit(self._retier, irid, irversion, irjson).result()
+
+    def health(self):
+        return {
+            'status': 'ok',
+            'workers': self.workers,
+            'authenticated': self._session is not None,
+            'cached_panels': panelapp.panel_cache_size(),
+        }
+
+    def handle(self, method, path, body):
+        """Return (status, json body) for a request."""
+        if method == 'GET' and path.rstrip('/') == '/health':
+            return 200, self.health()
+        if method != 'POST' or path.rstrip('/') != '/retier':
+            return 404, {'detail': 'Not found.'}
+        try:
+            data = json.loads(body or b'{}')
+            if 'interpreted_genome' in data:
+                return 200, self.retier(irjson=data)
+            if 'irid' in data and 'irversion' in data:
+                return 200, self.retier(irid=int(data['irid']), irversion=int(data['irversion']))
+            return 400, {'detail': 'Expected interpretation request json or "irid" and "irversion".'}
+        except requests.HTTPError as error:
+            return 502, {'detail': f'Upstream request failed: {error}'}
+        except (IOError, ValueError, KeyError) as error:
+            return 400, {'detail': f'Invalid interpretation request: {error}'}
+
+    def serve(self, host='127.0.0.1', port=8080):
+        """Serve requests until interrupted."""
+        self._httpd = _ThreadingHTTPServer((host, port), _handler(self))
+        self._httpd.daemon_threads = True
+        logger.info(f'TierUp service listening on http://{host}:{self._httpd.server_address[1]}')
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+            self.executor.shutdown()
+
+    def shutdown(self):
+        """Stop a service started with serve() from another thread."""
+        if self._httpd:
+            self._httpd.shutdown()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in a thread, as http.server.ThreadingHTTPServer does from Python 3.7"""
+
+
+def _handler(service):
+    """Return a request handler class bound to a TierUpService."""
+
+    class TierUpRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _respond(self, method):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            try:
+                status, response = service.handle(method, self.path.split('?')[0], body)
+            except Exception as error:
+                logger.exception(f'Error handling {method} {self.path}')
+                status, response = 500, {'detail': str(error)}
+            data = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._respond('GET')
+
+        def do_POST(self):
+            self._respond('POST')
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return TierUpRequestHandler
@@ -5,24 +5,31 @@ README = ( pathlib.Path(__file__).parent / 'pypi_readme.md').read_text()
 
 setup(
     name='jellypy_tierup',
-    version='0.3.2',
+    version='0.4.0',
     author="NHS Bioinformatics Group",
     author_email="nana.mensah1@nhs.net",
     description='Reanalyse Tier 3 variants',
     license="MIT",
     url='https://github.com/NHS-NGS/JellyPy/tierup',
     packages=find_packages(),
-    python_requires='>=3.6.*',
+    python_requires='>=3.6',
     long_description=README,
     long_description_content_type="text/markdown",
     package_data={'':['data/*.schema']},
     install_requires=[
         'click==7.0',
         'jsonschema==3.2.0',
-        'jellypy-pyCIPAPI==0.2.4'
+        'jellypy-pyCIPAPI==0.3.0'
     ],
     entry_points = {
-        'console_scripts': 'tierup=jellypy.tierup.interface:cli'
+        'console_scripts': [
+            'tierup=jellypy.tierup.interface:cli',
+            'tierup-panel-update=jellypy.tierup.interface:panel_update_cli',
+            'tierup-snapshot=jellypy.tierup.interface:snapshot_cli',
+            'tierup-service=jellypy.tierup.interface:service_cli',
+            'tierup-queue=jellypy.tierup.interface:queue_cli',
+            'tierup-batch=jellypy.tierup.interface:batch_cli'
+        ]
     },
     classifiers=[
         "Programming Language :: Python :: 3.6"
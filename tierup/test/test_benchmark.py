@@ -0,0 +1,197 @@
+"""
+Benchmarks for the TierUp hot path.
+
+Cases and PanelApp panels are generated offline with jellypy.pyCIPAPI.synthetic. Each benchmark runs at
+several case sizes and records events per second and the tracemalloc peak in the benchmark extra_info.
+Both are checked against test_data/benchmark_baseline.json. A benchmark fails if its tracemalloc peak
+grows, or its events per second falls, by more than the tolerance in the baseline file.
+
+Benchmarks are skipped unless --run-benchmarks is passed.
+
+Usage:
+    # Run the benchmarks and check them against the baseline
+    pytest tierup/test/test_benchmark.py --run-benchmarks
+    # Update the baseline after an intended change
+    pytest tierup/test/test_benchmark.py --update-benchmark-baseline
+    # Also fail if the mean time of any benchmark regresses by more than 10% against the last saved run
+    pytest tierup/test/test_benchmark.py --run-benchmarks --benchmark-autosave
+    pytest tierup/test/test_benchmark.py --run-benchmarks --benchmark-compare --benchmark-compare-fail=mean:10%
+"""
+import json
+import pathlib
+import tracemalloc
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from jellypy.pyCIPAPI.synthetic import SyntheticCaseGenerator
+from jellypy.tierup import panelapp
+from jellypy.tierup.irtools import IRJIO, IRJson, IRJValidator
+from jellypy.tierup.lib import TierUpCSVWriter, TieringLite, TierUpRunner
+
+pytestmark = pytest.mark.benchmark
+
+BASELINE_PATH = pathlib.Path(__file__).parent / "test_data" / "benchmark_baseline.json"
+
+# Variants per case. Each variant has two report events.
+CASE_SIZES = [10, 100, 1000]
+EVENTS_PER_VARIANT = 2
+PANELS = 20
+
+
+def generator(variants):
+    return SyntheticCaseGenerator(
+        seed=1, variants=variants, events_per_variant=EVENTS_PER_VARIANT, total_panels=PANELS
+    )
+
+
+@pytest.fixture(scope="module")
+def snapshot_path(tmp_path_factory):
+    """Write synthetic PanelApp panels to a snapshot file"""
+    path = tmp_path_factory.mktemp("panelapp") / "panelapp.snapshot"
+    gen = generator(0)
+    panelapp.PanelAppSnapshot.write(
+        str(path),
+        [gen.panel_summary(panel_id) for panel_id in range(1, PANELS + 1)],
+        [gen.panel(panel_id) for panel_id in range(1, PANELS + 1)]
+    )
+    return str(path)
+
+
+@pytest.fixture
+def offline_panelapp(snapshot_path):
+    panelapp.use_snapshot(snapshot_path)
+
+
+@pytest.fixture(params=CASE_SIZES, ids=lambda size: f"{size}variants")
+def case(request, tmp_path, offline_panelapp):
+    """Return (irjson path, irjson data, IRJson object, number of report events) for a synthetic case"""
+    irjson = generator(request.param).interpretation_request(1, 1)
+    path = tmp_path / "1-1.json"
+    with open(path, "w") as f:
+        json.dump(irjson, f)
+    return str(path), irjson, IRJson(irjson), request.param * EVENTS_PER_VARIANT
+
+
+@pytest.fixture(scope="module")
+def baseline(request):
+    """Return the baseline benchmark results. With --update-benchmark-baseline, results are saved on teardown."""
+    with open(BASELINE_PATH) as f:
+        data = json.load(f)
+    update = request.config.getoption("--update-benchmark-baseline")
+    if update:
+        data["benchmarks"] = {}
+    yield data, update
+    if update:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+
+@pytest.fixture
+def record_stats(benchmark, baseline):
+    """Return a function adding events per second and the tracemalloc peak for one call of a function to
+    the benchmark, then checking both against the baseline."""
+    data, update = baseline
+
+    def record(events, function, *args):
+        tracemalloc.start()
+        try:
+            function(*args)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        stats = {"events_per_second": round(events / benchmark.stats.stats.mean), "tracemalloc_peak_bytes": peak}
+        benchmark.extra_info["events"] = events
+        benchmark.extra_info.update(stats)
+        if update:
+            data["benchmarks"][benchmark.name] = stats
+            return
+        expected = data["benchmarks"].get(benchmark.name)
+        if expected is None:
+            pytest.fail(f"No baseline for {benchmark.name}. Run with --update-benchmark-baseline")
+        # Small peaks vary by a few allocations between runs, so a fixed slack is also allowed
+        max_peak = (
+            expected["tracemalloc_peak_bytes"] * (1 + data["tolerance"]["tracemalloc_peak_bytes"])
+            + data["tolerance"]["tracemalloc_slack_bytes"]
+        )
+        assert peak <= max_peak, (
+            f"tracemalloc peak {peak} bytes exceeds the baseline "
+            f"{expected['tracemalloc_peak_bytes']} bytes by more than the tolerance"
+        )
+        min_rate = expected["events_per_second"] * (1 - data["tolerance"]["events_per_second"])
+        assert stats["events_per_second"] >= min_rate, (
+            f"{stats['events_per_second']} events per second is below the baseline "
+            f"{expected['events_per_second']} by more than the tolerance"
+        )
+
+    return record
+
+
+def test_irjio_read(benchmark, record_stats, case):
+    path, _, _, events = case
+    benchmark(IRJIO.read, path)
+    record_stats(events, IRJIO.read, path)
+
+
+def test_validate(benchmark, record_stats, case):
+    _, irjson, _, events = case
+    benchmark(IRJValidator().validate, irjson)
+    record_stats(events, IRJValidator().validate, irjson)
+
+
+def test_irjson(benchmark, record_stats, case):
+    _, irjson, _, events = case
+    benchmark(IRJson, irjson)
+    record_stats(events, IRJson, irjson)
+
+
+def test_proband_report_events(benchmark, record_stats, case):
+    _, _, irjo, events = case
+    runner = TierUpRunner()
+
+    def proband_events():
+        return list(runner._get_proband_report_events(irjo))
+
+    benchmark(proband_events)
+    record_stats(events, proband_events)
+
+
+def test_retier(benchmark, record_stats, case):
+    _, _, irjo, events = case
+    tiering_lite = TieringLite()
+    report_events = [
+        (event, irjo.panels[event.panelname])
+        for event in TierUpRunner()._get_proband_report_events(irjo)
+    ]
+
+    def retier():
+        return [tiering_lite.retier(event, panel) for event, panel in report_events]
+
+    benchmark(retier)
+    record_stats(events, retier)
+
+
+def test_gelpanel_query(benchmark, record_stats, case):
+    _, _, irjo, events = case
+    queries = [
+        (irjo.panels[event.panelname], event.ensembl)
+        for event in TierUpRunner()._get_proband_report_events(irjo)
+    ]
+
+    def query():
+        return [panel.query(ensembl) for panel, ensembl in queries]
+
+    benchmark(query)
+    record_stats(events, query)
+
+
+def test_csv_writer(benchmark, record_stats, case, tmp_path):
+    _, _, _, events = case
+    writer = TierUpCSVWriter(str(tmp_path / "tierup.csv"))
+    # Records with every output column, as created by TierUpRunner.tierup_record
+    records = [{field: f"{field}_{index}" for field in writer.header} for index in range(events)]
+    benchmark(writer.write, records)
+    record_stats(events, writer.write, records)
+    writer.close_file()
@@ -1,11 +1,26 @@
 import json
 import os
+import pickle
+import time
 from distutils import dir_util
 from pathlib import Path
+from types import SimpleNamespace
 
 import pytest
+import requests
+from jellypy.pyCIPAPI import transport
+from jellypy.pyCIPAPI.synthetic import SyntheticCaseGenerator
+from jellypy.tierup import lib, main
+from jellypy.tierup.index import PanelEventIndex, changed_genes
+from jellypy.tierup.jobqueue import JobQueue
+from jellypy.tierup.metrics import RunMetrics
+from jellypy.tierup.pipeline import Pipeline
+from jellypy.tierup.service import TierUpService
 from jellypy.tierup.lib import TieringLite, ReportEvent
-from jellypy.tierup.panelapp import GeLPanel
+from jellypy.tierup import panelapp
+from jellypy.tierup.panelapp import (
+    CompactPanel, GeLPanel, PanelApp, PanelAppSnapshot, PanelGeneTable, diff_panels
+)
 
 
 # Read test data from a file
@@ -24,6 +39,25 @@ def test_gelpanel_query(tdata):
     for query, result in tdata["test_gel_panel"][0]["queries"].items():
         assert gp.query(query) == tuple(result)
 
+def test_panelapp_snapshot_export(tdata, tmpdir, request):
+    """A snapshot exported from PanelApp answers the same queries, and has every field of the test snapshot"""
+    if not request.config.getoption("--panelapp-live"):
+        pytest.skip("needs the PanelApp API: pass --panelapp-live to run")
+    snapshot_path = str(tmpdir / "export.snapshot")
+    PanelAppSnapshot.export(snapshot_path, panel_ids=[123, 254])
+    panelapp.use_snapshot(snapshot_path)
+    gp = GeLPanel(tdata["test_gel_panel"][0]["panel_id"])
+    for query, result in tdata["test_gel_panel"][0]["queries"].items():
+        assert gp.query(query) == tuple(result)
+    export = PanelAppSnapshot(snapshot_path)
+    fixture = PanelAppSnapshot(str(Path(request.module.__file__).parent / "test_data" / "panelapp.snapshot"))
+    assert set(export.header["offsets"]) == set(fixture.header["offsets"])
+    for panel_id in fixture.header["offsets"]:
+        exported, trimmed = export.panel_json(panel_id), fixture.panel_json(panel_id)
+        assert set(trimmed) <= set(exported)
+        assert set(trimmed["genes"][0]) <= set(exported["genes"][0])
+        assert set(trimmed["genes"][0]["gene_data"]) <= set(exported["genes"][0]["gene_data"])
+
 def test_mode_of_inheritance(tdata):
     tl = TieringLite()
     for test_data in tdata["test_mode_of_inheritance"]:
@@ -41,4 +75,204 @@ def test_tiering_lite(tdata):
     for td in tdata["test_tiering_lite"]:
         event = ReportEvent(td['report_event'], td['variant'], td['proband_call'])
         panel = GeLPanel(td['panel_id'])
-        assert tl.retier(event, panel)[0] == td['result']
\ No newline at end of file
+        assert tl.retier(event, panel)[0] == td['result']
+
+def test_panel_event_index(tdata, tmpdir):
+    td = tdata["test_tiering_lite"][0]
+    event_panel = td["report_event"]["genePanel"]["panelName"]
+    irjo = SimpleNamespace(
+        irid="1234-1",
+        proband_id=td["proband_call"]["participantId"],
+        tiering={"interpreted_genome_data": {"variants": [td["variant"]]}},
+        panels={event_panel: SimpleNamespace(id=td["panel_id"])}
+    )
+    index = PanelEventIndex(Path(tmpdir / "index.json"))
+    index.add(irjo)
+    # Re-indexing a case replaces its entries
+    index.add(irjo)
+    index.save()
+    ensembl = td["report_event"]["genomicEntities"][0]["ensemblId"]
+    reloaded = PanelEventIndex(Path(tmpdir / "index.json"))
+    assert ("1234-1", td["report_event"]["reportEventId"]) in reloaded.lookup(td["panel_id"], ensembl)
+    assert len(reloaded.lookup(td["panel_id"], ensembl)) == len(set(reloaded.lookup(td["panel_id"], ensembl)))
+    reloaded.remove("1234-1")
+    assert reloaded.lookup(td["panel_id"], ensembl) == []
+
+def panel_json(version, genes, panel_id=1, name="Test panel"):
+    """Return PanelApp json for a test panel. Genes are (hgnc_id, symbol, confidence, moi) tuples."""
+    return {
+        "name": name, "id": panel_id, "hash_id": None, "version": version, "version_created": None,
+        "genes": [
+            {
+                "gene_data": {
+                    "hgnc_id": hgnc_id, "hgnc_symbol": symbol,
+                    "ensembl_genes": {"GRch38": {"90": {"ensembl_id": f"ENSG{hgnc_id[5:]}"}}}
+                },
+                "confidence_level": confidence, "mode_of_inheritance": moi
+            }
+            for hgnc_id, symbol, confidence, moi in genes
+        ]
+    }
+
+def test_diff_panels():
+    old = GeLPanel(1, panel_json=panel_json("1.9", [
+        ("HGNC:1", "A", "3", "BIALLELIC"), ("HGNC:2", "B", "3", "BIALLELIC"), ("HGNC:3", "C", "2", "")
+    ]))
+    new = GeLPanel(1, panel_json=panel_json("1.10", [
+        ("HGNC:1", "A", "1", "MONOALLELIC"), ("HGNC:3", "C", "2", ""), ("HGNC:4", "D", "3", "")
+    ]))
+    changes = [(c.hgnc_symbol, c.change, c.old, c.new, c.ensembl_ids) for c in diff_panels(old, new)]
+    assert changes == [
+        ("A", "confidence", "3", "1", ("ENSG1",)),
+        ("A", "moi", "BIALLELIC", "MONOALLELIC", ("ENSG1",)),
+        ("B", "removed", "3", None, ("ENSG2",)),
+        ("D", "added", None, "3", ("ENSG4",))
+    ]
+    assert diff_panels(old, new)[0][1:3] == ("1.9", "1.10")
+    assert changed_genes(old, new) == {"ENSG1": "changed", "ENSG2": "removed", "ENSG4": "added"}
+
+def test_panelapp_snapshot(tmpdir):
+    snapshot_path = str(tmpdir / "panelapp.snapshot")
+    panels = [
+        panel_json("1.10", [("HGNC:1", "A", "3", "BIALLELIC")], panel_id=1, name="Panel one"),
+        panel_json("2.0", [("HGNC:2", "B", "2", "")], panel_id=2, name="Panel two")
+    ]
+    listing = [{"id": p["id"], "name": p["name"], "relevant_disorders": [p["name"]]} for p in panels]
+    PanelAppSnapshot.write(snapshot_path, listing, panels)
+    panelapp.use_snapshot(snapshot_path)
+    assert GeLPanel(1).query("ENSG1") == ("HGNC:1", "A", "3", "ENSG1", "BIALLELIC")
+    assert GeLPanel("panel two").id == 2
+    assert GeLPanel(1, version="1.10").version_string == "1.10"
+    with pytest.raises(requests.HTTPError):
+        GeLPanel(1, version="1.1")
+    with pytest.raises(requests.HTTPError):
+        GeLPanel(3)
+    assert [p["id"] for p in PanelApp()] == [1, 2]
+
+def test_panel_gene_table(tmpdir):
+    table_path = str(tmpdir / "panels.genes")
+    panels = [
+        GeLPanel(1, panel_json=panel_json("1.10", [
+            ("HGNC:3", "C", "3", "BIALLELIC"), ("HGNC:1", "A", "3", "BIALLELIC"), ("HGNC:2", "B", None, "")
+        ])),
+        GeLPanel(2, panel_json=panel_json("2.0", [("HGNC:4", "D", "2", "BIALLELIC")], panel_id=2, name="Two"))
+    ]
+    PanelGeneTable.write(table_path, panels)
+    panelapp.use_gene_table(table_path)
+    compact = panelapp.get_panel(1)
+    assert isinstance(compact, CompactPanel)
+    assert (compact.name, compact.id, compact.version, compact.version_string) == ("Test panel", 1, 1.1, "1.10")
+    for ensembl_id in ["ENSG1", "ENSG2", "ENSG3", "ENSG4", "ENSG0", "ENSG9", ""]:
+        assert compact.query(ensembl_id) == panels[0].query(ensembl_id)
+    assert compact.genes == panels[0].genes
+    assert panelapp.get_panel("two").query("ENSG4") == panels[1].query("ENSG4")
+    assert pickle.loads(pickle.dumps(compact)).query("ENSG3") == panels[0].query("ENSG3")
+    with pytest.raises(requests.HTTPError):
+        panelapp.get_panel(3)
+    PanelGeneTable.open(table_path).close()
+
+def test_run_metrics(tmpdir):
+    snapshot_path = str(tmpdir / "panelapp.snapshot")
+    panel = panel_json("1.0", [("HGNC:1", "A", "3", "BIALLELIC")])
+    PanelAppSnapshot.write(snapshot_path, [{"id": 1, "name": "Test panel"}], [panel])
+    panelapp.use_snapshot(snapshot_path)
+    with RunMetrics(case="1234-1") as run_metrics:
+        with run_metrics.stage("retier"):
+            GeLPanel(1)
+        run_metrics.count("report_events", 10)
+        transport._notify("cipapi.example", "GET", 200, 100, 0.5)
+        transport._notify("cipapi.example", "GET", None, 0, 0.1)
+    # Requests after the run are not counted
+    transport._notify("cipapi.example", "GET", 200, 100, 0.5)
+    assert run_metrics.http["cipapi.example"] == {"requests": 2, "bytes": 100, "seconds": 0.6, "errors": 1}
+    assert sum(run_metrics.cache_hits.values()) == 1
+    assert run_metrics.events_per_second == 10 / run_metrics.stages["retier"]
+    metrics_path = str(tmpdir / "tierup.prom")
+    run_metrics.write_prometheus(metrics_path)
+    with open(metrics_path) as f:
+        lines = f.read().splitlines()
+    assert 'tierup_http_requests_total{case="1234-1",host="cipapi.example"} 2' in lines
+    assert 'tierup_count{case="1234-1",name="report_events"} 10' in lines
+
+@pytest.fixture
+def synthetic_panelapp(tmpdir):
+    """Serve synthetic PanelApp panels from a snapshot. Returns the case generator."""
+    generator = SyntheticCaseGenerator(seed=1, variants=20, total_panels=5)
+    snapshot_path = str(tmpdir / "synthetic.snapshot")
+    PanelAppSnapshot.write(
+        snapshot_path, [generator.panel_summary(i) for i in range(1, 6)], [generator.panel(i) for i in range(1, 6)]
+    )
+    panelapp.use_snapshot(snapshot_path)
+    return generator
+
+def test_service(synthetic_panelapp, monkeypatch):
+    monkeypatch.setattr(lib, "tierup_version", lambda: "test")
+    service = TierUpService(config=None, workers=2)
+    irjson = synthetic_panelapp.interpretation_request(7, 1)
+    status, response = service.handle("POST", "/retier", json.dumps(irjson).encode())
+    assert status == 200 and response["interpretation_request_id"] == "7-1"
+    assert len(response["records"]) == 40
+    # Panels are cached between cases
+    assert service.handle("POST", "/retier", json.dumps(irjson).encode())[0] == 200
+    assert service.health()["cached_panels"] == 2
+    assert service.handle("POST", "/retier", b'{"case": 1}')[0] == 400
+    assert service.handle("GET", "/missing", b"")[0] == 404
+
+def test_job_queue(tmpdir, monkeypatch):
+    monkeypatch.setattr(main, "cipapi_session", lambda config, session: None)
+    queue = JobQueue(str(tmpdir / "queue.db"), max_attempts=2, backoff=0)
+    assert queue.add("1-1", "2-1", str(tmpdir / "3-1.json")) == 3
+    assert queue.add("1-1") == 0
+    calls = []
+
+    def run(config, outdir, irid_irversion=None, irjson=None, session=None):
+        calls.append(irid_irversion or irjson)
+        if irid_irversion == (2, 1):
+            raise IOError("Case failed")
+        return f"{outdir}/{irid_irversion}.tierup.csv"
+
+    counts = queue.work(None, str(tmpdir), run=run, poll=0)
+    assert counts == {"done": 2, "failed": 2}
+    assert queue.status() == {"done": 2, "failed": 1}
+    assert queue.failures() == [("2-1", 2, "OSError: Case failed")]
+    assert calls.count((2, 1)) == 2 and str(tmpdir / "3-1.json") in calls
+    # Completed jobs are not run again
+    assert queue.retry_failed() == 1
+    assert queue.work(None, str(tmpdir), run=run, poll=0) == {"failed": 2}
+
+def test_job_queue_lease(tmpdir):
+    # With a zero lease, a running job can be claimed again straight away, as if its worker had stalled
+    queue = JobQueue(str(tmpdir / "lease.db"), max_attempts=2, backoff=0, lease=0)
+    queue.add("1-1", "2-1")
+    assert queue.claim("slow")[0] == "1-1"
+    time.sleep(0.01)
+    assert queue.claim("fast")[0] == "1-1"
+    # The first worker lost its lease, so cannot finish or fail the job
+    assert not queue.complete("1-1", "slow", "slow.csv")
+    assert queue.fail("1-1", "slow", "Error") is None
+    assert queue.complete("1-1", "fast", "fast.csv")
+    assert queue.fail("1-1", "fast", "Error") is None
+    assert queue.status() == {"done": 1, "pending": 1}
+    # A job whose lease expires on its last attempt is failed rather than claimed again
+    assert queue.claim("a")[0] == "2-1"
+    time.sleep(0.01)
+    assert queue.claim("b")[0] == "2-1"
+    time.sleep(0.01)
+    assert queue.claim("c") is None
+    assert queue.failures() == [("2-1", 2, "Lease expired on the last attempt")]
+
+def test_pipeline(synthetic_panelapp, monkeypatch, tmpdir):
+    monkeypatch.setattr(lib, "tierup_version", lambda: "test")
+    cases = []
+    for ir_id in range(1, 6):
+        irjson = synthetic_panelapp.interpretation_request(ir_id, 1)
+        if ir_id == 5:
+            irjson["status"] = []  # Not sent to GMCs, so fails validation
+        cases.append(str(tmpdir / f"{ir_id}-1.json"))
+        with open(cases[-1], "w") as f:
+            json.dump(irjson, f)
+    outdir = tmpdir / "results"
+    result = Pipeline(None, str(outdir), fetch_workers=2, validate_workers=2, queue_size=1).run(cases)
+    assert result["done"] == 4 and list(result["failed"]) == [cases[4]]
+    assert result["failed"][cases[4]][0] == "validate"
+    assert sorted(os.listdir(outdir)) == [f"{ir_id}-1.tierup.csv" for ir_id in range(1, 5)]